@@ -0,0 +1,39 @@
+"""
+Alembic environment: same DB and metadata as the application (database.py / models.py)
+"""
+from logging.config import fileConfig
+from alembic import context
+from database import engine, SQLALCHEMY_DATABASE_URL
+import models
+
+
+config = context.config
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = models.Base.metadata
+
+
+def run_migrations_offline():
+    """
+    Generate the SQL script without a DB connection (alembic upgrade head --sql).
+    """
+    context.configure(url=SQLALCHEMY_DATABASE_URL, target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """
+    Run the migrations on the application DB.
+    """
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
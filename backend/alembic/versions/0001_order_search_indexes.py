@@ -0,0 +1,30 @@
+"""
+Composite indexes for the order search (GET /orders filters)
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+
+The tables are created by the application (create_all), this revision only adds the indexes to existing DBs.
+"""
+from alembic import op
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    #Filter by pharmacy, status and date range
+    op.create_index("ix_orders_pharmacy_status_date", "orders", ["pharmacy_id", "status", "order_date"],
+                    if_not_exists=True)
+    #Orders containing a medication (the order id is read from the index)
+    op.create_index("ix_order_items_medication_order", "order_items", ["medication_id", "order_id"],
+                    if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index("ix_order_items_medication_order", table_name="order_items", if_exists=True)
+    op.drop_index("ix_orders_pharmacy_status_date", table_name="orders", if_exists=True)
@@ -0,0 +1,53 @@
+"""
+Medication index set derived from the query patterns
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+
+Dropped (maintained on every order, no query looks them up):
+-> ix_medications_quantity, ix_medications_price, ix_medications_stock: quantity and stock are written by every
+   order; the three columns are only sort keys of the medication list, sorted by the DB after filtering.
+-> ix_medications_stock_level: replaced by ix_medications_stock_level_pharma.
+-> ix_medications_name: duplicate of the leading column of uq_medications_name_pharma_id.
+Added / ensured on existing DBs:
+-> uq_medications_name_pharma_id (name, pharma_id): filter_by(name=...) for the central stock updates, bulk import key.
+-> ix_medications_name_lower: case insensitive search and sort.
+-> ix_medications_stock_level_pharma (stock_level, pharma_id): stock level filter, low stock per pharmacy.
+The (id, pharma_id) lookups are served by the primary key.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+DROPPED = {
+    "ix_medications_quantity": "quantity",
+    "ix_medications_price": "price",
+    "ix_medications_stock": "stock",
+    "ix_medications_stock_level": "stock_level",
+    "ix_medications_name": "name",
+}
+
+
+def upgrade():
+    #Unique index: fails if the table already has the same medication twice in a pharmacy
+    op.create_index("uq_medications_name_pharma_id", "medications", ["name", "pharma_id"], unique=True,
+                    if_not_exists=True)
+    op.create_index("ix_medications_name_lower", "medications", [sa.text("lower(name)")], if_not_exists=True)
+    op.create_index("ix_medications_stock_level_pharma", "medications", ["stock_level", "pharma_id"],
+                    if_not_exists=True)
+
+    for index_name in DROPPED:
+        op.drop_index(index_name, table_name="medications", if_exists=True)
+
+
+def downgrade():
+    for index_name, column in DROPPED.items():
+        op.create_index(index_name, "medications", [column], if_not_exists=True)
+
+    op.drop_index("ix_medications_stock_level_pharma", table_name="medications", if_exists=True)
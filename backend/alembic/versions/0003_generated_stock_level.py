@@ -0,0 +1,42 @@
+"""
+stock_level as a generated column computed by the DB from the stock
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+
+The thresholds are read from STOCK_LEVEL_LOW_MAX / STOCK_LEVEL_MEDIUM_MAX (.env) when the revision runs.
+To change them, add a revision with the same upgrade (the column is re-created with the new expression).
+SQLite cannot add a stored generated column with ALTER TABLE: the table is re-created (batch mode).
+"""
+from alembic import op
+import sqlalchemy as sa
+from models import stock_level_expression
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def recreate_stock_level(column: sa.Column):
+    """
+    Replace the stock_level column (and its index).
+    """
+    op.drop_index("ix_medications_stock_level_pharma", table_name="medications", if_exists=True)
+    with op.batch_alter_table("medications") as batch:
+        batch.drop_column("stock_level")
+        batch.add_column(column)
+    op.create_index("ix_medications_stock_level_pharma", "medications", ["stock_level", "pharma_id"])
+
+
+def upgrade():
+    recreate_stock_level(sa.Column("stock_level", sa.String,
+                                   sa.Computed(stock_level_expression(sa.column("stock")), persisted=True)))
+
+
+def downgrade():
+    recreate_stock_level(sa.Column("stock_level", sa.String))
+    medications = sa.table("medications", sa.column("stock"), sa.column("stock_level"))
+    op.execute(medications.update().values(stock_level=stock_level_expression(medications.c.stock)))
@@ -0,0 +1,36 @@
+"""
+Row versions of the medications and orders for the delta sync
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19
+
+The existing rows get version 0 (a first sync with since_version=0 returns all of them).
+The sync_state and sync_tombstones tables are created by the application (create_all). A DB created by the current
+application already has the columns (create_all), they are only added when missing.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+TABLES = ["medications", "orders"]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table in TABLES:
+        if "row_version" not in {column["name"] for column in inspector.get_columns(table)}:
+            op.add_column(table, sa.Column("row_version", sa.Integer, server_default="0"))
+        op.create_index(f"ix_{table}_row_version", table, ["row_version"], if_not_exists=True)
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_index(f"ix_{table}_row_version", table_name=table)
+        with op.batch_alter_table(table) as batch:
+            batch.drop_column("row_version")
@@ -0,0 +1,31 @@
+"""
+Index for the stock history time ranges (GET /medications/{id}/stock-history)
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19
+
+The stock_ledger table is created by the application (create_all), this revision only adds the index to existing DBs.
+A DB without the table (the application has not run yet) is skipped: create_all builds the table with the index.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if not sa.inspect(op.get_bind()).has_table("stock_ledger"):
+        return
+    op.create_index("ix_stock_ledger_medication_created_at", "stock_ledger", ["medication_id", "created_at"],
+                    if_not_exists=True)
+
+
+def downgrade():
+    if not sa.inspect(op.get_bind()).has_table("stock_ledger"):
+        return
+    op.drop_index("ix_stock_ledger_medication_created_at", table_name="stock_ledger", if_exists=True)
@@ -0,0 +1,33 @@
+"""
+Pharmacy locations for the nearest pharmacy lookups
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-19
+
+The existing pharmacies have no location until they are updated (they are left out of the spatial index).
+A DB created by the current application already has the columns (create_all), they are only added when missing.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+COLUMNS = ["latitude", "longitude"]
+
+
+def upgrade():
+    existing = {column["name"] for column in sa.inspect(op.get_bind()).get_columns("pharmacies")}
+    for column in COLUMNS:
+        if column not in existing:
+            op.add_column("pharmacies", sa.Column(column, sa.Float, nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("pharmacies") as batch:
+        for column in COLUMNS:
+            batch.drop_column(column)
@@ -0,0 +1,26 @@
+"""
+Drop the single column index on orders.pharmacy_id
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-19
+
+pharmacy_id is the leading column of ix_orders_pharmacy_status_date, which serves the pharmacy lookups too. With both
+indexes, SQLite picked ix_orders_pharmacy_id for the pharmacy + status search sorted by id (the rowid order saves the
+sort) and ignored the status filter (tests/test_order_query_plans.py).
+"""
+from alembic import op
+
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_index("ix_orders_pharmacy_id", table_name="orders", if_exists=True)
+
+
+def downgrade():
+    op.create_index("ix_orders_pharmacy_id", "orders", ["pharmacy_id"], if_not_exists=True)
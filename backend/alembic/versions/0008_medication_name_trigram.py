@@ -0,0 +1,29 @@
+"""
+Trigram index for the "contains" medication name search (PostgreSQL only)
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-19
+
+New DBs get the extension and the index from create_all (after_create DDL on medications), existing DBs from here.
+"""
+from alembic import op
+
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.execute("CREATE INDEX IF NOT EXISTS ix_medications_name_trgm ON medications USING gin (lower(name) gin_trgm_ops)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.execute("DROP INDEX IF EXISTS ix_medications_name_trgm")
@@ -0,0 +1,31 @@
+"""
+Single column stock_level index
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-19
+
+Every order updates the stock (and the generated stock_level) of all the rows with the same name, one row per
+pharmacy. In ix_medications_stock_level_pharma (stock_level, pharma_id) these rows are spread over one index page per
+pharmacy; in ix_medications_stock_level (stock_level) they stay next to each other (rowid order). On SQLite the order
+write throughput goes from 235-340 to 520-810 orders/s (benchmark_writes.py).
+The stock level filter of the list is served by the single column index too.
+"""
+from alembic import op
+
+
+revision = "0009"
+down_revision = "0008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index("ix_medications_stock_level", "medications", ["stock_level"], if_not_exists=True)
+    op.drop_index("ix_medications_stock_level_pharma", table_name="medications", if_exists=True)
+
+
+def downgrade():
+    op.create_index("ix_medications_stock_level_pharma", "medications", ["stock_level", "pharma_id"],
+                    if_not_exists=True)
+    op.drop_index("ix_medications_stock_level", table_name="medications", if_exists=True)
@@ -0,0 +1,140 @@
+"""
+Unique (name, address) index of the pharmacies (upsert key of the pharmacy bulk import)
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-19
+
+create_all only adds uq_pharmacies_name_address to new DBs, the bulk import (ON CONFLICT (name, address)) needs it.
+The duplicate pharmacies (same name and address) are merged into the one with the lowest id first:
+-> their orders and stock alerts move to it
+-> their medications move to it; a medication it already lists gets the quantity of the duplicate row, with its order
+   items, reorder proposals and stock alerts, and the duplicate row is deleted (its ledger rows are kept as history)
+-> the sales rollups are rebuilt from the orders
+The moved rows get a new delta sync version, the deleted medications a tombstone, and the table change counters are
+increased. The tables the application has not created yet are skipped.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0010"
+down_revision = "0009"
+branch_labels = None
+depends_on = None
+
+INDEX_NAME = "uq_pharmacies_name_address"
+COLUMNS = ["name", "address"]
+MEDICATION_REFERENCES = ["order_items", "reorder_proposals", "stock_alerts"]
+
+
+def has_unique_key(inspector) -> bool:
+    """
+    Check for a unique constraint or index on (name, address), e.g. built by create_all.
+    """
+    keys = inspector.get_unique_constraints("pharmacies") + [
+        index for index in inspector.get_indexes("pharmacies") if index["unique"]]
+    return any(key["column_names"] == COLUMNS for key in keys)
+
+
+def next_sync_version(bind, tables):
+    """
+    Next delta sync version (None without the sync tables).
+    """
+    if "sync_state" not in tables:
+        return None
+    bind.execute(sa.text("UPDATE sync_state SET version = version + 1 WHERE id = 1"))
+    return bind.execute(sa.text("SELECT version FROM sync_state WHERE id = 1")).scalar()
+
+
+def merge_medication(bind, tables, version, medication_id, target_id, quantity):
+    """
+    Merge a medication row of a duplicate pharmacy into the row of the same medication in the kept pharmacy.
+    """
+    params = {"id": medication_id, "target": target_id, "quantity": quantity or 0, "version": version}
+    bind.execute(sa.text("UPDATE medications SET quantity = COALESCE(quantity, 0) + :quantity WHERE id = :target"),
+                 params)
+    if version is not None:
+        bind.execute(sa.text("UPDATE medications SET row_version = :version WHERE id = :target"), params)
+        bind.execute(sa.text("UPDATE orders SET row_version = :version "
+                             "WHERE id IN (SELECT order_id FROM order_items WHERE medication_id = :id)"), params)
+    for table in MEDICATION_REFERENCES:
+        if table in tables:
+            bind.execute(sa.text(f"UPDATE {table} SET medication_id = :target WHERE medication_id = :id"), params)
+    bind.execute(sa.text("DELETE FROM medications WHERE id = :id"), params)
+    if version is not None and "sync_tombstones" in tables:
+        bind.execute(sa.text("INSERT INTO sync_tombstones (table_name, row_id, version) "
+                             "VALUES ('medications', :id, :version)"), params)
+
+
+def merge_pharmacies(bind, tables, duplicates):
+    """
+    Merge every (duplicate id, kept id) pharmacy into the kept one.
+    """
+    version = next_sync_version(bind, tables)
+    row_version = ", row_version = :version" if version is not None else ""
+
+    for duplicate_id, keep_id in duplicates:
+        params = {"duplicate": duplicate_id, "keep": keep_id, "version": version}
+        kept = dict(bind.execute(sa.text("SELECT name, id FROM medications WHERE pharma_id = :keep"), params).all())
+        for medication_id, name, quantity in bind.execute(
+                sa.text("SELECT id, name, quantity FROM medications WHERE pharma_id = :duplicate"), params).all():
+            if name in kept:
+                merge_medication(bind, tables, version, medication_id, kept[name], quantity)
+            else:
+                bind.execute(sa.text(f"UPDATE medications SET pharma_id = :keep{row_version} WHERE id = :id"),
+                             {**params, "id": medication_id})
+
+        bind.execute(sa.text(f"UPDATE orders SET pharmacy_id = :keep{row_version} WHERE pharmacy_id = :duplicate"),
+                     params)
+        if "stock_alerts" in tables:
+            bind.execute(sa.text("UPDATE stock_alerts SET pharma_id = :keep WHERE pharma_id = :duplicate"), params)
+        bind.execute(sa.text("DELETE FROM pharmacies WHERE id = :duplicate"), params)
+
+    if {"daily_medication_sales", "daily_pharmacy_sales"} <= tables:
+        rebuild_sales_rollups(bind)
+    if "table_versions" in tables:
+        bind.execute(sa.text("UPDATE table_versions SET version = version + 1 "
+                             "WHERE table_name IN ('medications', 'pharmacies', 'orders')"))
+
+
+def rebuild_sales_rollups(bind):
+    """
+    Recompute both sales rollups from the orders (same statements as SalesRollupRepository.rebuild).
+    """
+    bind.execute(sa.text("DELETE FROM daily_medication_sales"))
+    bind.execute(sa.text("DELETE FROM daily_pharmacy_sales"))
+    bind.execute(sa.text(
+        "INSERT INTO daily_medication_sales (day, medication_id, pharmacy_id, quantity, revenue, order_count) "
+        "SELECT date(o.order_date), i.medication_id, o.pharmacy_id, SUM(i.quantity), SUM(i.quantity * i.price), "
+        "COUNT(DISTINCT o.id) FROM order_items i JOIN orders o ON i.order_id = o.id "
+        "GROUP BY date(o.order_date), i.medication_id, o.pharmacy_id"))
+    bind.execute(sa.text(
+        "INSERT INTO daily_pharmacy_sales (day, pharmacy_id, quantity, revenue, order_count) "
+        "SELECT date(o.order_date), o.pharmacy_id, SUM(i.quantity), SUM(i.quantity * i.price), "
+        "COUNT(DISTINCT o.id) FROM order_items i JOIN orders o ON i.order_id = o.id "
+        "GROUP BY date(o.order_date), o.pharmacy_id"))
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if has_unique_key(inspector):
+        return
+
+    #Every duplicate pharmacy with the lowest id of its (name, address) group
+    duplicates = bind.execute(sa.text(
+        "SELECT p.id, k.keep_id FROM pharmacies p "
+        "JOIN (SELECT name, address, MIN(id) AS keep_id FROM pharmacies "
+        "      GROUP BY name, address HAVING COUNT(*) > 1) k ON p.name = k.name AND p.address = k.address "
+        "WHERE p.id <> k.keep_id ORDER BY p.id")).all()
+    if duplicates:
+        merge_pharmacies(bind, set(inspector.get_table_names()), duplicates)
+
+    op.create_index(INDEX_NAME, "pharmacies", COLUMNS, unique=True)
+
+
+def downgrade():
+    #Only the index of this revision, a constraint built by create_all is kept
+    if INDEX_NAME in {index["name"] for index in sa.inspect(op.get_bind()).get_indexes("pharmacies")}:
+        op.drop_index(INDEX_NAME, table_name="pharmacies")
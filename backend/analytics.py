@@ -0,0 +1,71 @@
+"""
+Order analytics computed in the DB (only the aggregated rows are returned)
+The analytics read the daily sales rollups instead of the order items.
+"""
+from datetime import date
+from typing import List, Optional
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from models import DailyMedicationSalesDB, MedicationDB, PharmacyDB, BestSellerResponse
+
+
+#Columns of the tabular (Arrow / Parquet) responses, in the BestSellerResponse model order
+BEST_SELLER_FIELDS = list(BestSellerResponse.model_fields)
+
+
+class AnalyticsRepository:
+    """
+    Repo for the order analytics.
+    """
+    def best_sellers(self, db: Session, top_n: int = 1, date_from: Optional[date] = None,
+                     date_to: Optional[date] = None) -> List[BestSellerResponse]:
+        """
+        Top N medications per pharmacy by ordered quantity.
+        """
+        return [BestSellerResponse(**dict(zip(BEST_SELLER_FIELDS, row)))
+                for row in self.best_seller_rows(db, top_n, date_from, date_to)]
+
+
+    def best_seller_rows(self, db: Session, top_n: int = 1, date_from: Optional[date] = None,
+                         date_to: Optional[date] = None) -> List[tuple]:
+        """
+        Top N medications per pharmacy by ordered quantity, in a single aggregation over the daily rollup, as row
+        tuples with the BEST_SELLER_FIELDS columns.
+        The pharmacy total is included, so the share of the best sellers can be computed.
+        The dates are inclusive, as in the order search.
+        """
+        sales = DailyMedicationSalesDB
+        quantity = func.sum(sales.quantity)
+
+        ranked = (
+            select(
+                sales.pharmacy_id.label("pharmacy_id"),
+                sales.medication_id.label("medication_id"),
+                quantity.label("quantity"),
+                func.row_number().over(partition_by=sales.pharmacy_id,
+                                       order_by=(quantity.desc(), sales.medication_id)).label("rank"),
+                func.sum(quantity).over(partition_by=sales.pharmacy_id).label("pharmacy_total_quantity")
+            )
+            .group_by(sales.pharmacy_id, sales.medication_id)
+        )
+        if date_from is not None:
+            ranked = ranked.where(sales.day >= date_from)
+        if date_to is not None:
+            ranked = ranked.where(sales.day <= date_to)
+        ranked = ranked.subquery()
+
+        return db.execute(
+            select(
+                ranked.c.pharmacy_id,
+                PharmacyDB.name.label("pharmacy_name"),
+                ranked.c.medication_id,
+                MedicationDB.name.label("medication_name"),
+                ranked.c.quantity,
+                ranked.c.rank,
+                ranked.c.pharmacy_total_quantity
+            )
+            .outerjoin(PharmacyDB, PharmacyDB.id == ranked.c.pharmacy_id)
+            .outerjoin(MedicationDB, MedicationDB.id == ranked.c.medication_id)
+            .where(ranked.c.rank <= top_n)
+            .order_by(ranked.c.pharmacy_id, ranked.c.rank)
+        ).all()
@@ -0,0 +1,80 @@
+"""
+Benchmark: JSON vs. Arrow IPC stream vs. Parquet for a medications table
+
+Measures the server side encoding and the client side decoding into a pandas DataFrame.
+To run the benchmark, in terminal: python benchmark_serialization.py --rows 100000
+"""
+import argparse
+import json
+import random
+import time
+import pandas as pd
+import pyarrow as pa
+from tabular import table_from_rows, tabular_response, ARROW_STREAM, PARQUET
+
+
+#Same columns as medications.MEDICATION_FIELDS (importing it would need a DB connection)
+MEDICATION_FIELDS = ["id", "name", "type", "quantity", "price", "pharma_id", "stock", "stock_level", "image"]
+
+
+def generate_rows(count):
+    """
+    Synthetic medication rows with the same columns as the medications table (without images).
+    """
+    random.seed(42)
+    levels = ["low", "medium", "high"]
+    return [
+        (i, f"Medication {i % 5000}", random.choice(["RX", "OTC"]), random.randint(0, 500),
+         round(random.uniform(0.5, 300), 2), random.randint(1, 300), random.randint(0, 1000),
+         random.choice(levels), None)
+        for i in range(1, count + 1)
+    ]
+
+
+def timed(function, repeat):
+    """
+    Best time of several runs, in milliseconds.
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serialization benchmark for the tabular endpoints.")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = generate_rows(args.rows)
+
+    #JSON: list of dicts on the server, DataFrame from the decoded list on the client
+    encode_ms, payload = timed(lambda: json.dumps([dict(zip(MEDICATION_FIELDS, row)) for row in rows]).encode(),
+                               args.repeat)
+    decode_ms, _ = timed(lambda: pd.DataFrame(json.loads(payload)), args.repeat)
+    results = [("JSON", encode_ms, decode_ms, len(payload))]
+
+    for media_type, label in ((ARROW_STREAM, "Arrow IPC"), (PARQUET, "Parquet")):
+        encode_ms, response = timed(
+            lambda: tabular_response(table_from_rows(MEDICATION_FIELDS, rows), media_type), args.repeat)
+        body = response.body
+
+        if media_type == ARROW_STREAM:
+            decode = lambda: pa.ipc.open_stream(body).read_all().to_pandas(split_blocks=True, self_destruct=True)
+        else:
+            decode = lambda: pd.read_parquet(pa.BufferReader(body))
+        decode_ms, _ = timed(decode, args.repeat)
+        results.append((label, encode_ms, decode_ms, len(body)))
+
+    print(f"{args.rows} rows (best of {args.repeat})")
+    print(f"{'Format':<12}{'Encode ms':>12}{'Decode ms':>12}{'Size KB':>12}")
+    for label, encode_ms, decode_ms, size in results:
+        print(f"{label:<12}{encode_ms:>12.1f}{decode_ms:>12.1f}{size / 1024:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
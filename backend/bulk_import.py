@@ -0,0 +1,257 @@
+"""
+Bulk import of medications and pharmacies from CSV or NDJSON files
+
+The rows are validated in chunks, and each valid chunk is upserted in its own transaction using the unique
+constraints: (name, pharma_id) for medications and (name, address) for pharmacies.
+PostgreSQL: COPY into a temporary table + INSERT ... SELECT ... ON CONFLICT DO UPDATE.
+Other DBs (SQLite): executemany INSERT ... ON CONFLICT DO UPDATE.
+Invalid rows are skipped and reported with their row number.
+The stock of the medications is not upserted: it is the central stock of a name, so after the upsert every row with
+an imported name is set to the stock of the file (last row of the name) through the shared stock UPDATE, with the
+stock level alerts, live stock events and "import" ledger rows. New rows start at 0 before that.
+"""
+from typing import Iterable, Iterator, List, Optional, Tuple, Type
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import case, func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from models import MedicationRequest, PharmacyRequest, MedicationDB, PharmacyDB, BulkImportResponse, BulkRowError
+from medication_index import medication_name_index
+from pharmacy_index import pharmacy_location_index
+from sync import row_version
+from stock_alerts import StockAlertRepository
+from lots import LotRepository
+from stock_ledger import IMPORT
+from table_versions import mark_changed
+import codecs
+import csv
+import io
+import json
+import logging
+
+
+CHUNK_SIZE = 5000
+IMPORT_FORMATS = ["csv", "ndjson"]
+
+#stock_level is generated by the DB, row_version is the delta sync version of the chunk transaction
+MEDICATION_COLUMNS = ["name", "type", "quantity", "price", "pharma_id", "stock", "row_version"]
+MEDICATION_KEYS = ["name", "pharma_id"]
+PHARMACY_COLUMNS = ["name", "address", "contact_phone", "email", "latitude", "longitude"]
+PHARMACY_KEYS = ["name", "address"]
+PHARMACY_KEEP = ["latitude", "longitude"]   #A file without a location keeps the stored one
+
+stock_alert_repo = StockAlertRepository()
+lot_repo = LotRepository()
+
+
+def detect_format(filename: str, file_format: str = None) -> str:
+    """
+    File format from the explicit format or from the file extension.
+    """
+    if file_format:
+        return file_format
+    if filename and filename.lower().endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    return "csv"
+
+
+def read_rows(binary_file, file_format: str) -> Iterator[Tuple[int, dict]]:
+    """
+    Parse the uploaded file lazily. Yield (row number, row) pairs; unparsable lines are yielded as errors.
+    """
+    text_file = codecs.getreader("utf-8-sig")(binary_file)
+
+    if file_format == "csv":
+        for number, row in enumerate(csv.DictReader(text_file), start=1):
+            #Empty cells are missing values
+            yield number, {key.strip(): value for key, value in row.items() if key and value not in (None, "")}
+        return
+
+    for number, line in enumerate(text_file, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield number, e
+
+
+def chunked(rows: Iterator, size: int) -> Iterator[list]:
+    """
+    Group the rows in lists of at most size rows.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def format_error(error: Exception) -> str:
+    """
+    Short message for the import report.
+    """
+    if isinstance(error, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+    return str(error)
+
+
+def validate_chunk(chunk: list, model: Type[BaseModel], columns: List[str],
+                   errors: List[BulkRowError]) -> List[Tuple[int, dict]]:
+    """
+    Validate the rows of a chunk with the request model, the errors are added to the report.
+    """
+    valid = []
+    for number, row in chunk:
+        if isinstance(row, Exception):
+            errors.append(BulkRowError(row=number, error=format_error(row)))
+            continue
+        try:
+            data = model(**row).model_dump()
+        except (ValidationError, TypeError) as e:
+            errors.append(BulkRowError(row=number, error=format_error(e)))
+            continue
+        valid.append((number, {column: data.get(column) for column in columns}))
+    return valid
+
+
+def unique_rows(rows: List[Tuple[int, dict]], keys: List[str]) -> List[Tuple[int, dict]]:
+    """
+    Keep the last row of every key, a single upsert statement cannot update the same row twice.
+    """
+    by_key = {tuple(data[key] for key in keys): (number, data) for number, data in rows}
+    return list(by_key.values())
+
+
+def upsert(db: Session, table, columns: List[str], keys: List[str], rows: List[dict],
+           updates: Optional[List[str]] = None, keep: Iterable[str] = ()):
+    """
+    Insert the rows, updating the updates columns (all but the keys by default) of the existing ones with the same key.
+    A missing (NULL) value of a keep column does not overwrite the stored one.
+    """
+    if updates is None:
+        updates = [column for column in columns if column not in keys]
+
+    if db.get_bind().dialect.name == "postgresql":
+        staging = f"{table.name}_import"
+        column_list = ", ".join(columns)
+        db.execute(text(f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                        f"SELECT {column_list} FROM {table.name} WITH NO DATA"))
+
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows([row[column] for column in columns] for row in rows)
+        buffer.seek(0)
+        cursor = db.connection().connection.cursor()
+        cursor.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+        db.execute(text(
+            f"INSERT INTO {table.name} ({column_list}) SELECT {column_list} FROM {staging} "
+            f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+            + ", ".join(f"{column} = COALESCE(EXCLUDED.{column}, {table.name}.{column})" if column in keep
+                        else f"{column} = EXCLUDED.{column}" for column in updates)
+        ))
+        mark_changed(db, [table.name])   #Raw SQL is not seen by the change counters
+        return
+
+    statement = sqlite_insert(table)
+    statement = statement.on_conflict_do_update(index_elements=keys, set_={
+        column: func.coalesce(statement.excluded[column], table.c[column]) if column in keep
+        else statement.excluded[column] for column in updates
+    })
+    db.execute(statement, rows)
+
+
+def import_rows(db: Session, rows: Iterator[Tuple[int, dict]], model: Type[BaseModel], table,
+                columns: List[str], keys: List[str], prepare=None, write=None) -> BulkImportResponse:
+    """
+    Validate and upsert the rows chunk by chunk, one transaction per chunk.
+    prepare(db, valid_rows, errors) can reject more rows of a chunk (e.g. unknown foreign keys).
+    write(db, rows) replaces the plain upsert of a chunk.
+    """
+    total = imported = 0
+    errors = []
+
+    for chunk in chunked(rows, CHUNK_SIZE):
+        total += len(chunk)
+        valid = validate_chunk(chunk, model, columns, errors)
+        if prepare is not None:
+            valid = prepare(db, valid, errors)
+        valid = unique_rows(valid, keys)
+        if not valid:
+            continue
+
+        try:
+            if write is not None:
+                write(db, [data for _, data in valid])
+            else:
+                upsert(db, table, columns, keys, [data for _, data in valid])
+            db.commit()
+            imported += len(valid)
+        except Exception as e:
+            db.rollback()
+            logging.error(f"Bulk import chunk failed: {e}")
+            errors.extend(BulkRowError(row=number, error=f"Chunk failed: {e}") for number, _ in valid)
+
+    errors.sort(key=lambda error: error.row)
+    return BulkImportResponse(total=total, imported=imported, failed=len(errors), errors=errors)
+
+
+def prepare_medications(db: Session, valid: List[Tuple[int, dict]], errors: List[BulkRowError]):
+    """
+    Check the pharmacies of the chunk with one query and set the row version.
+    """
+    pharmacy_ids = {data["pharma_id"] for _, data in valid}
+    existing = {pharmacy_id for (pharmacy_id,) in
+                db.query(PharmacyDB.id).filter(PharmacyDB.id.in_(pharmacy_ids))} if pharmacy_ids else set()
+
+    prepared = []
+    for number, data in valid:
+        if data["pharma_id"] not in existing:
+            errors.append(BulkRowError(row=number, error=f"pharma_id: pharmacy {data['pharma_id']} not found"))
+            continue
+        data["row_version"] = row_version(db)
+        prepared.append((number, data))
+    return prepared
+
+
+def write_medications(db: Session, rows: List[dict]):
+    """
+    Upsert the medication rows without their stock, then set the central stock of every imported name (the lots
+    over the new stock are written off).
+    """
+    stocks = {row["name"]: row["stock"] for row in rows}   #Per name, the last row wins
+    upsert(db, MedicationDB.__table__, MEDICATION_COLUMNS, MEDICATION_KEYS, [{**row, "stock": 0} for row in rows],
+           [column for column in MEDICATION_COLUMNS if column not in MEDICATION_KEYS and column != "stock"])
+    stock_alert_repo.set_stock(db, MedicationDB.name.in_(list(stocks)),
+                               case(stocks, value=MedicationDB.name, else_=MedicationDB.stock), IMPORT)
+    lot_repo.reconcile(db, stocks)
+
+
+def import_medications(db: Session, binary_file, file_format: str) -> BulkImportResponse:
+    """
+    Bulk import medications (the images are not imported).
+    """
+    report = import_rows(db, read_rows(binary_file, file_format), MedicationRequest, MedicationDB.__table__,
+                         MEDICATION_COLUMNS, MEDICATION_KEYS, prepare_medications, write_medications)
+    medication_name_index.invalidate()
+    return report
+
+
+def write_pharmacies(db: Session, rows: List[dict]):
+    """
+    Upsert the pharmacy rows, keeping the stored location of the rows without one.
+    """
+    upsert(db, PharmacyDB.__table__, PHARMACY_COLUMNS, PHARMACY_KEYS, rows, keep=PHARMACY_KEEP)
+
+
+def import_pharmacies(db: Session, binary_file, file_format: str) -> BulkImportResponse:
+    """
+    Bulk import pharmacies.
+    """
+    report = import_rows(db, read_rows(binary_file, file_format), PharmacyRequest, PharmacyDB.__table__,
+                         PHARMACY_COLUMNS, PHARMACY_KEYS, write=write_pharmacies)
+    pharmacy_location_index.invalidate()
+    return report
@@ -0,0 +1,89 @@
+"""
+Main page KPIs computed in the DB and cached for a short time
+"""
+from threading import Lock
+from sqlalchemy import func, case
+from sqlalchemy.orm import Session
+from models import (MedicationDB, PharmacyDB, DashboardSummaryResponse, PharmacyTotalsResponse,
+                    LowStockItemResponse, STOCK_LEVEL_LOW_MAX, STOCK_LEVEL_MEDIUM_MAX)
+import time
+
+
+SUMMARY_TTL = 30   #seconds
+
+
+class DashboardRepository:
+    """
+    Repo for the dashboard summary.
+    """
+    def __init__(self, ttl: float = SUMMARY_TTL):
+        self.ttl = ttl
+        self._cache = {}   #top_n -> (expires_at, summary)
+        self._lock = Lock()
+
+
+    def get_summary(self, db: Session, top_n: int = 10) -> DashboardSummaryResponse:
+        """
+        Return the cached summary, computing it again once it expired.
+        The cache is checked again under the lock: the requests that waited for a computation reuse its summary.
+        """
+        cached = self._cache.get(top_n)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        with self._lock:
+            cached = self._cache.get(top_n)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
+
+            summary = self.compute_summary(db, top_n)
+            self._cache[top_n] = (time.monotonic() + self.ttl, summary)
+        return summary
+
+
+    @staticmethod
+    def compute_summary(db: Session, top_n: int) -> DashboardSummaryResponse:
+        """
+        Counts per stock level, totals per pharmacy and the medications with the lowest stock.
+        """
+        stock_levels = {level: 0 for level in ["low", "medium", "high"]}
+        for level, count in (db.query(MedicationDB.stock_level, func.count(MedicationDB.id))
+                             .group_by(MedicationDB.stock_level)):
+            if level is not None:
+                stock_levels[level] = count
+
+        pharmacies = [
+            PharmacyTotalsResponse(pharmacy_id=pharmacy_id, pharmacy_name=pharmacy_name, medications=medications,
+                                   quantity=quantity or 0, low_stock=low_stock or 0)
+            for pharmacy_id, pharmacy_name, medications, quantity, low_stock in (
+                db.query(
+                    MedicationDB.pharma_id,
+                    PharmacyDB.name,
+                    func.count(MedicationDB.id),
+                    func.sum(MedicationDB.quantity),
+                    func.sum(case((MedicationDB.stock_level == "low", 1), else_=0))
+                )
+                .outerjoin(PharmacyDB, MedicationDB.pharma_id == PharmacyDB.id)
+                .group_by(MedicationDB.pharma_id, PharmacyDB.name)
+                .order_by(MedicationDB.pharma_id)
+            )
+        ]
+
+        #The central stock is the same for all the rows with the same name
+        stock = func.max(MedicationDB.stock)
+        lowest_stock = [
+            LowStockItemResponse(name=name, stock=stock_value or 0, stock_level=stock_level)
+            for name, stock_value, stock_level in (
+                db.query(MedicationDB.name, stock, func.max(MedicationDB.stock_level))
+                .group_by(MedicationDB.name)
+                .order_by(stock.asc(), MedicationDB.name)
+                .limit(top_n)
+            )
+        ]
+
+        return DashboardSummaryResponse(
+            stock_levels=stock_levels,
+            stock_level_thresholds={"low": STOCK_LEVEL_LOW_MAX, "medium": STOCK_LEVEL_MEDIUM_MAX},
+            pharmacies=pharmacies,
+            lowest_stock=lowest_stock
+        )
@@ -0,0 +1,104 @@
+"""
+Streaming exports of the orders and medications (NDJSON or CSV)
+
+The rows are read with a server-side cursor in batches (yield_per) and sent as soon as they are encoded, so the memory
+use does not depend on the table size. The generators open their own DB session because the response is streamed
+after the endpoint returns.
+"""
+from datetime import datetime, date
+from enum import Enum
+from typing import Iterator, List
+from sqlalchemy import select
+from database import SessionLocal
+from models import MedicationDB, OrderDB, OrderItemDB
+import csv
+import io
+import json
+
+
+BATCH_SIZE = 1000
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+ORDER_COLUMNS = ["id", "pharmacy_id", "order_date", "status", "total_amount"]
+ORDER_ITEM_COLUMNS = ["medication_id", "quantity", "price"]
+
+
+def to_json_value(value):
+    """
+    JSON compatible value for dates and enums.
+    """
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def csv_line(values) -> str:
+    """
+    Encode one CSV line.
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow([to_json_value(value) for value in values])
+    return buffer.getvalue()
+
+
+def stream_rows(statement) -> Iterator[tuple]:
+    """
+    Iterate the result rows with a server-side cursor, BATCH_SIZE rows at a time.
+    """
+    db = SessionLocal()
+    try:
+        for row in db.execute(statement.execution_options(yield_per=BATCH_SIZE)):
+            yield tuple(row)
+    finally:
+        db.close()
+
+
+def export_medications(export_format: str, fields: List[str]) -> Iterator[str]:
+    """
+    Medications with the requested columns, one line per medication.
+    """
+    statement = select(*[getattr(MedicationDB, field) for field in fields]).order_by(MedicationDB.id)
+
+    if export_format == "csv":
+        yield csv_line(fields)
+        for row in stream_rows(statement):
+            yield csv_line(row)
+    else:
+        for row in stream_rows(statement):
+            yield json.dumps(dict(zip(fields, map(to_json_value, row)))) + "\n"
+
+
+def export_orders(export_format: str) -> Iterator[str]:
+    """
+    NDJSON: one line per order with its items. CSV: one line per order item (the order columns are repeated).
+    """
+    statement = (
+        select(*[getattr(OrderDB, column) for column in ORDER_COLUMNS],
+               *[getattr(OrderItemDB, column) for column in ORDER_ITEM_COLUMNS])
+        .outerjoin(OrderItemDB, OrderItemDB.order_id == OrderDB.id)
+        .order_by(OrderDB.id, OrderItemDB.id)
+    )
+    order_size = len(ORDER_COLUMNS)
+
+    if export_format == "csv":
+        yield csv_line(ORDER_COLUMNS + ORDER_ITEM_COLUMNS)
+        for row in stream_rows(statement):
+            yield csv_line(row)
+        return
+
+    #The rows are sorted by order, an order is complete when the next one starts
+    current = None
+    for row in stream_rows(statement):
+        order, item = row[:order_size], row[order_size:]
+        if current is None or current["id"] != order[0]:
+            if current is not None:
+                yield json.dumps(current) + "\n"
+            current = dict(zip(ORDER_COLUMNS, map(to_json_value, order)))
+            current["order_items"] = []
+        if item[0] is not None:
+            current["order_items"].append(dict(zip(ORDER_ITEM_COLUMNS, item)))
+
+    if current is not None:
+        yield json.dumps(current) + "\n"
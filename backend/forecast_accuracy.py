@@ -0,0 +1,161 @@
+"""
+Forecast accuracy monitoring
+
+Every forecast opens a 30 days window with the predicted demand for a medication. The real demand is added to the
+window as orders arrive, and when the window ends its error is folded into running aggregates (MAE, bias), so the
+accuracy never requires rescanning the order history.
+A medication drifts when its recent error (exponentially weighted) becomes much larger than its long-run MAE; only
+these medications are retrained.
+The ended windows are closed by the writers: a new forecast, the retraining and the nightly reorder planner run.
+GET /forecast-accuracy only reads. To close them without a planner run, in terminal: python forecast_accuracy.py
+"""
+from datetime import datetime, timedelta
+from typing import List
+from sqlalchemy.orm import Session
+from models import ForecastAccuracyDB, ForecastAccuracyResponse
+from stock_forecast import predict_optimal_stock
+import logging
+
+
+FORECAST_WINDOW_DAYS = 30
+RECENT_ERROR_WEIGHT = 0.3   #Weight of the last closed window in the recent error
+DRIFT_RATIO = 1.5           #Recent error / MAE ratio that flags a drift
+MIN_PERIODS = 3             #Closed windows needed before a drift can be flagged
+
+
+class ForecastAccuracyRepository:
+    """
+    Repo for managing the forecast accuracy data from DB.
+    """
+    def record_forecast(self, db: Session, medication_name: str, predicted_demand: float,
+                        replace: bool = False, commit: bool = True):
+        """
+        Open a new forecast window for a medication.
+        A running window is kept unless replace=True; an ended window is closed before opening the new one.
+        """
+        now = datetime.utcnow()
+        db_accuracy = db.query(ForecastAccuracyDB).filter(ForecastAccuracyDB.medication_name == medication_name).first()
+
+        if db_accuracy is None:
+            db_accuracy = ForecastAccuracyDB(medication_name=medication_name, periods=0, abs_error_sum=0,
+                                             error_sum=0, recent_abs_error=0, drift=False)
+            db.add(db_accuracy)
+        elif db_accuracy.window_end <= now:
+            self.close_window(db_accuracy)
+        elif not replace:
+            return db_accuracy
+
+        db_accuracy.predicted_demand = float(predicted_demand)
+        db_accuracy.actual_demand = 0
+        db_accuracy.window_start = now
+        db_accuracy.window_end = now + timedelta(days=FORECAST_WINDOW_DAYS)
+
+        if commit:
+            db.commit()
+        return db_accuracy
+
+
+    def record_demand(self, db: Session, medication_name: str, quantity: int):
+        """
+        Add ordered quantity to the running window of a medication.
+        Runs inside the order transaction, the caller commits.
+        """
+        now = datetime.utcnow()
+        db.query(ForecastAccuracyDB).filter(
+            ForecastAccuracyDB.medication_name == medication_name,
+            ForecastAccuracyDB.window_start <= now,
+            ForecastAccuracyDB.window_end > now
+        ).update({"actual_demand": ForecastAccuracyDB.actual_demand + quantity}, synchronize_session=False)
+
+
+    @staticmethod
+    def close_window(db_accuracy: ForecastAccuracyDB):
+        """
+        Fold the error of an ended window into the aggregates and update the drift flag.
+        The window is left empty until the next forecast, so it is never counted twice.
+        """
+        if db_accuracy.window_start >= db_accuracy.window_end:
+            return
+
+        error = db_accuracy.actual_demand - db_accuracy.predicted_demand
+
+        db_accuracy.periods += 1
+        db_accuracy.abs_error_sum += abs(error)
+        db_accuracy.error_sum += error
+
+        if db_accuracy.periods == 1:
+            db_accuracy.recent_abs_error = abs(error)
+        else:
+            db_accuracy.recent_abs_error = (RECENT_ERROR_WEIGHT * abs(error) +
+                                            (1 - RECENT_ERROR_WEIGHT) * db_accuracy.recent_abs_error)
+
+        db_accuracy.drift = (db_accuracy.periods >= MIN_PERIODS and
+                             db_accuracy.recent_abs_error > DRIFT_RATIO * db_accuracy.mae)
+        db_accuracy.window_start = db_accuracy.window_end
+
+
+    def close_ended_windows(self, db: Session, commit: bool = True) -> int:
+        """
+        Close the windows that ended without a new forecast.
+        Return the number of closed windows.
+        """
+        ended = db.query(ForecastAccuracyDB).filter(
+            ForecastAccuracyDB.window_end <= datetime.utcnow(),
+            ForecastAccuracyDB.window_end > ForecastAccuracyDB.window_start
+        ).all()
+
+        for db_accuracy in ended:
+            self.close_window(db_accuracy)
+
+        if ended and commit:
+            db.commit()
+        return len(ended)
+
+
+    def get_all(self, db: Session, drift_only: bool = False) -> List[ForecastAccuracyResponse]:
+        """
+        Retrieve the forecast accuracy of all medications (read only, the ended windows are closed by the writers).
+        """
+        query = db.query(ForecastAccuracyDB)
+        if drift_only:
+            query = query.filter(ForecastAccuracyDB.drift.is_(True))
+        return [ForecastAccuracyResponse.model_validate(accuracy)
+                for accuracy in query.order_by(ForecastAccuracyDB.medication_name).all()]
+
+
+    def retrain_drifted(self, db: Session, csv_path: str) -> List[str]:
+        """
+        Run a new forecast for the medications with drift and open new windows for them.
+        Return the retrained medication names.
+        """
+        self.close_ended_windows(db)
+        drifted = db.query(ForecastAccuracyDB).filter(ForecastAccuracyDB.drift.is_(True)).all()
+
+        retrained = []
+        for db_accuracy in drifted:
+            forecast = predict_optimal_stock(db, db_accuracy.medication_name, csv_path)
+            if "error" in forecast:
+                logging.warning(f"Retraining skipped for {db_accuracy.medication_name}: {forecast['error']}")
+                continue
+
+            self.record_forecast(db, db_accuracy.medication_name, forecast["predicted_monthly_demand"],
+                                 replace=True, commit=False)
+            #Start the recent error again from the long-run error
+            db_accuracy.recent_abs_error = db_accuracy.mae
+            db_accuracy.drift = False
+            retrained.append(db_accuracy.medication_name)
+
+        db.commit()
+        return retrained
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, engine
+    import models
+
+    models.Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        print(f"{ForecastAccuracyRepository().close_ended_windows(session)} forecast windows closed.")
+    finally:
+        session.close()
@@ -0,0 +1,183 @@
+"""
+Medication lots with expiry dates and FEFO (first expiry, first out) allocation
+
+The central stock of a medication (shared by all the rows with the same name) is split in lots. Receiving a lot adds
+its quantity to the central stock. When an order takes stock, the quantity is allocated from the unexpired lots of the
+medication in expiry order, read and locked with one ordered query on (medication_name, expiry_date); the allocations
+are kept per order, so a smaller order update gives back the latest expiring units first.
+Stock older than the lots (not received as a lot) is unlotted: an order takes the unexpired lots first, then the
+unlotted units, and the expired units are never sold (sellable stock = central stock - expired lot quantities).
+A stock adjustment or import below the lot quantities writes the lots off, first expiry first.
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from models import MedicationDB, LotDB, LotAllocationDB, LotRequest, LotResponse, ExpiringLotResponse
+from stock_alerts import StockAlertRepository
+from stock_ledger import RECEIVED
+import re
+
+
+WITHIN_PATTERN = re.compile(r"^\s*(\d+)\s*([dw]?)\s*$")
+
+
+def parse_within(within: str) -> int:
+    """
+    Days of a report window: "30d", "2w" or a number of days.
+    """
+    match = WITHIN_PATTERN.match(within or "")
+    if not match:
+        raise ValueError(f"Invalid window '{within}', expected e.g. 30d or 2w.")
+    days = int(match.group(1))
+    return days * 7 if match.group(2) == "w" else days
+
+
+class LotRepository:
+    """
+    Repo for the medication lots.
+    """
+    stock_alert_repo = StockAlertRepository()
+
+    def add(self, db: Session, lot_request: LotRequest) -> LotResponse:
+        """
+        Receive a lot: store it and add its quantity to the central stock of the medication.
+        """
+        if not db.query(MedicationDB.id).filter(MedicationDB.name == lot_request.medication_name).first():
+            raise ValueError(f"Medication {lot_request.medication_name} not found.")
+        if db.query(LotDB.id).filter(LotDB.medication_name == lot_request.medication_name,
+                                     LotDB.lot_number == lot_request.lot_number).first():
+            raise ValueError(f"Lot {lot_request.lot_number} already exists.")
+
+        db_lot = LotDB(**lot_request.model_dump())
+        db.add(db_lot)
+        self.stock_alert_repo.change_stock(db, MedicationDB.name == lot_request.medication_name,
+                                           lot_request.quantity, RECEIVED)
+        db.commit()
+        db.refresh(db_lot)
+        return LotResponse.model_validate(db_lot)
+
+
+    @staticmethod
+    def allocate(db: Session, items: Iterable[Tuple[int, str, int]]):
+        """
+        Allocate the (order id, medication name, quantity) items from the unexpired lots, first expiry first; the rest
+        is unlotted stock (the caller checks the sellable stock first).
+        The lots of all the medications are read and locked with one ordered query (the caller commits).
+        """
+        items = [(order_id, name, quantity) for order_id, name, quantity in items if quantity > 0]
+        if not items:
+            return
+
+        lots_by_name = defaultdict(list)
+        for lot in (db.query(LotDB)
+                    .filter(LotDB.medication_name.in_({name for _, name, _ in items}),
+                            LotDB.expiry_date >= date.today(), LotDB.quantity > 0)
+                    .order_by(LotDB.medication_name, LotDB.expiry_date, LotDB.id)
+                    .with_for_update()):
+            lots_by_name[lot.medication_name].append(lot)
+
+        allocations = []
+        for order_id, name, quantity in items:
+            lots = lots_by_name[name]
+            while quantity > 0 and lots:
+                lot = lots[0]
+                taken = min(lot.quantity, quantity)
+                lot.quantity -= taken
+                quantity -= taken
+                allocations.append(LotAllocationDB(order_id=order_id, lot_id=lot.id, quantity=taken))
+                if lot.quantity == 0:
+                    lots.pop(0)
+        db.add_all(allocations)
+
+
+    @staticmethod
+    def expired(db: Session, names: Iterable[str]) -> Dict[str, int]:
+        """
+        Quantity left in the expired lots per medication name (not sellable).
+        """
+        return dict(db.query(LotDB.medication_name, func.sum(LotDB.quantity))
+                    .filter(LotDB.medication_name.in_(set(names)), LotDB.expiry_date < date.today(),
+                            LotDB.quantity > 0)
+                    .group_by(LotDB.medication_name)
+                    .all())
+
+
+    @staticmethod
+    def sellable(db: Session, stocks: Dict[str, int]) -> Dict[str, int]:
+        """
+        Sellable stock per medication name: the central stock without the expired lots.
+        """
+        expired = LotRepository.expired(db, stocks)
+        return {name: stock - expired.get(name, 0) for name, stock in stocks.items()}
+
+
+    @staticmethod
+    def reconcile(db: Session, names: Iterable[str]):
+        """
+        Keep the lots within the central stock after it was set (adjustment, import): the units over the stock are
+        written off the lots, first expiry first (expired lots included). A higher stock is left unlotted.
+        One ordered query for the lots of all the medications (the caller commits).
+        """
+        names = set(names)
+        if not names:
+            return
+        stocks = dict(db.query(MedicationDB.name, func.max(MedicationDB.stock))
+                      .filter(MedicationDB.name.in_(names))
+                      .group_by(MedicationDB.name)
+                      .all())
+
+        lots_by_name = defaultdict(list)
+        for lot in (db.query(LotDB)
+                    .filter(LotDB.medication_name.in_(names), LotDB.quantity > 0)
+                    .order_by(LotDB.medication_name, LotDB.expiry_date, LotDB.id)
+                    .with_for_update()):
+            lots_by_name[lot.medication_name].append(lot)
+
+        for name, lots in lots_by_name.items():
+            excess = sum(lot.quantity for lot in lots) - max(stocks.get(name) or 0, 0)
+            for lot in lots:
+                if excess <= 0:
+                    break
+                written_off = min(lot.quantity, excess)
+                lot.quantity -= written_off
+                excess -= written_off
+
+
+    @staticmethod
+    def release(db: Session, order_id: int, medication_name: str, quantity: int):
+        """
+        Give back quantity units of an order to its lots, latest expiry first (the caller commits).
+        """
+        allocations = (db.query(LotAllocationDB, LotDB)
+                       .join(LotDB, LotDB.id == LotAllocationDB.lot_id)
+                       .filter(LotAllocationDB.order_id == order_id, LotDB.medication_name == medication_name)
+                       .order_by(LotDB.expiry_date.desc(), LotDB.id.desc())
+                       .with_for_update()
+                       .all())
+        for allocation, lot in allocations:
+            if quantity <= 0:
+                break
+            returned = min(allocation.quantity, quantity)
+            lot.quantity += returned
+            allocation.quantity -= returned
+            quantity -= returned
+            if allocation.quantity == 0:
+                db.delete(allocation)
+
+
+    @staticmethod
+    def expiring(db: Session, within_days: int, medication_name: Optional[str] = None) -> List[ExpiringLotResponse]:
+        """
+        Lots with stock left that expire within the window (already expired included), soonest first.
+        """
+        today = date.today()
+        query = db.query(LotDB).filter(LotDB.expiry_date <= today + timedelta(days=within_days), LotDB.quantity > 0)
+        if medication_name:
+            query = query.filter(LotDB.medication_name == medication_name)
+        return [
+            ExpiringLotResponse(**LotResponse.model_validate(lot).model_dump(),
+                                days_to_expiry=(lot.expiry_date - today).days)
+            for lot in query.order_by(LotDB.expiry_date, LotDB.id)
+        ]
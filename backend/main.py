@@ -3,18 +3,43 @@ FASTAPI: Pharma Stock API
 To run the app, in terminal: uvicorn main:app --reload
 """
 import pandas as pd
-from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Form
+from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Form, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import List, Optional
+from datetime import date, datetime, timedelta
 from sqlalchemy.orm import Session
 from database import SessionLocal, engine
 import models
 from models import (MedicationRequest, MedicationResponse, MedicationDB, MedicationWithPharmacyResponse,
                     PharmacyRequest, PharmacyResponse, Pharmacy, PharmacyDB,
-                    OrderRequest, OrderResponse)
-from medications import MedicationRepository
-from pharmacies import PharmacyRepository
-from orders import OrderRepository
+                    OrderRequest, OrderResponse, OrderStatus, ReorderProposalResponse, ReorderRunResponse,
+                    ProposalStatus, ForecastAccuracyResponse, BestSellerResponse,
+                    SalesBucketResponse, DashboardSummaryResponse, BulkImportResponse, BulkOrderRequest,
+                    BulkOrderResponse, OrderStatusBulkRequest, OrderStatusBulkResponse, StockAlertResponse,
+                    SyncResponse, StockAtResponse, StockHistoryResponse, RebalanceResponse,
+                    NearestPharmacyResponse, LotRequest, LotResponse, ExpiringLotResponse)
+from medications import MedicationRepository, MEDICATION_FIELDS
+from pharmacies import PharmacyRepository, PHARMACY_TABLE_FIELDS
+from orders import OrderRepository, ORDER_TABLE_FIELDS
 from stock_forecast import predict_optimal_stock
+from reorder_planner import (ReorderProposalRepository, run_reorder_planner, DEFAULT_TIME_BUDGET,
+                             DEFAULT_WORKERS, MAX_TIME_BUDGET, MAX_WORKERS)
+from forecast_accuracy import ForecastAccuracyRepository
+from medication_index import medication_name_index
+from analytics import AnalyticsRepository, BEST_SELLER_FIELDS
+from sales_rollup import SalesRollupRepository, SALES_FIELDS
+from dashboard import DashboardRepository
+from stock_alerts import StockAlertRepository
+from stock_events import event_stream, start_notify_listener
+from sync import SyncRepository
+from table_versions import TableVersionRepository, not_modified, with_etag
+from stock_ledger import StockLedgerRepository, naive_utc
+from stock_history import StockHistoryRepository
+from lots import LotRepository, parse_within
+from rebalancing import plan_transfers, DEFAULT_WINDOW_DAYS, DEFAULT_COVER_DAYS
+from tabular import requested_format, table_from_rows, tabular_response
+from exports import export_medications, export_orders, EXPORT_FORMATS
+from bulk_import import import_medications, import_pharmacies, detect_format, IMPORT_FORMATS
 import base64
 
 
@@ -29,6 +54,17 @@ CSV_PATH = "medication_orders_data.csv"   #Dataset path
 medication_repo = MedicationRepository()
 pharmacy_repo = PharmacyRepository()
 order_repo = OrderRepository()
+reorder_proposal_repo = ReorderProposalRepository()
+forecast_accuracy_repo = ForecastAccuracyRepository()
+analytics_repo = AnalyticsRepository()
+sales_rollup_repo = SalesRollupRepository()
+dashboard_repo = DashboardRepository()
+stock_alert_repo = StockAlertRepository()
+sync_repo = SyncRepository()
+table_version_repo = TableVersionRepository()
+stock_ledger_repo = StockLedgerRepository()
+stock_history_repo = StockHistoryRepository()
+lot_repo = LotRepository()
 
 
 #DB session
@@ -42,13 +78,92 @@ def get_db():
 
 #Medication endpoints
 @app.get("/medications", response_model=List[MedicationResponse])
-async def get_medications(db: Session = Depends(get_db)):
-    medications = medication_repo.get_all(db)
-    if not medications:
+async def get_medications(
+    request: Request,
+    response: Response,
+    q: Optional[str] = None,
+    stock_level: Optional[str] = None,
+    type: Optional[str] = None,
+    pharma_id: Optional[int] = None,
+    sort: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    etag = table_version_repo.etag(db, request, ["medications"])
+    if cached := not_modified(request, etag):
+        return cached
+    response.headers["ETag"] = etag
+
+    filtered = any(value is not None for value in (q, stock_level, type, pharma_id))
+
+    #Arrow / Parquet: the table is built from the row tuples, without ORM objects
+    media_type = requested_format(request)
+    if media_type:
+        rows = medication_repo.search_rows(db, MEDICATION_FIELDS, q, stock_level, type, pharma_id, sort)
+        if not rows and not filtered:
+            raise HTTPException(status_code=404, detail="No medications found.")
+        return with_etag(tabular_response(table_from_rows(MEDICATION_FIELDS, rows), media_type), etag)
+
+    if filtered or sort:
+        medications = medication_repo.search(db, q, stock_level, type, pharma_id, sort)
+    else:
+        medications = medication_repo.get_all(db)
+
+    #An empty search result is a valid answer
+    if not medications and not filtered:
         raise HTTPException(status_code=404, detail="No medications found.")
     return medications
 
 
+@app.get("/medications/suggest", response_model=List[str])
+def suggest_medication_names(prefix: str, limit: int = 10, db: Session = Depends(get_db)):
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="Invalid limit.")
+    return medication_name_index.suggest(db, prefix, limit)
+
+
+@app.get("/medications/export")
+def export_medications_data(format: str = "ndjson", fields: Optional[str] = None):
+    validate_export_format(format)
+    fields = medication_repo.parse_fields(fields)
+    return StreamingResponse(export_medications(format, fields), media_type=EXPORT_FORMATS[format],
+                             headers={"Content-Disposition": f"attachment; filename=medications.{format}"})
+
+
+def validate_export_format(export_format: str):
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400,
+                            detail=f"Invalid format {export_format}. See allowed formats: {list(EXPORT_FORMATS)}.")
+
+
+@app.get("/medications/{medication_id}/stock-at", response_model=StockAtResponse)
+def get_medication_stock_at(medication_id: int, at: Optional[datetime] = None, db: Session = Depends(get_db)):
+    if not stock_ledger_repo.has_history(db, medication_id):
+        raise HTTPException(status_code=404, detail="Medication not found.")
+    return stock_ledger_repo.stock_at(db, medication_id, naive_utc(at) if at else datetime.utcnow())
+
+
+@app.get("/medications/{medication_id}/stock-history", response_model=StockHistoryResponse)
+def get_medication_stock_history(medication_id: int,
+                                 date_from: Optional[datetime] = Query(None, alias="from"),
+                                 date_to: Optional[datetime] = Query(None, alias="to"),
+                                 points: int = Query(500, ge=3, le=5000),
+                                 db: Session = Depends(get_db)):
+    date_to = naive_utc(date_to) if date_to else datetime.utcnow()
+    date_from = naive_utc(date_from) if date_from else date_to - timedelta(days=90)
+    if date_from >= date_to:
+        raise HTTPException(status_code=400, detail="from must be before to.")
+    if not stock_ledger_repo.has_history(db, medication_id):
+        raise HTTPException(status_code=404, detail="Medication not found.")
+    return stock_history_repo.history(db, medication_id, date_from, date_to, points)
+
+
+@app.get("/medications/{name}/nearest", response_model=List[NearestPharmacyResponse])
+def get_nearest_pharmacies_with_medication(name: str, lat: float = Query(ge=-90, le=90),
+                                           lon: float = Query(ge=-180, le=180), k: int = Query(5, ge=1, le=100),
+                                           db: Session = Depends(get_db)):
+    return pharmacy_repo.nearest_with_medication(db, name, lat, lon, k)
+
+
 @app.get("/medications/{medication_id}", response_model=MedicationResponse)
 async def get_medication(medication_id: int, db: Session = Depends(get_db)):
     medication = medication_repo.get_by_id(db, medication_id)
@@ -88,6 +203,21 @@ async def create_medication(
     return medication_repo.add(db, request)
 
 
+@app.post("/medications/bulk", response_model=BulkImportResponse)
+def bulk_import_medications(file: UploadFile = File(...), format: Optional[str] = None,
+                            db: Session = Depends(get_db)):
+    file_format = validate_import_format(file, format)
+    return import_medications(db, file.file, file_format)
+
+
+def validate_import_format(file: UploadFile, file_format: Optional[str]) -> str:
+    file_format = detect_format(file.filename, file_format)
+    if file_format not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400,
+                            detail=f"Invalid format {file_format}. See allowed formats: {IMPORT_FORMATS}.")
+    return file_format
+
+
 def validate_image(image: UploadFile):
     if image.content_type not in ["image/jpeg", "image/jpg", "image/png"]:
         raise HTTPException(status_code=400, detail="Invalid file type. Only JPG, JPEG, and PNG are allowed.")
@@ -160,8 +290,25 @@ async def create_pharmacy(request: PharmacyRequest, db: Session = Depends(get_db
     return pharmacy_repo.add(db, request)
 
 
+@app.post("/pharmacies/bulk", response_model=BulkImportResponse)
+def bulk_import_pharmacies(file: UploadFile = File(...), format: Optional[str] = None,
+                           db: Session = Depends(get_db)):
+    file_format = validate_import_format(file, format)
+    return import_pharmacies(db, file.file, file_format)
+
+
 @app.get("/pharmacies", response_model=List[Pharmacy])
-async def get_pharmacies(db: Session = Depends(get_db)):
+async def get_pharmacies(request: Request, response: Response, db: Session = Depends(get_db)):
+    etag = table_version_repo.etag(db, request, ["pharmacies"])
+    if cached := not_modified(request, etag):
+        return cached
+    response.headers["ETag"] = etag
+
+    #Arrow / Parquet: the table is built from the row tuples, without ORM objects
+    media_type = requested_format(request)
+    if media_type:
+        rows = pharmacy_repo.get_rows(db)
+        return with_etag(tabular_response(table_from_rows(PHARMACY_TABLE_FIELDS, rows), media_type), etag)
     return pharmacy_repo.get_all(db)
 
 
@@ -199,9 +346,40 @@ async def create_order(request: OrderRequest, db: Session = Depends(get_db)):
     return order_repo.add(db, request)
 
 
+@app.post("/orders/bulk", response_model=BulkOrderResponse)
+async def create_orders_bulk(request: BulkOrderRequest, chunk_size: Optional[int] = Query(None, ge=1),
+                             db: Session = Depends(get_db)):
+    return order_repo.add_bulk(db, request.orders, chunk_size)
+
+
 @app.get("/orders", response_model=List[OrderResponse])
-async def get_orders(db: Session = Depends(get_db)):
-    return order_repo.get_all(db)
+async def get_orders(request: Request, response: Response, pharmacy_id: Optional[int] = None,
+                     status: Optional[OrderStatus] = None,
+                     date_from: Optional[date] = Query(None, alias="from"),
+                     date_to: Optional[date] = Query(None, alias="to"),
+                     medication_id: Optional[int] = None, db: Session = Depends(get_db)):
+    etag = table_version_repo.etag(db, request, ["orders", "medications"])   #Item prices read from medications
+    if cached := not_modified(request, etag):
+        return cached
+    response.headers["ETag"] = etag
+
+    media_type = requested_format(request)
+    if media_type:
+        rows = order_repo.get_rows(db, pharmacy_id, status, date_from, date_to, medication_id)
+        return with_etag(tabular_response(table_from_rows(ORDER_TABLE_FIELDS, rows), media_type), etag)
+    return order_repo.get_all(db, pharmacy_id, status, date_from, date_to, medication_id)
+
+
+@app.get("/orders/export")
+def export_orders_data(format: str = "ndjson"):
+    validate_export_format(format)
+    return StreamingResponse(export_orders(format), media_type=EXPORT_FORMATS[format],
+                             headers={"Content-Disposition": f"attachment; filename=orders.{format}"})
+
+
+@app.put("/orders/status", response_model=OrderStatusBulkResponse)
+async def update_orders_status(request: OrderStatusBulkRequest, db: Session = Depends(get_db)):
+    return order_repo.update_status_bulk(db, request)
 
 
 @app.get("/orders/{order_id}", response_model=OrderResponse)
@@ -246,7 +424,22 @@ async def delete_order(order_id: int, db: Session = Depends(get_db)):
 
 #Join medications and pharma data
 @app.get("/medications_with_pharmacies", response_model=List[MedicationWithPharmacyResponse])
-def read_medications_with_pharmacies(db: Session = Depends(get_db)):
+def read_medications_with_pharmacies(request: Request, response: Response, fields: Optional[str] = None,
+                                     shape: str = "nested", db: Session = Depends(get_db)):
+    if shape not in ("nested", "normalized"):
+        raise HTTPException(status_code=400, detail="Invalid shape. See allowed shapes: nested, normalized.")
+
+    etag = table_version_repo.etag(db, request, ["medications", "pharmacies"])
+    if cached := not_modified(request, etag):
+        return cached
+    response.headers["ETag"] = etag
+
+    #Projection: only the requested columns are selected and serialized
+    if fields or shape == "normalized":
+        projection = medication_repo.get_medications_with_pharmacy_projection(
+            db, medication_repo.parse_fields(fields), normalized=shape == "normalized")
+        return with_etag(JSONResponse(content=projection), etag)
+
     #Join for getting medications and pharmacies data
     medications_with_pharmacies = (
         db.query(MedicationDB, PharmacyDB)
@@ -270,7 +463,165 @@ def get_stock_forecast(medication_name: str, db: Session = Depends(get_db)):
         forecast = predict_optimal_stock(db, medication_name, CSV_PATH)
         if "error" in forecast:
             raise HTTPException(status_code=404, detail=forecast["error"])
+        forecast_accuracy_repo.record_forecast(db, forecast["medication_name"], forecast["predicted_monthly_demand"])
         return forecast
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+#Forecast accuracy
+@app.get("/forecast-accuracy", response_model=List[ForecastAccuracyResponse])
+def get_forecast_accuracy(drift_only: bool = False, db: Session = Depends(get_db)):
+    return forecast_accuracy_repo.get_all(db, drift_only)
+
+
+@app.post("/forecast-accuracy/retrain", response_model=List[str])
+def retrain_drifted_forecasts(db: Session = Depends(get_db)):
+    return forecast_accuracy_repo.retrain_drifted(db, CSV_PATH)
+
+
+#Reorder planner
+@app.post("/reorder-proposals/run", response_model=ReorderRunResponse)
+def run_reorder_proposals(time_budget: float = Query(DEFAULT_TIME_BUDGET, gt=0, le=MAX_TIME_BUDGET),
+                          max_workers: int = Query(DEFAULT_WORKERS, ge=1, le=MAX_WORKERS),
+                          db: Session = Depends(get_db)):
+    try:
+        return run_reorder_planner(db, CSV_PATH, time_budget, max_workers)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+@app.get("/reorder-proposals", response_model=List[ReorderProposalResponse])
+def get_reorder_proposals(status: Optional[ProposalStatus] = None, db: Session = Depends(get_db)):
+    return reorder_proposal_repo.get_all(db, status)
+
+
+@app.put("/reorder-proposals/{proposal_id}/approve", response_model=ReorderProposalResponse)
+def approve_reorder_proposal(proposal_id: int, db: Session = Depends(get_db)):
+    return set_reorder_proposal_status(db, proposal_id, ProposalStatus.approved)
+
+
+@app.put("/reorder-proposals/{proposal_id}/reject", response_model=ReorderProposalResponse)
+def reject_reorder_proposal(proposal_id: int, db: Session = Depends(get_db)):
+    return set_reorder_proposal_status(db, proposal_id, ProposalStatus.rejected)
+
+
+def set_reorder_proposal_status(db: Session, proposal_id: int, new_status: ProposalStatus):
+    try:
+        proposal = reorder_proposal_repo.set_status(db, proposal_id, new_status)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if proposal is None:
+        raise HTTPException(status_code=404, detail="Reorder proposal not found.")
+    return proposal
+
+
+#Stock rebalancing between the pharmacies
+@app.get("/rebalancing/transfers", response_model=RebalanceResponse)
+def get_rebalancing_transfers(window_days: int = Query(DEFAULT_WINDOW_DAYS, ge=1),
+                              cover_days: int = Query(DEFAULT_COVER_DAYS, ge=1),
+                              min_quantity: int = Query(1, ge=1),
+                              db: Session = Depends(get_db)):
+    return plan_transfers(db, window_days, cover_days, min_quantity)
+
+
+#Medication lots (FEFO allocation by the orders)
+@app.post("/lots", response_model=LotResponse)
+def receive_lot(request: LotRequest, db: Session = Depends(get_db)):
+    try:
+        return lot_repo.add(db, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/lots/expiring", response_model=List[ExpiringLotResponse])
+def get_expiring_lots(within: str = "30d", medication_name: Optional[str] = None, db: Session = Depends(get_db)):
+    try:
+        within_days = parse_within(within)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return lot_repo.expiring(db, within_days, medication_name)
+
+
+#Analytics
+@app.get("/analytics/best-sellers", response_model=List[BestSellerResponse])
+def get_best_sellers(
+    request: Request,
+    top_n: int = 1,
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    db: Session = Depends(get_db)
+):
+    if top_n < 1:
+        raise HTTPException(status_code=400, detail="Invalid top_n.")
+    media_type = requested_format(request)
+    if media_type:
+        rows = analytics_repo.best_seller_rows(db, top_n, date_from, date_to)
+        return tabular_response(table_from_rows(BEST_SELLER_FIELDS, rows), media_type)
+    return analytics_repo.best_sellers(db, top_n, date_from, date_to)
+
+
+@app.get("/analytics/sales", response_model=List[SalesBucketResponse])
+def get_sales(
+    request: Request,
+    bucket: str = "day",
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    pharmacy_id: Optional[int] = None,
+    medication_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    media_type = requested_format(request)
+    try:
+        if media_type:
+            rows = sales_rollup_repo.sales_rows(db, bucket, date_from, date_to, pharmacy_id, medication_id)
+            return tabular_response(table_from_rows(SALES_FIELDS, rows), media_type)
+        return sales_rollup_repo.sales(db, bucket, date_from, date_to, pharmacy_id, medication_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+#Dashboard
+@app.get("/dashboard/summary", response_model=DashboardSummaryResponse)
+def get_dashboard_summary(top_n: int = 10, db: Session = Depends(get_db)):
+    if not 1 <= top_n <= 100:
+        raise HTTPException(status_code=400, detail="top_n must be between 1 and 100.")
+    return dashboard_repo.get_summary(db, top_n)
+
+
+#Stock level alerts
+@app.get("/alerts", response_model=List[StockAlertResponse])
+def get_alerts(since: Optional[int] = Query(None, description="Last alert id received"),
+               level: Optional[str] = Query(None, pattern="^(low|medium|high)$"),
+               limit: int = Query(100, ge=1, le=1000), db: Session = Depends(get_db)):
+    return stock_alert_repo.get_since(db, since, limit, level)
+
+
+#Live stock changes (Server-Sent Events)
+@app.on_event("startup")
+def start_stock_events():
+    start_notify_listener()
+
+
+@app.get("/events/stock")
+async def stock_events(request: Request):
+    return StreamingResponse(event_stream(request.is_disconnected), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+#Delta sync for the branch terminals
+@app.get("/sync", response_model=SyncResponse)
+def sync_changes(since_version: int = Query(0, ge=0), include: str = "medications,orders",
+                 db: Session = Depends(get_db)):
+    tables = {table.strip() for table in include.split(",") if table.strip()}
+    if not tables or not tables <= {"medications", "orders"}:
+        raise HTTPException(status_code=400, detail="include must list medications and/or orders.")
+    return sync_repo.get_changes(db, since_version, "medications" in tables, "orders" in tables)
+
+
+#Change counters for the client caches
+@app.get("/versions")
+def get_versions(db: Session = Depends(get_db)):
+    return table_version_repo.get_versions(db)
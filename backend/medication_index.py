@@ -0,0 +1,72 @@
+"""
+In-memory prefix index of the medication names (used for autocomplete)
+
+The distinct names are kept sorted by their lowercase form, so a prefix lookup is a binary search.
+Medication writes of this process invalidate the index and it is rebuilt on the next lookup. The writes of the other
+API processes are not seen here, so the index is also rebuilt once it is older than NAME_INDEX_TTL (the medication
+change counter moves with every stock change, a version check would rebuild it after every order).
+"""
+from bisect import bisect_left
+from threading import Lock
+from typing import List
+from sqlalchemy.orm import Session
+from models import MedicationDB
+import time
+
+
+NAME_INDEX_TTL = 60   #seconds
+
+
+class MedicationNameIndex:
+    """
+    Sorted index of the distinct medication names
+    """
+    def __init__(self, ttl: float = NAME_INDEX_TTL):
+        self.ttl = ttl
+        self._keys = []     #Lowercase names, sorted
+        self._names = []    #Original names, same order as the keys
+        self._stale = True
+        self._expires_at = 0.0
+        self._lock = Lock()
+
+
+    def invalidate(self):
+        """
+        Mark the index as stale after a medication write.
+        """
+        self._stale = True
+
+
+    def refresh(self, db: Session):
+        """
+        Rebuild the index from the distinct names in the DB.
+        """
+        with self._lock:
+            self._stale = False
+            self._expires_at = time.monotonic() + self.ttl
+            names = {name for (name,) in db.query(MedicationDB.name).distinct() if name}
+            entries = sorted((name.lower(), name) for name in names)
+            #Swap both lists at once, readers never see a half built index
+            self._keys, self._names = [key for key, _ in entries], [name for _, name in entries]
+
+
+    def suggest(self, db: Session, prefix: str, limit: int = 10) -> List[str]:
+        """
+        Names starting with the prefix (case insensitive), in alphabetical order.
+        """
+        if self._stale or self._expires_at <= time.monotonic():
+            self.refresh(db)
+
+        keys, names = self._keys, self._names
+        prefix = prefix.strip().lower()
+        start = bisect_left(keys, prefix)
+
+        suggestions = []
+        for i in range(start, min(start + limit, len(keys))):
+            if not keys[i].startswith(prefix):
+                break
+            suggestions.append(names[i])
+        return suggestions
+
+
+medication_name_index = MedicationNameIndex()
@@ -1,14 +1,40 @@
-from typing import List, Optional, Union
+from typing import List, Optional, Union, Dict, Any
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
 from models import MedicationRequest, MedicationResponse, MedicationDB, PharmacyDB
+from medication_index import medication_name_index
+from stock_alerts import StockAlertRepository
+from lots import LotRepository
+from stock_events import record_stock_events
+from stock_ledger import record_ledger, ADJUSTMENT, INITIAL, DELETED
 import base64
 
 
+#Allowed sort keys for the medications search ("-" prefix -> descending)
+SORT_COLUMNS = {
+    "id": MedicationDB.id,
+    "name": func.lower(MedicationDB.name),
+    "type": MedicationDB.type,
+    "quantity": MedicationDB.quantity,
+    "price": MedicationDB.price,
+    "stock": MedicationDB.stock,
+}
+
+
+#Medication columns that can be requested with a projection (id and pharma_id are always returned)
+MEDICATION_FIELDS = ["id", "name", "type", "quantity", "price", "pharma_id", "stock", "stock_level", "image"]
+PHARMACY_FIELDS = ["id", "name", "address", "contact_phone", "email"]
+
+
 class MedicationRepository:
     """
     Repo for managing the medication data from DB.
     """
+    stock_alert_repo = StockAlertRepository()
+    lot_repo = LotRepository()
+
     def check_duplicate_medication(self, db: Session, medication_request: MedicationRequest) -> bool:
         """
         Check if a medication already exists.
@@ -43,8 +69,17 @@ class MedicationRepository:
 
         db_medication = MedicationDB(**medication_data)
         db.add(db_medication)
-        db.commit()
+        try:
+            db.flush()
+            record_stock_events(db, [(db_medication.id, db_medication.stock, db_medication.stock_level)])
+            record_ledger(db, [(db_medication.id, db_medication.stock, INITIAL, None)])
+            db.commit()
+        except IntegrityError:
+            #Same name in the same pharmacy (unique constraint)
+            db.rollback()
+            raise HTTPException(status_code=400, detail="Medication already exists.")
         db.refresh(db_medication)
+        medication_name_index.invalidate()
 
         return MedicationResponse.model_validate(db_medication)
 
@@ -56,6 +91,67 @@ class MedicationRepository:
         return [MedicationResponse.model_validate(medication) for medication in db.query(MedicationDB).all()]
 
 
+    def search(self, db: Session, q: Optional[str] = None, stock_level: Optional[str] = None,
+               type: Optional[str] = None, pharma_id: Optional[int] = None,
+               sort: Optional[str] = None) -> List[MedicationResponse]:
+        """
+        Search medications by name and filter by stock level, type and pharmacy. Everything runs in SQL.
+        """
+        query = self.search_query(db, q, stock_level, type, pharma_id, sort)
+        return [MedicationResponse.model_validate(medication) for medication in query.all()]
+
+
+    def search_rows(self, db: Session, columns: List[str], q: Optional[str] = None,
+                    stock_level: Optional[str] = None, type: Optional[str] = None,
+                    pharma_id: Optional[int] = None, sort: Optional[str] = None) -> List[tuple]:
+        """
+        Same search as search(), returning plain row tuples with the requested columns (no ORM objects).
+        """
+        query = self.search_query(db, q, stock_level, type, pharma_id, sort)
+        return query.with_entities(*[getattr(MedicationDB, column) for column in columns]).all()
+
+
+    def search_query(self, db: Session, q: Optional[str] = None, stock_level: Optional[str] = None,
+                     type: Optional[str] = None, pharma_id: Optional[int] = None, sort: Optional[str] = None):
+        """
+        Build the medications search query.
+        """
+        query = db.query(MedicationDB)
+
+        if q:
+            query = query.filter(self.name_search_clause(db, q))
+        if stock_level:
+            query = query.filter(MedicationDB.stock_level == stock_level)
+        if type:
+            query = query.filter(MedicationDB.type == type)
+        if pharma_id is not None:
+            query = query.filter(MedicationDB.pharma_id == pharma_id)
+
+        if sort:
+            column = SORT_COLUMNS.get(sort.lstrip("-"))
+            if column is None:
+                raise HTTPException(status_code=400,
+                                    detail=f"Invalid sort {sort}. See allowed values: {list(SORT_COLUMNS)}.")
+            query = query.order_by(column.desc() if sort.startswith("-") else column.asc(), MedicationDB.id)
+
+        return query
+
+
+    @staticmethod
+    def name_search_clause(db: Session, q: str):
+        """
+        Case insensitive name search.
+        PostgreSQL: "contains" search served by the trigram index.
+        Other DBs (SQLite): prefix search as a range on the lower(name) index.
+        """
+        term = q.strip().lower()
+        if db.get_bind().dialect.name == "postgresql":
+            return func.lower(MedicationDB.name).contains(term, autoescape=True)
+
+        name = func.lower(MedicationDB.name)
+        return (name >= term) & (name < term + "\uffff")
+
+
     def get_by_id(self, db: Session, medication_id: int) -> Optional[MedicationResponse]:
         """
         Retrieve a medication by id.
@@ -79,11 +175,13 @@ class MedicationRepository:
 
         update_data = medication_request.model_dump(exclude_unset=True)
 
-        if 'stock' in update_data and update_data['stock'] != db_medication.stock:
+        if 'stock' in update_data:
             try:
-                #Update stock for all medications with the same name
-                db.query(MedicationDB).filter(MedicationDB.name == db_medication.name).update(
-                    {"stock": update_data['stock']})
+                #Set the stock of all medications with the same name (stock level alerts, ledger delta per row)
+                self.stock_alert_repo.set_stock(db, MedicationDB.name == db_medication.name, update_data['stock'],
+                                                ADJUSTMENT)
+                #Lots over the new stock are written off, first expiry first
+                self.lot_repo.reconcile(db, [db_medication.name])
 
                 db.commit()
             except Exception as e:
@@ -104,6 +202,7 @@ class MedicationRepository:
                 setattr(db_medication, key, value)
             db.commit()
             db.refresh(db_medication)
+            medication_name_index.invalidate()
             return MedicationResponse.model_validate(db_medication)
 
         return HTTPException(status_code=404, detail="Medication not found.")
@@ -116,7 +215,10 @@ class MedicationRepository:
         db_medication = db.query(MedicationDB).filter(MedicationDB.id == medication_id).first()
         if db_medication:
             db.delete(db_medication)
+            record_stock_events(db, [(db_medication.id, None, None)])
+            record_ledger(db, [(db_medication.id, -db_medication.stock, DELETED, None)])
             db.commit()
+            medication_name_index.invalidate()
             return MedicationResponse.model_validate(db_medication)
         return None
 
@@ -151,3 +253,45 @@ class MedicationRepository:
             .all()
         )
 
+
+    @staticmethod
+    def parse_fields(fields: Optional[str]) -> List[str]:
+        """
+        Validate a comma separated list of medication fields. Without fields, all except the image are returned.
+        """
+        if not fields:
+            return [field for field in MEDICATION_FIELDS if field != "image"]
+
+        requested = [field.strip() for field in fields.split(",") if field.strip()]
+        invalid = [field for field in requested if field not in MEDICATION_FIELDS]
+        if invalid:
+            raise HTTPException(status_code=400,
+                                detail=f"Invalid fields {invalid}. See allowed fields: {MEDICATION_FIELDS}.")
+
+        #The ids are needed to reference the medication and its pharmacy
+        return ["id", "pharma_id"] + [field for field in requested if field not in ("id", "pharma_id")]
+
+
+    def get_medications_with_pharmacy_projection(self, db: Session, fields: List[str],
+                                                 normalized: bool = False) -> Union[Dict[str, Any], List[Dict]]:
+        """
+        Medications with only the requested columns (selected in SQL) and their pharmacies.
+        normalized=True -> {"pharmacies": [...], "medications": [...]}, each pharmacy is listed once and the medications
+        reference it by pharma_id.
+        normalized=False -> [{"medication": {...}, "pharmacy": {...}}, ...], same shape as the full join.
+        """
+        columns = [getattr(MedicationDB, field) for field in fields]
+        medications = [dict(zip(fields, row)) for row in db.query(*columns).order_by(MedicationDB.id)]
+
+        pharmacy_ids = {medication["pharma_id"] for medication in medications if medication["pharma_id"] is not None}
+        pharmacy_columns = [getattr(PharmacyDB, field) for field in PHARMACY_FIELDS]
+        pharmacies = {
+            row[0]: dict(zip(PHARMACY_FIELDS, row))
+            for row in db.query(*pharmacy_columns).filter(PharmacyDB.id.in_(pharmacy_ids))
+        } if pharmacy_ids else {}
+
+        if normalized:
+            return {"pharmacies": list(pharmacies.values()), "medications": medications}
+
+        return [{"medication": medication, "pharmacy": pharmacies.get(medication["pharma_id"])}
+                for medication in medications]
@@ -1,14 +1,16 @@
 """
 # pip install pydantic
 """
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Text, Enum as SQLAlchemyEnum
+from sqlalchemy import (Column, Integer, String, Float, ForeignKey, DateTime, Date, Text, Boolean, Index, DDL, func,
+                        UniqueConstraint, Computed, case, Enum as SQLAlchemyEnum)
 from sqlalchemy.orm import relationship
-from sqlalchemy.event import listens_for
+from sqlalchemy.event import listen
 from database import Base
-from pydantic import BaseModel, Field, field_validator
-from datetime import datetime
-from typing import List, Optional
+from pydantic import BaseModel, Field, field_validator, model_validator
+from datetime import datetime, date
+from typing import Dict, List, Optional
 from enum import Enum
+import os
 
 
 #Using Enum for order status
@@ -18,6 +20,35 @@ class OrderStatus(str, Enum):
     delivered = "delivered"
 
 
+#Allowed order status changes: target status -> current statuses
+ORDER_STATUS_TRANSITIONS = {
+    OrderStatus.processed: [OrderStatus.pending],
+    OrderStatus.delivered: [OrderStatus.pending, OrderStatus.processed],
+    OrderStatus.pending: [],
+}
+
+
+#Using Enum for reorder proposal status
+class ProposalStatus(str, Enum):
+    proposed = "proposed"
+    approved = "approved"
+    rejected = "rejected"
+
+
+#Stock level thresholds (.env), low: stock <= STOCK_LEVEL_LOW_MAX, medium: stock <= STOCK_LEVEL_MEDIUM_MAX, high: above.
+#They are only read into the DDL of the generated stock_level column (new DBs); everything else (alerts, reports)
+#reads the column. To change them on an existing DB, re-create the column with a new alembic revision (see 0003)
+STOCK_LEVEL_LOW_MAX = int(os.getenv("STOCK_LEVEL_LOW_MAX", 100))
+STOCK_LEVEL_MEDIUM_MAX = int(os.getenv("STOCK_LEVEL_MEDIUM_MAX", 350))
+
+
+def stock_level_expression(stock):
+    """
+    SQL expression of the stock level for a stock expression (DDL of the generated column).
+    """
+    return case((stock <= STOCK_LEVEL_LOW_MAX, 'low'), (stock <= STOCK_LEVEL_MEDIUM_MAX, 'medium'), else_='high')
+
+
 #Database models
 class MedicationDB(Base):
     """
@@ -26,50 +57,42 @@ class MedicationDB(Base):
     __tablename__ = "medications"
 
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, index=True)
+    #No single column indexes on quantity, price, stock and stock_level: they are written by every order
+    #and no query looks them up (alembic revision 0002)
+    name = Column(String)
     type = Column(String, index=True)
-    quantity = Column(Integer, index=True)
-    price = Column(Float, index=True)
+    quantity = Column(Integer)
+    price = Column(Float)
     pharma_id = Column(Integer, ForeignKey("pharmacies.id"), index=True)
-    stock = Column(Integer, index=True)
-    stock_level = Column(String, index=True)
+    stock = Column(Integer)
+    #Computed by the DB from the stock on every insert/update (also set-based updates), never written by the app
+    stock_level = Column(String, Computed(stock_level_expression(stock), persisted=True))
     image = Column(Text, nullable=True)
+    row_version = Column(Integer, default=0, server_default="0", index=True)   #Delta sync (sync.py)
+
+    __table_args__ = (
+        #Case insensitive name search and sort (prefix search on SQLite)
+        Index("ix_medications_name_lower", func.lower(name)),
+        #A medication is listed once per pharmacy (upsert key for the bulk import).
+        #Also serves the lookups of all the rows with the same name (central stock updates)
+        UniqueConstraint("name", "pharma_id", name="uq_medications_name_pharma_id"),
+        #Stock level filter of the list. Single column: the rows of a medication (written together by every order)
+        #stay next to each other in the index, a (stock_level, pharma_id) key spread them over one page per pharmacy
+        #(benchmark_writes.py, alembic revision 0009)
+        Index("ix_medications_stock_level", "stock_level"),
+    )
 
     #Relationships
     pharmacy = relationship("PharmacyDB", back_populates="medications")
     order_items = relationship("OrderItemDB", back_populates="medication")
 
 
-    #Stock level update
-    def update_stock_level(self):
-        """
-        Update automatically the stock level based on current stock.
-        Low: 0-100
-        Medium: 101 - 350
-        High: >= 351
-        """
-        if self.stock <= 100:
-            self.stock_level = 'low'
-        elif 101 <= self.stock <= 350:
-            self.stock_level = 'medium'
-        else:
-            self.stock_level = 'high'
-
-
-#Listen for automatic update of the stock_level
-@listens_for(MedicationDB, 'before_update')
-def before_update(mapper, connection, target):
-    """
-    SQLAlchemy listener that updates stock level before update operation.
-    """
-    target.update_stock_level()
-
-@listens_for(MedicationDB, 'before_insert')
-def before_insert(mapper, connection, target):
-    """
-    SQLAlchemy listener that updates stock level before insert operation.
-    """
-    target.update_stock_level()
+#Trigram index for the "contains" name search (PostgreSQL only, existing DBs: alembic revision 0008)
+listen(MedicationDB.__table__, 'before_create',
+       DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql'))
+listen(MedicationDB.__table__, 'after_create',
+       DDL("CREATE INDEX IF NOT EXISTS ix_medications_name_trgm "
+           "ON medications USING gin (lower(name) gin_trgm_ops)").execute_if(dialect='postgresql'))
 
 
 class PharmacyDB(Base):
@@ -83,6 +106,12 @@ class PharmacyDB(Base):
     address = Column(String)
     contact_phone = Column(String)
     email = Column(String)
+    #Location (degrees), indexed in memory for the nearest pharmacy lookups (pharmacy_index.py)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
+
+    #Upsert key for the bulk import
+    __table_args__ = (UniqueConstraint("name", "address", name="uq_pharmacies_name_address"),)
 
     #Relationships
     medications = relationship("MedicationDB", back_populates="pharmacy")
@@ -96,15 +125,22 @@ class OrderDB(Base):
     __tablename__ = "orders"
 
     id = Column(Integer, primary_key=True, index=True)
-    pharmacy_id = Column(Integer, ForeignKey("pharmacies.id"), index=True)
+    #No single column index: pharmacy_id leads ix_orders_pharmacy_status_date (alembic revision 0007)
+    pharmacy_id = Column(Integer, ForeignKey("pharmacies.id"))
     order_date = Column(DateTime, default=datetime.utcnow)
     status = Column(SQLAlchemyEnum(OrderStatus))
     total_amount = Column(Float)
+    row_version = Column(Integer, default=0, server_default="0", index=True)   #Delta sync (sync.py)
 
     #Relationships
     pharmacy = relationship("PharmacyDB", back_populates="orders")
     order_items = relationship("OrderItemDB", back_populates="order")
 
+    __table_args__ = (
+        #Order search: pharmacy, status and date range (alembic revision 0001)
+        Index("ix_orders_pharmacy_status_date", "pharmacy_id", "status", "order_date"),
+    )
+
 
 class OrderItemDB(Base):
     """
@@ -122,6 +158,222 @@ class OrderItemDB(Base):
     order = relationship("OrderDB", back_populates="order_items")
     medication = relationship("MedicationDB", back_populates="order_items")
 
+    __table_args__ = (
+        #Orders containing a medication (alembic revision 0001)
+        Index("ix_order_items_medication_order", "medication_id", "order_id"),
+    )
+
+
+class DailyMedicationSalesDB(Base):
+    """
+    DB model for the daily sales rollup per medication and pharmacy (maintained by the order writes)
+    """
+    __tablename__ = "daily_medication_sales"
+
+    day = Column(Date, primary_key=True)
+    medication_id = Column(Integer, primary_key=True, index=True)
+    pharmacy_id = Column(Integer, primary_key=True, index=True)
+    quantity = Column(Integer, default=0)
+    revenue = Column(Float, default=0)
+    order_count = Column(Integer, default=0)
+
+
+class DailyPharmacySalesDB(Base):
+    """
+    DB model for the daily sales rollup per pharmacy (maintained by the order writes)
+    """
+    __tablename__ = "daily_pharmacy_sales"
+
+    day = Column(Date, primary_key=True)
+    pharmacy_id = Column(Integer, primary_key=True, index=True)
+    quantity = Column(Integer, default=0)
+    revenue = Column(Float, default=0)
+    order_count = Column(Integer, default=0)
+
+
+class ReorderProposalDB(Base):
+    """
+    DB model for a purchase order proposed by the reorder planner
+    """
+    __tablename__ = "reorder_proposals"
+
+    id = Column(Integer, primary_key=True, index=True)
+    medication_id = Column(Integer, ForeignKey("medications.id"), index=True)
+    medication_name = Column(String, index=True)
+    current_stock = Column(Integer)
+    predicted_demand = Column(Integer)
+    safety_stock = Column(Integer)
+    reorder_point = Column(Integer)
+    recommended_quantity = Column(Integer)
+    status = Column(SQLAlchemyEnum(ProposalStatus), default=ProposalStatus.proposed, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    #Relationships
+    medication = relationship("MedicationDB")
+
+
+class ForecastAccuracyDB(Base):
+    """
+    DB model for the forecast accuracy of a medication.
+    Holds the open forecast window and the running error aggregates of the closed windows.
+    """
+    __tablename__ = "forecast_accuracy"
+
+    id = Column(Integer, primary_key=True, index=True)
+    medication_name = Column(String, unique=True, index=True)
+    predicted_demand = Column(Float)
+    actual_demand = Column(Float, default=0)
+    window_start = Column(DateTime)
+    window_end = Column(DateTime)
+    periods = Column(Integer, default=0)
+    abs_error_sum = Column(Float, default=0)
+    error_sum = Column(Float, default=0)
+    recent_abs_error = Column(Float, default=0)
+    drift = Column(Boolean, default=False, index=True)
+
+    @property
+    def mae(self):
+        """
+        Mean absolute error over the closed windows
+        """
+        return self.abs_error_sum / self.periods if self.periods else None
+
+    @property
+    def bias(self):
+        """
+        Mean error (actual - predicted) over the closed windows. Positive -> the demand is underestimated.
+        """
+        return self.error_sum / self.periods if self.periods else None
+
+
+class StockAlertDB(Base):
+    """
+    DB model for a stock level change of a medication (append only).
+    The id is the polling cursor of GET /alerts.
+    """
+    __tablename__ = "stock_alerts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    medication_id = Column(Integer, ForeignKey("medications.id", ondelete="SET NULL"), nullable=True)
+    medication_name = Column(String, index=True)
+    pharma_id = Column(Integer)
+    stock = Column(Integer)
+    old_level = Column(String)
+    new_level = Column(String)
+
+
+class SyncStateDB(Base):
+    """
+    DB model for the row version counter of the delta sync (single row, id=1)
+    """
+    __tablename__ = "sync_state"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+listen(SyncStateDB.__table__, 'after_create', DDL("INSERT INTO sync_state (id, version) VALUES (1, 0)"))
+
+
+class TableVersionDB(Base):
+    """
+    DB model for the change counter of a table (cache validation of the list endpoints)
+    """
+    __tablename__ = "table_versions"
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+listen(TableVersionDB.__table__, 'after_create',
+       DDL("INSERT INTO table_versions (table_name, version) "
+           "VALUES ('medications', 0), ('pharmacies', 0), ('orders', 0)"))
+
+
+class SyncTombstoneDB(Base):
+    """
+    DB model for a deleted medication or order (delta sync)
+    """
+    __tablename__ = "sync_tombstones"
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False, index=True)
+
+
+class StockLedgerDB(Base):
+    """
+    DB model for a stock change of a medication (append only)
+    """
+    __tablename__ = "stock_ledger"
+
+    id = Column(Integer, primary_key=True)
+    medication_id = Column(Integer, nullable=False)   #No foreign key: the history is kept after a delete
+    delta = Column(Integer, nullable=False)
+    reason = Column(String, nullable=False)
+    order_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        #Tail after a snapshot
+        Index("ix_stock_ledger_medication_id_id", "medication_id", "id"),
+        #Stock history of a time range
+        Index("ix_stock_ledger_medication_created_at", "medication_id", "created_at"),
+    )
+
+
+class StockSnapshotDB(Base):
+    """
+    DB model for the stock of a medication at a point in time, including the ledger rows up to ledger_id
+    """
+    __tablename__ = "stock_snapshots"
+
+    id = Column(Integer, primary_key=True)
+    medication_id = Column(Integer, nullable=False)
+    taken_at = Column(DateTime, nullable=False)
+    stock = Column(Integer, nullable=False)
+    ledger_id = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_stock_snapshots_medication_taken_at", "medication_id", "taken_at"),
+    )
+
+
+class LotDB(Base):
+    """
+    DB model for a lot of a medication in the central stock (same name, all pharmacies)
+    """
+    __tablename__ = "lots"
+
+    id = Column(Integer, primary_key=True)
+    medication_name = Column(String, nullable=False)
+    lot_number = Column(String, nullable=False)
+    expiry_date = Column(Date, nullable=False)
+    quantity = Column(Integer, nullable=False)   #Left in the lot
+    received_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("medication_name", "lot_number", name="uq_lots_medication_lot"),
+        #FEFO allocation: the lots of a medication in expiry order
+        Index("ix_lots_medication_expiry", "medication_name", "expiry_date"),
+        #Expiring lots report: only the lots with something left
+        Index("ix_lots_expiry_in_stock", "expiry_date", postgresql_where=quantity > 0, sqlite_where=quantity > 0),
+    )
+
+
+class LotAllocationDB(Base):
+    """
+    DB model for the quantity of an order taken from a lot
+    """
+    __tablename__ = "lot_allocations"
+
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, nullable=False, index=True)   #No foreign key, same as the ledger
+    lot_id = Column(Integer, ForeignKey("lots.id"), nullable=False)
+    quantity = Column(Integer, nullable=False)
+
 
 ### Pydantic models ###
 #POST, PUT (exclude stock_level)
@@ -179,6 +431,14 @@ class PharmacyRequest(BaseModel):
     address: str
     contact_phone: str = Field(..., description="Phone")
     email: str = Field(..., pattern=r"^[\w\.-]+@[\w\.-]+\.\w+$", description="Email")
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+    @model_validator(mode="after")
+    def check_location(self):
+        if (self.latitude is None) != (self.longitude is None):
+            raise ValueError("Latitude and longitude must be set together.")
+        return self
 
     class Config:
         from_attributes = True
@@ -193,6 +453,8 @@ class PharmacyResponse(BaseModel):
     address: str
     contact_phone: str
     email: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
     class Config:
         from_attributes = True
@@ -266,3 +528,321 @@ class MedicationWithPharmacyResponse(BaseModel):
     class Config:
         from_attributes = True
 
+
+
+class ReorderProposalResponse(BaseModel):
+    """
+    Pydantic model for returning a reorder proposal
+    """
+    id: int
+    medication_id: int
+    medication_name: str
+    current_stock: int
+    predicted_demand: int
+    safety_stock: int
+    reorder_point: int
+    recommended_quantity: int
+    status: ProposalStatus
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class ReorderRunResponse(BaseModel):
+    """
+    Pydantic model for the summary of a reorder planner run
+    """
+    evaluated: int
+    proposed: int
+    skipped: List[str]
+    duration_seconds: float
+
+
+class StockTransferRecommendation(BaseModel):
+    """
+    Pydantic model for a stock transfer proposed by the rebalancing
+    """
+    medication_name: str
+    from_pharmacy_id: int
+    to_pharmacy_id: int
+    from_medication_id: int
+    to_medication_id: int
+    quantity: int
+    from_quantity: int = Field(description="Stock of the sending pharmacy before the transfer")
+    to_quantity: int = Field(description="Stock of the receiving pharmacy before the transfer")
+    to_daily_demand: float
+
+
+class RebalanceResponse(BaseModel):
+    """
+    Pydantic model for the stock transfer recommendations of all the medications
+    """
+    medications: int
+    rows: int
+    transferred_quantity: int
+    unmet_need: int = Field(description="Units still needed after the transfers (to be reordered)")
+    transfers: List[StockTransferRecommendation]
+    duration_seconds: float
+
+
+class ForecastAccuracyResponse(BaseModel):
+    """
+    Pydantic model for returning the forecast accuracy of a medication
+    """
+    medication_name: str
+    predicted_demand: float
+    actual_demand: float
+    window_start: datetime
+    window_end: datetime
+    periods: int
+    mae: Optional[float] = None
+    bias: Optional[float] = None
+    recent_abs_error: float
+    drift: bool
+
+    class Config:
+        from_attributes = True
+
+
+class BestSellerResponse(BaseModel):
+    """
+    Pydantic model for returning a best-selling medication of a pharmacy
+    """
+    pharmacy_id: int
+    pharmacy_name: Optional[str] = None
+    medication_id: int
+    medication_name: Optional[str] = None
+    quantity: int
+    rank: int
+    pharmacy_total_quantity: int
+
+
+class SalesBucketResponse(BaseModel):
+    """
+    Pydantic model for returning the sales of a time bucket (day, week or month)
+    """
+    period_start: date
+    quantity: int
+    revenue: float
+    order_count: int
+
+
+class PharmacyTotalsResponse(BaseModel):
+    """
+    Pydantic model for returning the stock totals of a pharmacy
+    """
+    pharmacy_id: Optional[int] = None
+    pharmacy_name: Optional[str] = None
+    medications: int
+    quantity: int
+    low_stock: int
+
+
+class LowStockItemResponse(BaseModel):
+    """
+    Pydantic model for returning a medication with low stock
+    """
+    name: str
+    stock: int
+    stock_level: Optional[str] = None
+
+
+class DashboardSummaryResponse(BaseModel):
+    """
+    Pydantic model for returning the main page KPIs
+    """
+    stock_levels: Dict[str, int]
+    stock_level_thresholds: Dict[str, int]   #Highest stock of the low and medium levels
+    pharmacies: List[PharmacyTotalsResponse]
+    lowest_stock: List[LowStockItemResponse]
+
+
+class BulkRowError(BaseModel):
+    """
+    Pydantic model for a rejected row of a bulk import (row 1 is the first data row)
+    """
+    row: int
+    error: str
+
+
+class BulkImportResponse(BaseModel):
+    """
+    Pydantic model for the report of a bulk import
+    """
+    total: int
+    imported: int
+    failed: int
+    errors: List[BulkRowError]
+
+
+class BulkOrderRequest(BaseModel):
+    """
+    Pydantic model for submitting several orders at once
+    """
+    orders: List[OrderRequest] = Field(min_length=1)
+
+
+class BulkOrderResult(BaseModel):
+    """
+    Pydantic model for the result of one order of a bulk submission (index in the submitted list)
+    """
+    index: int
+    order_id: Optional[int] = None
+    total_amount: Optional[float] = None
+    error: Optional[str] = None
+
+
+class BulkOrderResponse(BaseModel):
+    """
+    Pydantic model for the report of a bulk order submission
+    """
+    created: int
+    rejected: int
+    results: List[BulkOrderResult]
+
+
+class OrderStatusBulkRequest(BaseModel):
+    """
+    Pydantic model for changing the status of many orders: a list of ids and/or filters
+    """
+    order_ids: Optional[List[int]] = Field(None, min_length=1)
+    pharmacy_id: Optional[int] = None
+    status: Optional[OrderStatus] = Field(None, description="Current status of the orders")
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    target: OrderStatus
+
+    @model_validator(mode="after")
+    def check_selection(self):
+        if self.order_ids is None and self.pharmacy_id is None and self.status is None \
+                and self.date_from is None and self.date_to is None:
+            raise ValueError("Order ids or at least one filter are required.")
+        return self
+
+
+class OrderStatusBulkResponse(BaseModel):
+    """
+    Pydantic model for the summary of a bulk status change
+    """
+    target: OrderStatus
+    matched: int
+    updated: int
+    skipped: Dict[str, int] = Field(default_factory=dict, description="Orders not updated, by current status")
+    not_found: List[int] = Field(default_factory=list)
+
+
+class StockAlertResponse(BaseModel):
+    """
+    Pydantic model for returning a stock level change
+    """
+    id: int
+    created_at: datetime
+    medication_id: Optional[int] = None
+    medication_name: str
+    pharma_id: Optional[int] = None
+    stock: int
+    old_level: str
+    new_level: str
+
+    class Config:
+        from_attributes = True
+
+
+class SyncTombstoneResponse(BaseModel):
+    """
+    Pydantic model for a deleted row in the delta sync
+    """
+    table_name: str
+    row_id: int
+    version: int
+
+    class Config:
+        from_attributes = True
+
+
+class SyncResponse(BaseModel):
+    """
+    Pydantic model for the rows changed since a version.
+    version is the value to send as since_version in the next request.
+    """
+    version: int
+    medications: List[MedicationResponse]
+    orders: List[OrderResponse]
+    deleted: List[SyncTombstoneResponse]
+
+
+class StockAtResponse(BaseModel):
+    """
+    Pydantic model for the stock of a medication at a point in time
+    """
+    medication_id: int
+    at: datetime
+    stock: int
+    snapshot_at: Optional[datetime] = Field(None, description="Snapshot used as the starting point")
+    ledger_rows: int = Field(description="Ledger rows applied after the snapshot")
+
+
+class StockHistoryPoint(BaseModel):
+    """
+    Pydantic model for one point of a stock history series
+    """
+    t: datetime
+    stock: int
+
+
+class StockHistoryResponse(BaseModel):
+    """
+    Pydantic model for the downsampled stock history of a medication
+    """
+    medication_id: int
+    date_from: datetime
+    date_to: datetime
+    changes: int = Field(description="Stock changes in the range before downsampling")
+    points: List[StockHistoryPoint]
+
+
+class NearestPharmacyResponse(BaseModel):
+    """
+    Pydantic model for a pharmacy holding a medication, with its distance
+    """
+    pharmacy_id: int
+    name: str
+    address: str
+    latitude: float
+    longitude: float
+    distance_km: float
+    medication_id: int
+    quantity: int
+
+
+class LotRequest(BaseModel):
+    """
+    Pydantic model for receiving a lot
+    """
+    medication_name: str
+    lot_number: str = Field(min_length=1, max_length=50)
+    expiry_date: date
+    quantity: int = Field(gt=0)
+
+
+class LotResponse(BaseModel):
+    """
+    Pydantic model for returning a lot
+    """
+    id: int
+    medication_name: str
+    lot_number: str
+    expiry_date: date
+    quantity: int
+    received_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class ExpiringLotResponse(LotResponse):
+    """
+    Pydantic model for a lot of the expiring lots report
+    """
+    days_to_expiry: int
@@ -1,14 +1,33 @@
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
 from typing import List, Optional
+from sqlalchemy import case, insert, func, select
 from sqlalchemy.orm import Session
 from models import (OrderRequest, OrderResponse, OrderDB, OrderItemDB, OrderItemResponse, OrderStatus,
-                    MedicationDB, MedicationResponse, PharmacyResponse)
+                    MedicationDB, MedicationResponse, PharmacyResponse, BulkOrderResult, BulkOrderResponse,
+                    OrderStatusBulkRequest, OrderStatusBulkResponse, ORDER_STATUS_TRANSITIONS)
+from forecast_accuracy import ForecastAccuracyRepository
+from sales_rollup import SalesRollupRepository, order_day
+from stock_alerts import StockAlertRepository
+from sync import row_version
+from stock_ledger import record_ledger, ORDER, ORDER_UPDATE
+from lots import LotRepository
 import logging
 
 
+#Columns of the tabular (Arrow / Parquet) responses, in the OrderResponse model order (the items are a list column)
+ORDER_TABLE_FIELDS = list(OrderResponse.model_fields)
+
+
 class OrderRepository:
     """
     Repo for managing the order data from DB.
     """
+    forecast_accuracy_repo = ForecastAccuracyRepository()
+    sales_rollup_repo = SalesRollupRepository()
+    stock_alert_repo = StockAlertRepository()
+    lot_repo = LotRepository()
+
     def check_duplicate_order(self, db: Session, order_request: OrderRequest) -> bool:
         """
         Check if an order already exists.
@@ -53,6 +72,8 @@ class OrderRepository:
         db.flush()  #Forces generation of an order id
 
         total_amount = 0
+        rollup_items = []
+        lot_items = []
         for item in order_request.order_items:
             #Access the medication from DB by medication_id to get its name
             medication = db.query(MedicationDB).filter_by(id=item.medication_id).first()
@@ -60,15 +81,13 @@ class OrderRepository:
             if not medication:
                 raise ValueError(f"Medication with id {item.medication_id} not found.")
 
-            #Get all medications with the same name
-            medications_with_same_name = db.query(MedicationDB).filter_by(name=medication.name).all()
-
-            #Check stock availability across all pharmacies with the same medication name
-            if medication.stock < item.quantity:
+            #Check the sellable stock across all pharmacies with the same medication name (expired lots excluded)
+            if self.lot_repo.sellable(db, {medication.name: medication.stock})[medication.name] < item.quantity:
                 raise ValueError(f"Not enough stock for medication {medication.name}.")
 
-            for med in medications_with_same_name:
-                med.stock -= item.quantity
+            #Decrease the stock of all medications with the same name (one UPDATE, stock level alerts, ledger)
+            self.stock_alert_repo.change_stock(db, MedicationDB.name == medication.name, -item.quantity,
+                                               ORDER, db_order.id)
 
             #Increase quantity in the pharmacy that made the order
             medication_in_order_pharmacy = db.query(MedicationDB).filter_by(id=item.medication_id,
@@ -76,6 +95,9 @@ class OrderRepository:
             if medication_in_order_pharmacy:
                 medication_in_order_pharmacy.quantity += item.quantity
 
+            #Real demand for the forecast accuracy
+            self.forecast_accuracy_repo.record_demand(db, medication.name, item.quantity)
+
             #Medication price remains the same
             medication_price = medication.price
 
@@ -87,6 +109,8 @@ class OrderRepository:
                 price=medication_price
             )
             db.add(db_order_item)
+            rollup_items.append((item.medication_id, item.quantity, medication_price))
+            lot_items.append((db_order.id, medication.name, item.quantity))
 
             #Total order amount
             total_amount += medication_price * item.quantity
@@ -94,6 +118,12 @@ class OrderRepository:
         #Set the total amount in the order
         db_order.total_amount = total_amount
 
+        #Take the stock from the lots, first expiry first
+        self.lot_repo.allocate(db, lot_items)
+
+        #Daily sales rollups, same transaction
+        self.sales_rollup_repo.apply_order(db, db_order.pharmacy_id, order_day(db_order.order_date), rollup_items)
+
         #Commit the updates
         db.commit()
         db.refresh(db_order)
@@ -114,6 +144,148 @@ class OrderRepository:
             ]
         )
 
+    def add_bulk(self, db: Session, order_requests: List[OrderRequest],
+                 chunk_size: Optional[int] = None) -> BulkOrderResponse:
+        """
+        Add many orders with set-based stock updates.
+        The orders are processed in chunks (one transaction per chunk, the whole list by default). For every chunk
+        the referenced medications are read (and locked) with one query, the orders are validated against the
+        remaining stock in memory and the stock/quantity changes are applied with one UPDATE each.
+        An order without enough stock is rejected, the others are created.
+        """
+        chunk_size = chunk_size or len(order_requests)
+        results = []
+
+        for start in range(0, len(order_requests), chunk_size):
+            chunk = list(enumerate(order_requests[start:start + chunk_size], start=start))
+            try:
+                results.extend(self.add_chunk(db, chunk))
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                logging.error(f"Bulk order chunk failed: {e}")
+                results = [result for result in results if result.index < start]
+                results.extend(BulkOrderResult(index=index, error=f"Chunk failed: {e}") for index, _ in chunk)
+
+        created = sum(1 for result in results if result.order_id is not None)
+        return BulkOrderResponse(created=created, rejected=len(results) - created, results=results)
+
+
+    def add_chunk(self, db: Session, chunk: List[tuple]) -> List[BulkOrderResult]:
+        """
+        Validate and write one chunk of a bulk submission (the caller commits).
+        """
+        medication_ids = {item.medication_id for _, order in chunk for item in order.order_items}
+        medications = {
+            medication.id: medication
+            for medication in db.query(MedicationDB).filter(MedicationDB.id.in_(medication_ids)).with_for_update()
+        }
+
+        #Sellable stock left per medication name while the orders are validated (expired lots excluded)
+        available = self.lot_repo.sellable(db, {medication.name: medication.stock
+                                                for medication in medications.values()})
+        stock_decrements = defaultdict(int)     #name -> quantity
+        quantity_increments = defaultdict(int)  #medication id -> quantity
+        accepted = []
+        results = {}
+
+        for index, order in chunk:
+            error = None
+            needed = defaultdict(int)
+            for item in order.order_items:
+                medication = medications.get(item.medication_id)
+                if medication is None:
+                    error = f"Medication with id {item.medication_id} not found."
+                    break
+                needed[medication.name] += item.quantity
+
+            if error is None:
+                short = [name for name, quantity in needed.items() if available[name] < quantity]
+                if short:
+                    error = f"Not enough stock for medication {short[0]}."
+
+            if error is not None:
+                results[index] = BulkOrderResult(index=index, error=error)
+                continue
+
+            #Reserve the stock for this order
+            for name, quantity in needed.items():
+                available[name] -= quantity
+                stock_decrements[name] += quantity
+            for item in order.order_items:
+                #Increase quantity in the pharmacy that made the order
+                if medications[item.medication_id].pharma_id == order.pharmacy_id:
+                    quantity_increments[item.medication_id] += item.quantity
+            accepted.append((index, order))
+
+        if accepted:
+            stock_rows = self.apply_stock_changes(db, stock_decrements, quantity_increments)
+
+            #Orders (one flush for the ids), then all the items with one INSERT
+            db_orders = [OrderDB(pharmacy_id=order.pharmacy_id, status=order.status,
+                                 total_amount=sum(medications[item.medication_id].price * item.quantity
+                                                  for item in order.order_items))
+                         for _, order in accepted]
+            db.add_all(db_orders)
+            db.flush()
+
+            db.execute(insert(OrderItemDB), [
+                {"order_id": db_order.id, "medication_id": item.medication_id, "quantity": item.quantity,
+                 "price": medications[item.medication_id].price}
+                for db_order, (_, order) in zip(db_orders, accepted) for item in order.order_items
+            ])
+
+            #Ledger: one row per order item and medication row with the same name
+            ids_by_name = defaultdict(list)
+            for medication_id, name, *_ in stock_rows:
+                ids_by_name[name].append(medication_id)
+            record_ledger(db, [
+                (medication_id, -item.quantity, ORDER, db_order.id)
+                for db_order, (_, order) in zip(db_orders, accepted) for item in order.order_items
+                for medication_id in ids_by_name[medications[item.medication_id].name]
+            ])
+
+            #Lots of all the medications with one query, first expiry first
+            self.lot_repo.allocate(db, [
+                (db_order.id, medications[item.medication_id].name, item.quantity)
+                for db_order, (_, order) in zip(db_orders, accepted) for item in order.order_items
+            ])
+
+            #Real demand for the forecast accuracy and daily sales rollups, same transaction
+            for name, quantity in stock_decrements.items():
+                self.forecast_accuracy_repo.record_demand(db, name, quantity)
+            self.sales_rollup_repo.apply_orders(db, order_day(db_orders[0].order_date), [
+                (order.pharmacy_id, [(item.medication_id, item.quantity, medications[item.medication_id].price)
+                                     for item in order.order_items])
+                for _, order in accepted
+            ])
+
+            for db_order, (index, _) in zip(db_orders, accepted):
+                results[index] = BulkOrderResult(index=index, order_id=db_order.id,
+                                                 total_amount=db_order.total_amount)
+
+        return [results[index] for index, _ in chunk]
+
+
+    def apply_stock_changes(self, db: Session, stock_decrements: dict, quantity_increments: dict) -> List[tuple]:
+        """
+        Set-based stock updates: one UPDATE for the central stock (all the rows with the same name, stock level
+        alerts) and one for the pharmacy quantities. The stock level is generated by the DB.
+        Return the rows of the stock update (the ledger is recorded per order by the caller).
+        """
+        stock_rows = []
+        if stock_decrements:
+            stock_rows = self.stock_alert_repo.change_stock(db, MedicationDB.name.in_(list(stock_decrements)),
+                                                            -case(stock_decrements, value=MedicationDB.name, else_=0))
+
+        if quantity_increments:
+            db.query(MedicationDB).filter(MedicationDB.id.in_(list(quantity_increments))).update(
+                {"quantity": MedicationDB.quantity + case(quantity_increments, value=MedicationDB.id, else_=0),
+                 "row_version": row_version(db)},
+                synchronize_session=False)
+        return stock_rows
+
+
     def update(self, db: Session, order_id: int, order_request: OrderRequest) -> Optional[OrderResponse]:
         """
         Update order by id
@@ -131,6 +303,11 @@ class OrderRepository:
         existing_order_items = db.query(OrderItemDB).filter(OrderItemDB.order_id == order_id).all()
         existing_items_by_medication = {item.medication_id: item for item in existing_order_items}
 
+        #Previous version of the order, removed from the rollups
+        previous_pharmacy_id = db_order.pharmacy_id
+        previous_rollup_items = [(item.medication_id, item.quantity, item.price) for item in existing_order_items]
+        rollup_items = []
+
         #Update order's data
         db_order.pharmacy_id = order_request.pharmacy_id
         db_order.status = order_request.status
@@ -143,30 +320,40 @@ class OrderRepository:
             if not medication:
                 raise ValueError(f"Medication with id {item.medication_id} not found.")
 
-            #Get all instances of this medication across all pharmacies
-            all_medication_instances = db.query(MedicationDB).filter_by(name=medication.name).all()
-
             #Update quantity in the pharmacy that made the order and update stock for all pharmacies
             medication_in_order_pharmacy = db.query(MedicationDB).filter_by(id=item.medication_id,
                                                                             pharma_id=order_request.pharmacy_id).first()
             if not medication_in_order_pharmacy:
                 raise ValueError(f"Medication with id {item.medication_id} not found in the specified pharmacy.")
 
+            #Sellable stock across all pharmacies with the same medication name (expired lots excluded)
+            sellable = self.lot_repo.sellable(db, {medication.name: medication.stock})[medication.name]
+
             if item.medication_id in existing_items_by_medication:
                 existing_item = existing_items_by_medication[item.medication_id]
                 quantity_diff = item.quantity - existing_item.quantity
+                if quantity_diff > 0 and sellable < quantity_diff:
+                    raise ValueError(f"Not enough stock for medication {medication.name}.")
                 medication_in_order_pharmacy.quantity += quantity_diff
                 #Update stock in all pharmacies
-                for med_instance in all_medication_instances:
-                    med_instance.stock -= quantity_diff
+                self.stock_alert_repo.change_stock(db, MedicationDB.name == medication.name, -quantity_diff,
+                                                   ORDER_UPDATE, db_order.id)
                 existing_item.quantity = item.quantity
+                if quantity_diff > 0:
+                    self.lot_repo.allocate(db, [(db_order.id, medication.name, quantity_diff)])
+                else:
+                    self.lot_repo.release(db, db_order.id, medication.name, -quantity_diff)
+                self.forecast_accuracy_repo.record_demand(db, medication.name, quantity_diff)
+                rollup_items.append((item.medication_id, item.quantity, existing_item.price))
             else:
-                if medication.stock < item.quantity:
+                if sellable < item.quantity:
                     raise ValueError(f"Not enough stock for medication {medication.name}.")
                 medication_in_order_pharmacy.quantity += item.quantity
                 #Update stock in all pharmacies
-                for med_instance in all_medication_instances:
-                    med_instance.stock -= item.quantity
+                self.stock_alert_repo.change_stock(db, MedicationDB.name == medication.name, -item.quantity,
+                                                   ORDER_UPDATE, db_order.id)
+                self.lot_repo.allocate(db, [(db_order.id, medication.name, item.quantity)])
+                self.forecast_accuracy_repo.record_demand(db, medication.name, item.quantity)
                 new_order_item = OrderItemDB(
                     order_id=db_order.id,
                     medication_id=item.medication_id,
@@ -174,6 +361,7 @@ class OrderRepository:
                     price=medication.price
                 )
                 db.add(new_order_item)
+                rollup_items.append((item.medication_id, item.quantity, medication.price))
 
                 #Calculate total order amount
             total_amount += medication.price * item.quantity
@@ -182,19 +370,25 @@ class OrderRepository:
         for existing_item in existing_order_items:
             if existing_item.medication_id not in {item.medication_id for item in order_request.order_items}:
                 medication = db.query(MedicationDB).filter_by(id=existing_item.medication_id).first()
-                all_medication_instances = db.query(MedicationDB).filter_by(name=medication.name).all()
                 medication_in_order_pharmacy = db.query(MedicationDB).filter_by(id=existing_item.medication_id,
                                                                                 pharma_id=order_request.pharmacy_id).first()
                 if medication_in_order_pharmacy:
                     medication_in_order_pharmacy.quantity -= existing_item.quantity
                 #Restore stock in all pharmacies
-                for med_instance in all_medication_instances:
-                    med_instance.stock += existing_item.quantity
+                self.stock_alert_repo.change_stock(db, MedicationDB.name == medication.name, existing_item.quantity,
+                                                   ORDER_UPDATE, db_order.id)
+                self.lot_repo.release(db, db_order.id, medication.name, existing_item.quantity)
+                self.forecast_accuracy_repo.record_demand(db, medication.name, -existing_item.quantity)
                 db.delete(existing_item)  #Delete the item from the order
 
         #Update the total amount
         db_order.total_amount = total_amount
 
+        #Daily sales rollups: replace the previous version of the order
+        day = order_day(db_order.order_date)
+        self.sales_rollup_repo.apply_order(db, previous_pharmacy_id, day, previous_rollup_items, sign=-1)
+        self.sales_rollup_repo.apply_order(db, db_order.pharmacy_id, day, rollup_items)
+
         #Commit and refresh
         db.commit()
         db.refresh(db_order)
@@ -215,25 +409,37 @@ class OrderRepository:
         )
 
 
-    def get_all(self, db: Session) -> List[OrderResponse]:
+    def get_all(self, db: Session, pharmacy_id: Optional[int] = None, status: Optional[OrderStatus] = None,
+                date_from: Optional[date] = None, date_to: Optional[date] = None,
+                medication_id: Optional[int] = None) -> List[OrderResponse]:
         """
-        Retrieve all orders from DB
+        Retrieve the orders from DB, optionally filtered.
         """
-        orders = db.query(OrderDB).all()
-        return [OrderResponse(
-            id=order.id,
-            pharmacy_id=order.pharmacy_id,
-            order_date=order.order_date,
-            status=order.status,
-            total_amount=order.total_amount,
-            order_items=[
-                OrderItemResponse(
-                    medication_id=item.medication_id,
-                    quantity=item.quantity,
-                    price=db.query(MedicationDB).filter_by(id=item.medication_id).first().price
-                ) for item in order.order_items
-            ]
-        ) for order in orders]
+        return [OrderResponse(**dict(zip(ORDER_TABLE_FIELDS, row)))
+                for row in self.get_rows(db, pharmacy_id, status, date_from, date_to, medication_id)]
+
+
+    def get_rows(self, db: Session, pharmacy_id: Optional[int] = None, status: Optional[OrderStatus] = None,
+                 date_from: Optional[date] = None, date_to: Optional[date] = None,
+                 medication_id: Optional[int] = None) -> List[tuple]:
+        """
+        The filtered orders as plain row tuples with the ORDER_TABLE_FIELDS columns (no ORM objects).
+        The items of all the orders, with the current medication price, are read with one more query.
+        """
+        query = self.order_query(db, pharmacy_id, status, date_from, date_to, medication_id)
+        orders = query.with_entities(OrderDB.id, OrderDB.pharmacy_id, OrderDB.order_date, OrderDB.status,
+                                     OrderDB.total_amount).all()
+
+        items = defaultdict(list)
+        for order_id, item_medication_id, quantity, price in (
+                db.query(OrderItemDB.order_id, OrderItemDB.medication_id, OrderItemDB.quantity,
+                         func.coalesce(MedicationDB.price, OrderItemDB.price))
+                .outerjoin(MedicationDB, MedicationDB.id == OrderItemDB.medication_id)
+                .filter(OrderItemDB.order_id.in_(query.with_entities(OrderDB.id).order_by(None)))
+                .order_by(OrderItemDB.order_id, OrderItemDB.id)):
+            items[order_id].append({"medication_id": item_medication_id, "quantity": quantity, "price": price})
+
+        return [(*order, items[order[0]]) for order in orders]
 
 
     def get_by_id(self, db: Session, order_id: int) -> Optional[OrderResponse]:
@@ -286,6 +492,71 @@ class OrderRepository:
         return None
 
 
+    def order_query(self, db: Session, pharmacy_id: Optional[int] = None, status: Optional[OrderStatus] = None,
+                    date_from: Optional[date] = None, date_to: Optional[date] = None,
+                    medication_id: Optional[int] = None):
+        """
+        Query of the filtered orders (GET /orders).
+        The filters use the composite indexes ix_orders_pharmacy_status_date and ix_order_items_medication_order
+        (checked by tests/test_order_query_plans.py).
+        """
+        filters = self.order_filters(pharmacy_id, status, date_from, date_to)
+        if medication_id is not None:
+            filters.append(OrderDB.id.in_(
+                select(OrderItemDB.order_id).where(OrderItemDB.medication_id == medication_id)))
+        return db.query(OrderDB).filter(*filters).order_by(OrderDB.id)
+
+
+    @staticmethod
+    def order_filters(pharmacy_id: Optional[int] = None, status: Optional[OrderStatus] = None,
+                      date_from: Optional[date] = None, date_to: Optional[date] = None) -> list:
+        """
+        Filter clauses on the orders table (the dates are inclusive).
+        """
+        filters = []
+        if pharmacy_id is not None:
+            filters.append(OrderDB.pharmacy_id == pharmacy_id)
+        if status is not None:
+            filters.append(OrderDB.status == status)
+        if date_from is not None:
+            filters.append(OrderDB.order_date >= datetime.combine(date_from, time.min))
+        if date_to is not None:
+            filters.append(OrderDB.order_date < datetime.combine(date_to + timedelta(days=1), time.min))
+        return filters
+
+
+    def update_status_bulk(self, db: Session, request: OrderStatusBulkRequest) -> OrderStatusBulkResponse:
+        """
+        Change the status of the selected orders with one UPDATE.
+        Only the orders whose current status allows the transition (ORDER_STATUS_TRANSITIONS) are updated,
+        the others are counted by status in the summary.
+        """
+        filters = self.order_filters(request.pharmacy_id, request.status, request.date_from, request.date_to)
+        if request.order_ids is not None:
+            filters.append(OrderDB.id.in_(request.order_ids))
+
+        #Matched orders by current status, one grouped query
+        matched = {status: count for status, count in
+                   db.query(OrderDB.status, func.count(OrderDB.id)).filter(*filters).group_by(OrderDB.status)}
+
+        not_found = []
+        if request.order_ids is not None and sum(matched.values()) < len(set(request.order_ids)):
+            existing = {order_id for (order_id,) in db.query(OrderDB.id).filter(OrderDB.id.in_(request.order_ids))}
+            not_found = sorted(set(request.order_ids) - existing)
+
+        allowed = ORDER_STATUS_TRANSITIONS[request.target]
+        updated = 0
+        if allowed:
+            updated = db.query(OrderDB).filter(*filters, OrderDB.status.in_(allowed)).update(
+                {"status": request.target, "row_version": row_version(db)}, synchronize_session=False)
+            db.commit()
+
+        skipped = {status.value if status else "none": count for status, count in matched.items()
+                   if status not in allowed}
+        return OrderStatusBulkResponse(target=request.target, matched=sum(matched.values()), updated=updated,
+                                       skipped=skipped, not_found=not_found)
+
+
     def delete(self, db: Session, order_id: int) -> Optional[OrderResponse]:
         """
         Delete a specific order by id.
@@ -306,6 +577,9 @@ class OrderRepository:
                             ) for item in db_order.order_items
                 ]
             )
+            self.sales_rollup_repo.apply_order(
+                db, db_order.pharmacy_id, order_day(db_order.order_date),
+                [(item.medication_id, item.quantity, item.price) for item in db_order.order_items], sign=-1)
             db.delete(db_order)
             db.commit()
             return response
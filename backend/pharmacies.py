@@ -1,7 +1,13 @@
 from typing import List, Optional
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 from fastapi import HTTPException
-from models import PharmacyRequest, Pharmacy, PharmacyDB
+from models import PharmacyRequest, Pharmacy, PharmacyDB, MedicationDB, NearestPharmacyResponse
+from pharmacy_index import pharmacy_location_index
+
+
+#Columns of the tabular (Arrow / Parquet) responses, in the Pharmacy model order
+PHARMACY_TABLE_FIELDS = list(Pharmacy.model_fields)
 
 
 class PharmacyRepository:
@@ -34,7 +40,13 @@ class PharmacyRepository:
 
         db_pharmacy = PharmacyDB(**pharmacy_request.model_dump())
         db.add(db_pharmacy)
-        db.commit()
+        try:
+            db.commit()
+        except IntegrityError:
+            #Same name and address (unique constraint)
+            db.rollback()
+            raise HTTPException(status_code=400, detail="Pharmacy already exists.")
+        pharmacy_location_index.invalidate()
         db.refresh(db_pharmacy)
         return Pharmacy.model_validate(db_pharmacy)
 
@@ -46,6 +58,13 @@ class PharmacyRepository:
         return [Pharmacy.model_validate(pharmacy) for pharmacy in db.query(PharmacyDB).all()]
 
 
+    def get_rows(self, db: Session) -> List[tuple]:
+        """
+        All pharmacies as plain row tuples with the PHARMACY_TABLE_FIELDS columns (no ORM objects).
+        """
+        return db.query(*[getattr(PharmacyDB, column) for column in PHARMACY_TABLE_FIELDS]).all()
+
+
     def get_by_id(self, db: Session, pharmacy_id: int) -> Optional[Pharmacy]:
         """
         Retrieve a pharmacy by id.
@@ -65,9 +84,11 @@ class PharmacyRepository:
             raise HTTPException(status_code=400, detail="Pharmacy already exists.")
 
         if db_pharmacy:
-            for key, value in pharmacy_request.model_dump().items():
+            #Fields not sent are kept (e.g. the location of a client that does not know it)
+            for key, value in pharmacy_request.model_dump(exclude_unset=True).items():
                 setattr(db_pharmacy, key, value)
             db.commit()
+            pharmacy_location_index.invalidate()
             db.refresh(db_pharmacy)
             return Pharmacy.model_validate(db_pharmacy)
 
@@ -81,5 +102,34 @@ class PharmacyRepository:
         if db_pharmacy:
             db.delete(db_pharmacy)
             db.commit()
+            pharmacy_location_index.invalidate()
             return Pharmacy.model_validate(db_pharmacy)
         return None
+
+
+    def nearest_with_medication(self, db: Session, medication_name: str, lat: float, lon: float,
+                                k: int = 5) -> List[NearestPharmacyResponse]:
+        """
+        The k nearest pharmacies holding the medication (pharmacy stock above 0), nearest first.
+        """
+        holders = {pharma_id: (medication_id, quantity) for medication_id, pharma_id, quantity in
+                   db.query(MedicationDB.id, MedicationDB.pharma_id, MedicationDB.quantity).filter(
+                       MedicationDB.name == medication_name, MedicationDB.quantity > 0)}
+        nearest = pharmacy_location_index.nearest(db, lat, lon, k, holders.keys())
+        if not nearest:
+            return []
+
+        pharmacies = {pharmacy.id: pharmacy for pharmacy in
+                      db.query(PharmacyDB).filter(PharmacyDB.id.in_([pharmacy_id for pharmacy_id, _ in nearest]))}
+        return [
+            NearestPharmacyResponse(
+                pharmacy_id=pharmacy_id,
+                name=pharmacies[pharmacy_id].name,
+                address=pharmacies[pharmacy_id].address,
+                latitude=pharmacies[pharmacy_id].latitude,
+                longitude=pharmacies[pharmacy_id].longitude,
+                distance_km=round(distance, 3),
+                medication_id=holders[pharmacy_id][0],
+                quantity=holders[pharmacy_id][1]
+            ) for pharmacy_id, distance in nearest if pharmacy_id in pharmacies
+        ]
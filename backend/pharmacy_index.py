@@ -0,0 +1,112 @@
+"""
+In-memory spatial index of the pharmacy locations (nearest pharmacies holding a medication)
+
+The pharmacies with coordinates are kept in a ball tree with the haversine metric, so a k nearest lookup is
+O(k log n) instead of a scan of all the pharmacies. Only some pharmacies hold a medication: the tree is asked for
+k, 2k, 4k... neighbours until k of them hold it; when few pharmacies hold it, their distances are computed directly.
+Pharmacy writes invalidate the index and it is rebuilt on the next lookup. The writes of the other API processes are
+detected with the pharmacies change counter (table_versions.py): a lookup reads it first (one small query) and
+rebuilds the index when it differs from the counter the index was built from.
+"""
+from threading import Lock
+from typing import Collection, List, Tuple
+from sqlalchemy.orm import Session
+from sklearn.neighbors import BallTree
+from models import PharmacyDB
+from table_versions import TableVersionRepository
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0088
+DIRECT_MAX_CANDIDATES = 64   #Up to this many holders the distances are computed without the tree
+
+
+def haversine_km(points: np.ndarray, lat: float, lon: float) -> np.ndarray:
+    """
+    Distances in km from (lat, lon) to the points (radians, [lat, lon] rows).
+    """
+    lat, lon = np.radians(lat), np.radians(lon)
+    a = (np.sin((points[:, 0] - lat) / 2) ** 2
+         + np.cos(lat) * np.cos(points[:, 0]) * np.sin((points[:, 1] - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class PharmacyLocationIndex:
+    """
+    Ball tree of the pharmacy locations
+    """
+    def __init__(self):
+        self._tree = None
+        self._ids = np.array([], dtype=np.int64)     #Pharmacy ids, same order as the tree points
+        self._points = np.empty((0, 2))               #[lat, lon] in radians
+        self._positions = {}                          #Pharmacy id -> point index
+        self._version = None                          #Pharmacies change counter of the build
+        self._stale = True
+        self._lock = Lock()
+
+
+    def invalidate(self):
+        """
+        Mark the index as stale after a pharmacy write.
+        """
+        self._stale = True
+
+
+    @staticmethod
+    def pharmacies_version(db: Session) -> int:
+        """
+        Current change counter of the pharmacies table.
+        """
+        return TableVersionRepository.get_versions(db).get("pharmacies", 0)
+
+
+    def refresh(self, db: Session, version: int):
+        """
+        Rebuild the index from the pharmacy locations in the DB (version: counter read before the rows).
+        """
+        with self._lock:
+            self._stale = False
+            self._version = version
+            rows = db.query(PharmacyDB.id, PharmacyDB.latitude, PharmacyDB.longitude).filter(
+                PharmacyDB.latitude.isnot(None), PharmacyDB.longitude.isnot(None)).all()
+            ids = np.array([pharmacy_id for pharmacy_id, _, _ in rows], dtype=np.int64)
+            points = np.radians(np.array([[lat, lon] for _, lat, lon in rows], dtype=np.float64).reshape(-1, 2))
+            tree = BallTree(points, metric="haversine") if len(rows) else None
+            #Swap everything at once, readers never see a half built index
+            self._tree, self._ids, self._points, self._positions = (
+                tree, ids, points, {int(pharmacy_id): i for i, pharmacy_id in enumerate(ids)})
+
+
+    def nearest(self, db: Session, lat: float, lon: float, k: int,
+                candidates: Collection[int]) -> List[Tuple[int, float]]:
+        """
+        (pharmacy id, distance in km) of the k nearest candidate pharmacies, nearest first.
+        """
+        version = self.pharmacies_version(db)
+        if self._stale or version != self._version:
+            self.refresh(db, version)
+
+        tree, ids, points, positions = self._tree, self._ids, self._points, self._positions
+        if tree is None or not candidates:
+            return []
+
+        if len(candidates) <= DIRECT_MAX_CANDIDATES:
+            indices = np.array([positions[pharmacy_id] for pharmacy_id in candidates if pharmacy_id in positions],
+                               dtype=np.int64)
+            distances = haversine_km(points[indices], lat, lon)
+            order = np.argsort(distances)[:k]
+            return [(int(ids[indices[i]]), float(distances[i])) for i in order]
+
+        point = np.radians([[lat, lon]])
+        count = k
+        while True:
+            count = min(count, len(ids))
+            distances, indices = tree.query(point, k=count)
+            found = [(int(ids[i]), float(distance) * EARTH_RADIUS_KM)
+                     for distance, i in zip(distances[0], indices[0]) if int(ids[i]) in candidates]
+            if len(found) >= k or count == len(ids):
+                return found[:k]
+            count *= 2
+
+
+pharmacy_location_index = PharmacyLocationIndex()
@@ -0,0 +1,166 @@
+"""
+Inter-pharmacy stock rebalancing
+
+Every medication is listed once per pharmacy with the pharmacy stock (quantity). The daily demand of each row is read
+from the daily sales rollup over a window; a pharmacy needs units up to cover_days of its demand and has a surplus
+above it. For all the medications at once, the surplus is matched with the needs of the other pharmacies holding the
+same medication, the largest surplus feeding the largest need first, which keeps the number of transfers low.
+Every transfer is treated as costing the same, so the min-cost flow reduces to this matching. The pharmacy locations
+(nearest pharmacy lookups) are not used to weight the transfers by distance.
+It is vectorized in NumPy (sort + searchsorted over all the rows), O(n log n) in the number of medication rows.
+
+In terminal: python rebalancing.py --window-days 90 --cover-days 30
+"""
+from datetime import date, timedelta
+from typing import Tuple
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from models import MedicationDB, DailyMedicationSalesDB, StockTransferRecommendation, RebalanceResponse
+import numpy as np
+import logging
+import time
+
+
+DEFAULT_WINDOW_DAYS = 90
+DEFAULT_COVER_DAYS = 30
+
+
+def get_positions(db: Session, window_days: int):
+    """
+    (id, name, pharmacy id, pharmacy stock, quantity sold in the window) of every medication row, in one query.
+    """
+    since = date.today() - timedelta(days=window_days)
+    sold = (
+        select(DailyMedicationSalesDB.medication_id, func.sum(DailyMedicationSalesDB.quantity).label("quantity"))
+        .where(DailyMedicationSalesDB.day >= since)
+        .group_by(DailyMedicationSalesDB.medication_id)
+        .subquery()
+    )
+    return db.execute(
+        select(MedicationDB.id, MedicationDB.name, MedicationDB.pharma_id, func.coalesce(MedicationDB.quantity, 0),
+               func.coalesce(sold.c.quantity, 0))
+        .outerjoin(sold, sold.c.medication_id == MedicationDB.id)
+        .where(MedicationDB.name.isnot(None), MedicationDB.pharma_id.isnot(None))
+    ).all()
+
+
+def _intervals(group: np.ndarray, amount: np.ndarray, moved: np.ndarray,
+               offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rows with an amount, sorted by group and amount (largest first), and the end of the interval of each row on a
+    line where group g covers [offsets[g], offsets[g] + moved[g]).
+    """
+    rows = np.flatnonzero(amount > 0)
+    rows = rows[np.lexsort((-amount[rows], group[rows]))]
+    groups = group[rows]
+    ends = np.cumsum(amount[rows])
+
+    #Cumulative amount of the previous groups, subtracted to restart the sum in each group
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = groups[1:] != groups[:-1]
+    group_base = np.maximum.accumulate(np.where(first, ends - amount[rows], 0))
+
+    return rows, offsets[groups] + np.minimum(ends - group_base, moved[groups])
+
+
+def match_transfers(group: np.ndarray, surplus: np.ndarray,
+                    need: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Match the surplus rows with the need rows of the same group, largest first.
+    Return the (surplus row, need row, quantity) arrays.
+    """
+    empty = np.array([], dtype=np.int64)
+    if not len(group):
+        return empty, empty, empty
+
+    groups = group.max() + 1
+    moved = np.minimum(np.bincount(group, surplus, groups), np.bincount(group, need, groups)).astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(moved)[:-1]))
+
+    supplier_rows, supplier_ends = _intervals(group, surplus, moved, offsets)
+    receiver_rows, receiver_ends = _intervals(group, need, moved, offsets)
+
+    #Every segment between two interval ends is one (supplier, receiver) pair
+    points = np.union1d(supplier_ends, receiver_ends)
+    if not len(points):
+        return empty, empty, empty
+    starts = np.concatenate(([0], points[:-1]))
+    lengths = points - starts
+    starts, lengths = starts[lengths > 0], lengths[lengths > 0]
+
+    suppliers = supplier_rows[np.searchsorted(supplier_ends, starts, side="right")]
+    receivers = receiver_rows[np.searchsorted(receiver_ends, starts, side="right")]
+    return suppliers, receivers, lengths
+
+
+def plan_transfers(db: Session, window_days: int = DEFAULT_WINDOW_DAYS, cover_days: int = DEFAULT_COVER_DAYS,
+                   min_quantity: int = 1) -> RebalanceResponse:
+    """
+    Transfer recommendations for all the medications. Transfers below min_quantity are left out.
+    """
+    started = time.monotonic()
+    positions = get_positions(db, window_days)
+
+    ids = np.array([row[0] for row in positions], dtype=np.int64)
+    names = np.array([row[1] for row in positions], dtype=object)
+    pharmacy_ids = np.array([row[2] for row in positions], dtype=np.int64)
+    quantities = np.array([row[3] for row in positions], dtype=np.int64)
+    sold = np.array([row[4] for row in positions], dtype=np.float64)
+
+    medication_names, group = (np.unique(names, return_inverse=True) if len(names)
+                               else (names, np.array([], dtype=np.int64)))
+    daily_demand = sold / window_days
+    target = np.ceil(daily_demand * cover_days).astype(np.int64)
+    surplus = np.maximum(quantities - target, 0)
+    need = np.maximum(target - np.maximum(quantities, 0), 0)
+
+    suppliers, receivers, amounts = match_transfers(group, surplus, need)
+    keep = amounts >= min_quantity
+    suppliers, receivers, amounts = suppliers[keep], receivers[keep], amounts[keep]
+
+    order = np.lexsort((-amounts, group[suppliers]))
+    transfers = [
+        StockTransferRecommendation(
+            medication_name=names[s],
+            from_pharmacy_id=int(pharmacy_ids[s]),
+            to_pharmacy_id=int(pharmacy_ids[r]),
+            from_medication_id=int(ids[s]),
+            to_medication_id=int(ids[r]),
+            quantity=int(amount),
+            from_quantity=int(quantities[s]),
+            to_quantity=int(quantities[r]),
+            to_daily_demand=round(float(daily_demand[r]), 3)
+        ) for s, r, amount in zip(suppliers[order], receivers[order], amounts[order])
+    ]
+
+    duration = time.monotonic() - started
+    logging.info(f"Rebalancing: {len(positions)} rows, {len(transfers)} transfers in {duration:.1f}s")
+
+    return RebalanceResponse(
+        medications=len(medication_names),
+        rows=len(positions),
+        transferred_quantity=int(amounts.sum()),
+        unmet_need=int(need.sum() - amounts.sum()),
+        transfers=transfers,
+        duration_seconds=round(duration, 3)
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    from database import SessionLocal, engine
+    import models
+
+    parser = argparse.ArgumentParser(description="Recommend stock transfers between the pharmacies.")
+    parser.add_argument("--window-days", type=int, default=DEFAULT_WINDOW_DAYS, help="Demand window in days")
+    parser.add_argument("--cover-days", type=int, default=DEFAULT_COVER_DAYS, help="Days of demand to cover")
+    parser.add_argument("--min-quantity", type=int, default=1, help="Smallest transfer")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    models.Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        print(plan_transfers(session, args.window_days, args.cover_days, args.min_quantity).model_dump_json(indent=2))
+    finally:
+        session.close()
@@ -0,0 +1,235 @@
+"""
+Automatic reorder planner
+
+Evaluates every medication from the DB, forecasts its demand and stores a purchase order proposal for each
+medication whose current stock is below the reorder point (predicted demand + safety stock).
+The proposals can be listed, approved or rejected through the API.
+
+Run nightly (e.g. from cron), in terminal: python reorder_planner.py
+"""
+from typing import List, Optional
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from models import (MedicationDB, ReorderProposalDB, ReorderProposalResponse, ReorderRunResponse,
+                    ProposalStatus)
+from stock_forecast import get_medication_features, forecast_stock
+from forecast_accuracy import ForecastAccuracyRepository
+from threading import Lock
+import multiprocessing
+import atexit
+import logging
+import time
+
+
+DEFAULT_TIME_BUDGET = 600   #seconds
+DEFAULT_WORKERS = 4
+MAX_TIME_BUDGET = 3600
+MAX_WORKERS = 16
+
+forecast_accuracy_repo = ForecastAccuracyRepository()
+
+
+class ForecastPool:
+    """
+    Worker processes of the forecasts, kept between the planner runs (spawning them takes seconds).
+    One run at a time uses the pool; a pool left with forecasts over the time budget is terminated and the next run
+    starts a new one.
+    """
+    def __init__(self):
+        self._pool = None
+        self._workers = 0
+        self.lock = Lock()
+
+
+    def get(self, workers: int):
+        """
+        Pool with the number of workers, reused when it has the same size (call with the lock held).
+        """
+        if self._pool is not None and self._workers != workers:
+            self.discard()
+        if self._pool is None:
+            self._pool = multiprocessing.get_context("spawn").Pool(processes=workers)
+            self._workers = workers
+        return self._pool
+
+
+    def discard(self):
+        """
+        Terminate the pool (forecasts still running are stopped).
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+forecast_pool = ForecastPool()
+atexit.register(forecast_pool.discard)
+
+
+class ReorderProposalRepository:
+    """
+    Repo for managing the reorder proposals from DB.
+    """
+    def get_all(self, db: Session, status: Optional[ProposalStatus] = None) -> List[ReorderProposalResponse]:
+        """
+        Retrieve all reorder proposals, optionally filtered by status.
+        """
+        query = db.query(ReorderProposalDB)
+        if status is not None:
+            query = query.filter(ReorderProposalDB.status == status)
+        return [ReorderProposalResponse.model_validate(proposal)
+                for proposal in query.order_by(ReorderProposalDB.created_at.desc()).all()]
+
+
+    def set_status(self, db: Session, proposal_id: int,
+                   new_status: ProposalStatus) -> Optional[ReorderProposalResponse]:
+        """
+        Approve or reject a proposal. Only proposals that are still open can change their status.
+        """
+        db_proposal = db.query(ReorderProposalDB).filter(ReorderProposalDB.id == proposal_id).first()
+        if not db_proposal:
+            return None
+
+        if db_proposal.status != ProposalStatus.proposed:
+            raise ValueError(f"Proposal {proposal_id} is already {db_proposal.status.value}.")
+
+        db_proposal.status = new_status
+        db.commit()
+        db.refresh(db_proposal)
+        return ReorderProposalResponse.model_validate(db_proposal)
+
+
+def get_stock_summary(db: Session):
+    """
+    Stock per medication name in a single grouped query.
+    Central stock is the same for all the rows with the same name, the pharmacy stock is summed.
+    """
+    return (
+        db.query(
+            MedicationDB.name,
+            func.min(MedicationDB.id),
+            func.max(MedicationDB.stock),
+            func.sum(MedicationDB.quantity)
+        )
+        .group_by(MedicationDB.name)
+        .all()
+    )
+
+
+def run_reorder_planner(db: Session, csv_path: str, time_budget: float = DEFAULT_TIME_BUDGET,
+                        max_workers: int = DEFAULT_WORKERS) -> ReorderRunResponse:
+    """
+    Evaluate all medications in parallel and store the proposals for the ones below the reorder point.
+
+    The features of every medication are prepared once from the grouped dataset and each forecast runs in a worker
+    process of the shared pool with its own slice, while the next features are prepared. The time budget covers both:
+    medications not prepared or forecasts not finished when it runs out are skipped and reported by name, and the
+    pool is terminated if forecasts are still running, so nothing keeps running after the run.
+    Only the open proposals of the evaluated medications are replaced, approved/rejected ones are kept.
+    """
+    started = time.monotonic()
+    deadline = started + time_budget
+    if not forecast_pool.lock.acquire(timeout=time_budget):
+        raise RuntimeError("Another reorder planner run is in progress.")
+
+    forecasts = {}
+    skipped = []
+    timed_out = False
+    try:
+        stock_summary = get_stock_summary(db)
+        pool = forecast_pool.get(max_workers)
+        pending = {}
+        for name, medication_id, central_stock, pharmacy_stock in stock_summary:
+            if time.monotonic() >= deadline:
+                skipped.append(name)   #Budget spent before its features were prepared
+                continue
+            df_agg = get_medication_features(csv_path, medication_id)
+            if df_agg.empty:
+                forecasts[name] = (medication_id, None)   #No history, nothing to propose
+                continue
+            pending[name] = (medication_id, pool.apply_async(
+                forecast_stock, (df_agg, name, central_stock or 0, pharmacy_stock or 0)))
+
+        for name, (medication_id, result) in pending.items():
+            try:
+                forecasts[name] = (medication_id, result.get(timeout=max(0.0, deadline - time.monotonic())))
+            except multiprocessing.TimeoutError:
+                skipped.append(name)
+                timed_out = True
+            except Exception as e:
+                logging.error(f"Reorder planner failed for {name}: {e}")
+                skipped.append(name)
+    except BaseException:
+        timed_out = True   #The pool state is unknown, start a new one
+        raise
+    finally:
+        #Stop the forecasts that exceeded the budget
+        if timed_out:
+            forecast_pool.discard()
+        forecast_pool.lock.release()
+
+    skipped.sort()
+    proposals = []
+    for name, (medication_id, forecast) in forecasts.items():
+        if forecast is None:
+            continue
+
+        forecast_accuracy_repo.record_forecast(db, name, forecast["predicted_monthly_demand"], commit=False)
+
+        if forecast["recommended_order_quantity"] <= 0:
+            continue
+
+        proposals.append(ReorderProposalDB(
+            medication_id=medication_id,
+            medication_name=name,
+            current_stock=int(forecast["total_current_stock"]),
+            predicted_demand=forecast["predicted_monthly_demand"],
+            safety_stock=forecast["safety_stock"],
+            reorder_point=forecast["reorder_point"],
+            recommended_quantity=forecast["recommended_order_quantity"],
+            status=ProposalStatus.proposed
+        ))
+
+    #Close the windows of the medications without a new forecast, same transaction
+    forecast_accuracy_repo.close_ended_windows(db, commit=False)
+
+    #Replace the open proposals of the evaluated medications in one transaction (the skipped ones keep theirs)
+    if forecasts:
+        db.query(ReorderProposalDB).filter(
+            ReorderProposalDB.status == ProposalStatus.proposed,
+            ReorderProposalDB.medication_name.in_(list(forecasts))
+        ).delete(synchronize_session=False)
+    db.add_all(proposals)
+    db.commit()
+
+    duration = time.monotonic() - started
+    logging.info(f"Reorder planner: {len(forecasts)} evaluated, {len(proposals)} proposed, "
+                 f"{len(skipped)} skipped in {duration:.1f}s")
+
+    return ReorderRunResponse(
+        evaluated=len(forecasts),
+        proposed=len(proposals),
+        skipped=skipped,
+        duration_seconds=round(duration, 3)
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    from database import SessionLocal, engine
+    import models
+
+    parser = argparse.ArgumentParser(description="Generate reorder proposals for all medications.")
+    parser.add_argument("--csv", default="medication_orders_data.csv", help="Historical orders dataset")
+    parser.add_argument("--time-budget", type=float, default=DEFAULT_TIME_BUDGET, help="Time budget in seconds")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Parallel forecasts")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    models.Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        print(run_reorder_planner(session, args.csv, args.time_budget, args.workers).model_dump_json(indent=2))
+    finally:
+        session.close()
@@ -0,0 +1,214 @@
+"""
+Daily sales rollups
+
+The order writes keep two rollup tables up to date in the same transaction:
+-> daily_medication_sales: quantity, revenue and order count per day, medication and pharmacy
+-> daily_pharmacy_sales: quantity, revenue and order count per day and pharmacy
+The analytics read the rollups, so their cost depends on the number of days and not on the number of order items.
+
+To rebuild the rollups from the orders, in terminal: python sales_rollup.py
+"""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+from sqlalchemy import func, select, insert
+from sqlalchemy.orm import Session
+from models import (OrderDB, OrderItemDB, DailyMedicationSalesDB, DailyPharmacySalesDB, SalesBucketResponse)
+
+
+BUCKETS = ["day", "week", "month"]
+
+#Columns of the tabular (Arrow / Parquet) responses, in the SalesBucketResponse model order
+SALES_FIELDS = list(SalesBucketResponse.model_fields)
+
+
+def order_day(order_date: Optional[datetime]) -> date:
+    """
+    Rollup day of an order (the order date is set on insert).
+    """
+    return (order_date or datetime.utcnow()).date()
+
+
+def bucket_start(day: date, bucket: str) -> date:
+    """
+    First day of the bucket that contains the day.
+    """
+    if bucket == "week":
+        return day - timedelta(days=day.weekday())
+    if bucket == "month":
+        return day.replace(day=1)
+    return day
+
+
+class SalesRollupRepository:
+    """
+    Repo for managing the sales rollups from DB.
+    """
+    def apply_order(self, db: Session, pharmacy_id: int, day: date,
+                    items: Iterable[Tuple[int, int, float]], sign: int = 1):
+        """
+        Add (sign=1) or remove (sign=-1) an order from the rollups.
+        items: (medication_id, quantity, price) of the order items.
+        Runs inside the order transaction, the caller commits.
+        """
+        self.apply_orders(db, day, [(pharmacy_id, items)], sign)
+
+
+    def apply_orders(self, db: Session, day: date,
+                     orders: Iterable[Tuple[int, Iterable[Tuple[int, int, float]]]], sign: int = 1):
+        """
+        Add (sign=1) or remove (sign=-1) several orders of the same day from the rollups.
+        orders: (pharmacy_id, items) pairs, items as in apply_order.
+        Every rollup row is read and updated once, whatever the number of orders.
+        """
+        #(medication_id, pharmacy_id) / pharmacy_id -> [quantity, revenue, order count]
+        per_medication = defaultdict(lambda: [0, 0.0, 0])
+        per_pharmacy = defaultdict(lambda: [0, 0.0, 0])
+
+        for pharmacy_id, items in orders:
+            #Merge the items of the same medication, an order counts once per medication
+            order_medications = set()
+            order_quantity, order_revenue = 0, 0.0
+            for medication_id, quantity, price in items:
+                totals = per_medication[(medication_id, pharmacy_id)]
+                totals[0] += quantity
+                totals[1] += quantity * price
+                if medication_id not in order_medications:
+                    totals[2] += 1
+                    order_medications.add(medication_id)
+                order_quantity += quantity
+                order_revenue += quantity * price
+
+            if order_medications:
+                totals = per_pharmacy[pharmacy_id]
+                totals[0] += order_quantity
+                totals[1] += order_revenue
+                totals[2] += 1
+
+        if not per_pharmacy:
+            return
+
+        for (medication_id, pharmacy_id), (quantity, revenue, order_count) in per_medication.items():
+            row = db.get(DailyMedicationSalesDB, (day, medication_id, pharmacy_id))
+            if row is None:
+                row = DailyMedicationSalesDB(day=day, medication_id=medication_id, pharmacy_id=pharmacy_id,
+                                             quantity=0, revenue=0, order_count=0)
+                db.add(row)
+            self.increment(db, row, sign * quantity, sign * revenue, sign * order_count)
+
+        for pharmacy_id, (quantity, revenue, order_count) in per_pharmacy.items():
+            row = db.get(DailyPharmacySalesDB, (day, pharmacy_id))
+            if row is None:
+                row = DailyPharmacySalesDB(day=day, pharmacy_id=pharmacy_id, quantity=0, revenue=0, order_count=0)
+                db.add(row)
+            self.increment(db, row, sign * quantity, sign * revenue, sign * order_count)
+
+        #New rows must be visible to the next lookup of the same key
+        db.flush()
+
+
+    @staticmethod
+    def increment(db: Session, row, quantity: int, revenue: float, order_count: int):
+        """
+        Update a rollup row, rows without orders are removed.
+        """
+        row.quantity += quantity
+        row.revenue += revenue
+        row.order_count += order_count
+        if row.order_count <= 0:
+            if row in db.new:
+                db.expunge(row)
+            else:
+                db.delete(row)
+
+
+    def rebuild(self, db: Session):
+        """
+        Recompute both rollups from the orders with two INSERT ... SELECT statements.
+        """
+        day = func.date(OrderDB.order_date)
+
+        db.query(DailyMedicationSalesDB).delete(synchronize_session=False)
+        db.query(DailyPharmacySalesDB).delete(synchronize_session=False)
+
+        db.execute(insert(DailyMedicationSalesDB).from_select(
+            ["day", "medication_id", "pharmacy_id", "quantity", "revenue", "order_count"],
+            select(day, OrderItemDB.medication_id, OrderDB.pharmacy_id,
+                   func.sum(OrderItemDB.quantity),
+                   func.sum(OrderItemDB.quantity * OrderItemDB.price),
+                   func.count(func.distinct(OrderDB.id)))
+            .join(OrderDB, OrderItemDB.order_id == OrderDB.id)
+            .group_by(day, OrderItemDB.medication_id, OrderDB.pharmacy_id)
+        ))
+
+        db.execute(insert(DailyPharmacySalesDB).from_select(
+            ["day", "pharmacy_id", "quantity", "revenue", "order_count"],
+            select(day, OrderDB.pharmacy_id,
+                   func.sum(OrderItemDB.quantity),
+                   func.sum(OrderItemDB.quantity * OrderItemDB.price),
+                   func.count(func.distinct(OrderDB.id)))
+            .join(OrderDB, OrderItemDB.order_id == OrderDB.id)
+            .group_by(day, OrderDB.pharmacy_id)
+        ))
+
+        db.commit()
+
+
+    def sales(self, db: Session, bucket: str = "day", date_from: Optional[date] = None,
+              date_to: Optional[date] = None, pharmacy_id: Optional[int] = None,
+              medication_id: Optional[int] = None) -> List[SalesBucketResponse]:
+        """
+        Sales per day, week or month read from the rollups.
+        """
+        return [SalesBucketResponse(**dict(zip(SALES_FIELDS, row)))
+                for row in self.sales_rows(db, bucket, date_from, date_to, pharmacy_id, medication_id)]
+
+
+    def sales_rows(self, db: Session, bucket: str = "day", date_from: Optional[date] = None,
+                   date_to: Optional[date] = None, pharmacy_id: Optional[int] = None,
+                   medication_id: Optional[int] = None) -> List[tuple]:
+        """
+        Sales per day, week or month read from the rollups, as row tuples with the SALES_FIELDS columns.
+        With a medication the medication rollup is used, otherwise the pharmacy rollup.
+        The dates are inclusive, as in the order search.
+        """
+        if bucket not in BUCKETS:
+            raise ValueError(f"Invalid bucket {bucket}. See allowed buckets: {BUCKETS}.")
+
+        rollup = DailyMedicationSalesDB if medication_id is not None else DailyPharmacySalesDB
+        query = db.query(rollup.day, func.sum(rollup.quantity), func.sum(rollup.revenue),
+                         func.sum(rollup.order_count))
+
+        if medication_id is not None:
+            query = query.filter(rollup.medication_id == medication_id)
+        if pharmacy_id is not None:
+            query = query.filter(rollup.pharmacy_id == pharmacy_id)
+        if date_from is not None:
+            query = query.filter(rollup.day >= date_from)
+        if date_to is not None:
+            query = query.filter(rollup.day <= date_to)
+
+        #One row per day, bucketed here
+        buckets = {}
+        for day, quantity, revenue, order_count in query.group_by(rollup.day).order_by(rollup.day):
+            start = bucket_start(day, bucket)
+            totals = buckets.setdefault(start, [0, 0.0, 0])
+            totals[0] += quantity or 0
+            totals[1] += revenue or 0
+            totals[2] += order_count or 0
+
+        return [(start, quantity, round(revenue, 2), order_count)
+                for start, (quantity, revenue, order_count) in buckets.items()]
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, engine
+    import models
+
+    models.Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        SalesRollupRepository().rebuild(session)
+        print("Sales rollups rebuilt.")
+    finally:
+        session.close()
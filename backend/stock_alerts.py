@@ -0,0 +1,98 @@
+"""
+Low stock alerts
+
+The stock write paths read and lock the rows to change (stock and level before the change), then change the stock
+with a single UPDATE ... RETURNING that returns the new stock and level, so a level change (e.g. medium -> low) is
+detected without reading the rows again. Both levels are read from the generated stock_level column, so the alerts
+always agree with the stored levels (the thresholds are the ones of the column DDL). Every change is appended to the stock_alerts table; consumers poll GET /alerts?since=<last id>.
+The new stock of every updated row is also recorded for the live stock events (stock_events.py), and the change
+for the stock ledger (stock_ledger.py) when a reason is given.
+RETURNING needs PostgreSQL or SQLite >= 3.35.
+"""
+from typing import List, Optional
+from sqlalchemy import and_, insert, select, update
+from sqlalchemy.orm import Session
+from models import MedicationDB, StockAlertDB, StockAlertResponse
+from stock_events import record_stock_events
+from sync import row_version
+from stock_ledger import record_ledger
+
+
+class StockAlertRepository:
+    """
+    Repo for the stock changes and the stock level alerts.
+    """
+    def change_stock(self, db: Session, where, delta, reason: Optional[str] = None,
+                     order_id: Optional[int] = None) -> List[tuple]:
+        """
+        Add delta (int or SQL expression, negative to decrease) to the stock of the medications matching where.
+        """
+        return self.update_stock(db, where, MedicationDB.stock + delta, reason, order_id)
+
+
+    def set_stock(self, db: Session, where, stock, reason: Optional[str] = None,
+                  order_id: Optional[int] = None) -> List[tuple]:
+        """
+        Set the stock of the medications matching where to an absolute value (int or SQL expression), the rows already
+        at it are not written.
+        """
+        return self.update_stock(db, and_(where, MedicationDB.stock != stock), stock, reason, order_id)
+
+
+    @staticmethod
+    def update_stock(db: Session, where, new_stock, reason: Optional[str] = None,
+                     order_id: Optional[int] = None) -> List[tuple]:
+        """
+        Set the stock of the medications matching where to new_stock (SQL expression or value) in one UPDATE.
+        The rows are read and locked first, so the change of every row is exact even when the rows with the same name
+        do not have the same stock.
+        An alert is added for every row whose stock level changed. With a reason the change of every row is added to
+        the ledger, otherwise the caller records it.
+        Return the updated (id, name, pharma_id, stock, old level, new level, old stock) rows (the caller commits).
+        """
+        old = {medication_id: (stock, level) for medication_id, stock, level in db.execute(
+            select(MedicationDB.id, MedicationDB.stock, MedicationDB.stock_level)
+            .where(where).with_for_update()
+        )}
+        if not old:
+            return []
+
+        rows = [
+            (medication_id, name, pharma_id, stock, old[medication_id][1], new_level, old[medication_id][0])
+            for medication_id, name, pharma_id, stock, new_level in db.execute(
+                update(MedicationDB)
+                .where(MedicationDB.id.in_(list(old)))
+                .values(stock=new_stock, row_version=row_version(db))
+                .returning(MedicationDB.id, MedicationDB.name, MedicationDB.pharma_id, MedicationDB.stock,
+                           MedicationDB.stock_level)
+            )
+        ]
+        record_stock_events(db, [(medication_id, stock, new_level)
+                                 for medication_id, _, _, stock, _, new_level, _ in rows])
+
+        alerts = [
+            {"medication_id": medication_id, "medication_name": name, "pharma_id": pharma_id, "stock": stock,
+             "old_level": old_level, "new_level": new_level}
+            for medication_id, name, pharma_id, stock, old_level, new_level, _ in rows if old_level != new_level
+        ]
+        if alerts:
+            db.execute(insert(StockAlertDB), alerts)
+        if reason is not None:
+            record_ledger(db, [(medication_id, stock - old_stock, reason, order_id)
+                               for medication_id, _, _, stock, _, _, old_stock in rows])
+        return rows
+
+
+    @staticmethod
+    def get_since(db: Session, since: Optional[int] = None, limit: int = 100,
+                  level: Optional[str] = None) -> List[StockAlertResponse]:
+        """
+        Alerts after the cursor (alert id), oldest first.
+        """
+        query = db.query(StockAlertDB)
+        if since is not None:
+            query = query.filter(StockAlertDB.id > since)
+        if level:
+            query = query.filter(StockAlertDB.new_level == level)
+        alerts = query.order_by(StockAlertDB.id).limit(limit).all()
+        return [StockAlertResponse.model_validate(alert) for alert in alerts]
@@ -0,0 +1,187 @@
+"""
+Live stock changes for the dashboards (GET /events/stock, Server-Sent Events)
+
+The write paths record compact deltas ({"medication_id", "stock", "stock_level"}) in the DB session, and they are
+published when the transaction commits (dropped on rollback). Every SSE client has a bounded queue: a client that
+cannot keep up loses its queued deltas and receives a "resync" event instead, so it reloads the table once.
+With STOCK_EVENTS_NOTIFY=1 (PostgreSQL) the deltas are sent with NOTIFY in the committing transaction and every
+worker process publishes what it receives with LISTEN, so the clients of all workers get all the changes.
+"""
+from threading import Lock, Thread
+from typing import AsyncIterator, Iterable, List
+from sqlalchemy import func, select
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from database import engine
+import asyncio
+import json
+import logging
+import os
+import select as select_io
+import time
+
+
+QUEUE_SIZE = 1000          #Deltas kept per client
+KEEPALIVE_SECONDS = 15     #Comment line sent when there are no changes (keeps proxies from closing the stream)
+NOTIFY_CHANNEL = "stock_events"
+NOTIFY_PAYLOAD_SIZE = 7000   #PostgreSQL limit is 8000 bytes per NOTIFY
+USE_NOTIFY = os.getenv("STOCK_EVENTS_NOTIFY", "0") == "1" and engine.dialect.name == "postgresql"
+
+RESYNC = {"resync": True}
+SESSION_KEY = "stock_events"
+
+
+class StockEventBroker:
+    """
+    In-process pub/sub: one bounded asyncio queue per subscriber, publish is thread safe.
+    """
+    def __init__(self, queue_size: int = QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}   #queue -> event loop of the subscriber
+        self._lock = Lock()
+
+
+    def subscribe(self) -> asyncio.Queue:
+        """
+        New subscriber queue (must be called from the event loop of the subscriber).
+        """
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers[queue] = asyncio.get_running_loop()
+        return queue
+
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers.pop(queue, None)
+
+
+    def publish(self, events: List[dict]):
+        """
+        Send the events to all the subscribers (from any thread).
+        """
+        if not events:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for queue, loop in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._put, queue, events)
+            except RuntimeError:   #Event loop closed
+                self.unsubscribe(queue)
+
+
+    @staticmethod
+    def _put(queue: asyncio.Queue, events: List[dict]):
+        """
+        Queue the events; on overflow the queued events are replaced by a resync event.
+        """
+        for event in events:
+            if queue.full():
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESYNC)
+                return
+            queue.put_nowait(event)
+
+
+stock_event_broker = StockEventBroker()
+
+
+def record_stock_events(db: Session, rows: Iterable[tuple]):
+    """
+    Record (medication id, stock, stock level) deltas, published when the session commits.
+    A None stock means the medication was deleted.
+    """
+    events = db.info.setdefault(SESSION_KEY, [])
+    for medication_id, stock, stock_level in rows:
+        event = {"medication_id": medication_id, "stock": stock, "stock_level": stock_level}
+        if stock is None:
+            event["deleted"] = True
+        events.append(event)
+
+
+@listens_for(Session, "before_commit")
+def notify_stock_events(session: Session):
+    """
+    NOTIFY the deltas in the committing transaction (delivered by PostgreSQL only if it commits).
+    """
+    if not USE_NOTIFY or not session.info.get(SESSION_KEY):
+        return
+    payloads, size = [[]], 0
+    for event in session.info.pop(SESSION_KEY):
+        encoded = json.dumps(event)
+        if size + len(encoded) > NOTIFY_PAYLOAD_SIZE and payloads[-1]:
+            payloads.append([])
+            size = 0
+        payloads[-1].append(encoded)
+        size += len(encoded) + 1
+    for payload in payloads:
+        session.execute(select(func.pg_notify(NOTIFY_CHANNEL, "[" + ",".join(payload) + "]")))
+
+
+@listens_for(Session, "after_commit")
+def publish_stock_events(session: Session):
+    events = session.info.pop(SESSION_KEY, None)
+    if events:
+        stock_event_broker.publish(events)
+
+
+@listens_for(Session, "after_rollback")
+def discard_stock_events(session: Session):
+    session.info.pop(SESSION_KEY, None)
+
+
+def listen_notifications():
+    """
+    Worker thread: publish the deltas notified by all the processes (LISTEN).
+    """
+    while True:
+        connection = None
+        try:
+            connection = engine.raw_connection()
+            driver_connection = connection.driver_connection
+            driver_connection.autocommit = True
+            driver_connection.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+            while True:
+                if select_io.select([driver_connection], [], [], KEEPALIVE_SECONDS) == ([], [], []):
+                    continue
+                driver_connection.poll()
+                while driver_connection.notifies:
+                    notification = driver_connection.notifies.pop(0)
+                    stock_event_broker.publish(json.loads(notification.payload))
+        except Exception as e:
+            logging.error(f"Stock events listener failed, reconnecting: {e}")
+            time.sleep(1)
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+def start_notify_listener():
+    """
+    Start the LISTEN thread when the NOTIFY mode is on.
+    """
+    if USE_NOTIFY:
+        Thread(target=listen_notifications, name="stock-events-listener", daemon=True).start()
+
+
+async def event_stream(is_disconnected) -> AsyncIterator[str]:
+    """
+    SSE stream of the deltas for one client; ends when the client disconnects.
+    """
+    queue = stock_event_broker.subscribe()
+    try:
+        yield "retry: 3000\n\n"
+        while not await is_disconnected():
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is RESYNC:
+                yield "event: resync\ndata: {}\n\n"
+            else:
+                yield f"event: stock\ndata: {json.dumps(event)}\n\n"
+    finally:
+        stock_event_broker.unsubscribe(queue)
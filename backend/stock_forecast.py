@@ -15,16 +15,62 @@ from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import mean_squared_error, r2_score
 from sklearn.preprocessing import StandardScaler
 from xgboost import XGBRegressor
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from models import MedicationDB
 from datetime import datetime
+from functools import lru_cache
+import os
 
 
-def prepare_data(df, medication_id):
+FEATURES = ['stock', 'quantity', 'price', 'day_of_week', 'month', 'year',
+            'demand_ma_7', 'demand_ma_30', 'season', 'trend']
+TARGET = 'quantity_ordered'
+
+
+@lru_cache(maxsize=4)
+def _read_historical_data(csv_path, modified_time):
+    """
+    Read the dataset once per file version (the modification time is part of the cache key).
+    """
+    return pd.read_csv(csv_path)
+
+
+def load_historical_data(csv_path):
+    """
+    Load the historical dataset, reusing the cached DataFrame while the file is unchanged.
+    """
+    return _read_historical_data(csv_path, os.path.getmtime(csv_path))
+
+
+@lru_cache(maxsize=4)
+def _history_by_medication(csv_path, modified_time):
+    """
+    Historical rows split by medication id in one pass (once per file version).
+    """
+    df = _read_historical_data(csv_path, modified_time)
+    return {medication_id: rows for medication_id, rows in df.groupby('id')}, df.iloc[0:0]
+
+
+@lru_cache(maxsize=1024)
+def _cached_features(csv_path, modified_time, medication_id):
+    history, no_rows = _history_by_medication(csv_path, modified_time)
+    return prepare_data(history.get(medication_id, no_rows))
+
+
+def get_medication_features(csv_path, medication_id):
+    """
+    Aggregated features for a medication, cached until the dataset changes.
+    The returned DataFrame is shared, so callers must not modify it.
+    """
+    return _cached_features(csv_path, os.path.getmtime(csv_path), medication_id)
+
+
+def prepare_data(df_med):
     """
-    Prepare and aggregate data for a specific medication.
+    Prepare and aggregate the historical rows of one medication.
     """
-    df_med = df[df['id'] == medication_id].copy()
+    df_med = df_med.copy()
     df_med['order_date'] = pd.to_datetime(df_med['order_date'])
     df_med = df_med.sort_values('order_date')
 
@@ -93,31 +139,35 @@ def predict_optimal_stock(db: Session, medication_name: str, csv_path: str):
     """
     Predict optimal stock for a specific medication
     """
-    #Fetch medication from DB
-    medications = db.query(MedicationDB).filter(MedicationDB.name == medication_name).all()
+    #Fetch medication from DB (case insensitive, served by the lower(name) index)
+    medications = db.query(MedicationDB).filter(
+        func.lower(MedicationDB.name) == medication_name.strip().lower()).all()
 
     if not medications:
         return {"error": f"{medication_name} not found in database."}
 
     current_central_stock = medications[0].stock
     current_pharmacy_stock = sum(med.quantity for med in medications)
-    total_current_stock = current_central_stock + current_pharmacy_stock
     medication_id = medications[0].id
 
     #Prepare historical data from dataset
-    historical_data = pd.read_csv(csv_path)
-    df_agg = prepare_data(historical_data, medication_id)
+    df_agg = get_medication_features(csv_path, medication_id)
 
     if df_agg.empty:
         return {"error": f"No historical data found for {medication_name} medication."}
 
-    #Define features and target
-    features = ['stock', 'quantity', 'price', 'day_of_week', 'month', 'year',
-                'demand_ma_7', 'demand_ma_30', 'season', 'trend']
-    target = 'quantity_ordered'
+    #Stored name, the lookup is case insensitive
+    return forecast_stock(df_agg, medications[0].name, current_central_stock, current_pharmacy_stock)
+
+
+def forecast_stock(df_agg, medication_name: str, current_central_stock: int, current_pharmacy_stock: int):
+    """
+    Train the models on the aggregated history of one medication and compute the recommended order.
+    """
+    total_current_stock = current_central_stock + current_pharmacy_stock
 
-    X = df_agg[features]
-    y = df_agg[target]
+    X = df_agg[FEATURES]
+    y = df_agg[TARGET]
 
     #Scale features
     scaler = StandardScaler()
@@ -158,7 +208,7 @@ def predict_optimal_stock(db: Session, medication_name: str, csv_path: str):
     })
 
     #Make forecast for next month
-    next_month_data_scaled = scaler.transform(next_month_data[features])
+    next_month_data_scaled = scaler.transform(next_month_data[FEATURES])
     rf_pred = rf_model.predict(next_month_data_scaled)
     xgb_pred = xgb_model.predict(next_month_data_scaled)
     ensemble_pred = (rf_pred + xgb_pred) / 2
@@ -196,6 +246,7 @@ def predict_optimal_stock(db: Session, medication_name: str, csv_path: str):
         "predicted_monthly_demand": int(weighted_prediction),
         "recommended_order_quantity": int(optimal_order_quantity),
         "safety_stock": int(safety_stock),
+        "reorder_point": int(weighted_prediction + safety_stock),
         "historical_comparison": {
             "one_year_ago": int(one_year_ago),
             "two_years_ago": int(two_years_ago),
@@ -0,0 +1,80 @@
+"""
+Stock history of a medication (one pharmacy row) for the charts
+
+The series is rebuilt from the stock ledger: the stock at the start of the range (snapshot + ledger tail) followed by
+the running stock after every ledger row in the range. It is downsampled with LTTB (Largest-Triangle-Three-Buckets)
+in NumPy, so the response has at most `points` points whatever the length of the history, and the peaks and drops
+of the stock are kept.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import StockLedgerDB, StockHistoryPoint, StockHistoryResponse
+from stock_ledger import StockLedgerRepository
+import numpy as np
+
+
+DEFAULT_POINTS = 500
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Indices of the points kept by LTTB; the first and the last points are always kept.
+    """
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+
+    bucket_size = (n - 2) / (points - 2)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = a = 0
+
+    for i in range(points - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        #Average of the next bucket (the last point for the last bucket)
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        avg_x = x[end:next_end].mean() if end < next_end else x[-1]
+        avg_y = y[end:next_end].mean() if end < next_end else y[-1]
+
+        #Point of the bucket forming the largest triangle with the previous selected point and the next average
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+
+    selected[-1] = n - 1
+    return selected
+
+
+class StockHistoryRepository:
+    """
+    Repo for the stock history series.
+    """
+    ledger_repo = StockLedgerRepository()
+
+    def history(self, db: Session, medication_id: int, date_from: datetime, date_to: datetime,
+                points: int = DEFAULT_POINTS) -> StockHistoryResponse:
+        """
+        Downsampled stock series of a medication between date_from and date_to.
+        """
+        start = self.ledger_repo.stock_at(db, medication_id, date_from)
+
+        rows = db.execute(
+            select(StockLedgerDB.created_at, StockLedgerDB.delta)
+            .where(StockLedgerDB.medication_id == medication_id,
+                   StockLedgerDB.created_at > date_from,
+                   StockLedgerDB.created_at <= date_to)
+            .order_by(StockLedgerDB.created_at, StockLedgerDB.id)
+        ).all()
+
+        #Seconds since date_from (naive UTC datetimes)
+        times = np.array([0.0] + [(created_at - date_from).total_seconds() for created_at, _ in rows]
+                         + [(date_to - date_from).total_seconds()])
+        deltas = np.array([start.stock] + [delta for _, delta in rows] + [0], dtype=np.int64)
+        stocks = np.cumsum(deltas)
+
+        kept = lttb(times, stocks.astype(np.float64), points)
+        series = [StockHistoryPoint(t=date_from + timedelta(seconds=float(times[i])), stock=int(stocks[i]))
+                  for i in kept]
+        return StockHistoryResponse(medication_id=medication_id, date_from=date_from, date_to=date_to,
+                                    changes=len(rows), points=series)
@@ -0,0 +1,143 @@
+"""
+Stock ledger and snapshots
+
+Every stock change is recorded as a ledger row (medication, delta, reason, order id, timestamp). The rows of a
+transaction are buffered in the session and written with one INSERT just before it commits, so the ledger is always
+in the same transaction as the stock update.
+A snapshot stores the stock of every medication changed since the previous one, with the last ledger id it includes;
+the stock at any time is the latest earlier snapshot plus the ledger rows after it (O(snapshot + tail)).
+
+Every stock write goes through the ledger (the bulk import too, with "import" rows), so the changed-only snapshot
+is complete. A full snapshot (--all) re-bases all the medications, e.g. after stock was written outside the app.
+
+To take a snapshot (e.g. daily, with cron), in terminal: python stock_ledger.py [--all]
+"""
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+from sqlalchemy import func, insert, literal, or_, select
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from models import MedicationDB, StockLedgerDB, StockSnapshotDB, SyncStateDB, StockAtResponse
+
+
+#Ledger reasons
+ORDER = "order"
+ORDER_UPDATE = "order_update"
+ADJUSTMENT = "adjustment"   #Stock set by a medication update
+INITIAL = "initial"         #Stock of a new medication
+DELETED = "deleted"
+RECEIVED = "received"       #Lot received (lots.py)
+IMPORT = "import"           #Stock set by a bulk import
+
+SESSION_KEY = "stock_ledger"
+
+
+def naive_utc(value: datetime) -> datetime:
+    """
+    The ledger timestamps are naive UTC: convert an aware datetime from a request.
+    """
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+def record_ledger(db: Session, entries: Iterable[tuple]):
+    """
+    Buffer (medication id, delta, reason, order id) ledger rows until the session commits.
+    """
+    now = datetime.utcnow()
+    db.info.setdefault(SESSION_KEY, []).extend(
+        {"medication_id": medication_id, "delta": delta, "reason": reason, "order_id": order_id, "created_at": now}
+        for medication_id, delta, reason, order_id in entries if delta
+    )
+
+
+@listens_for(Session, "before_commit")
+def write_ledger(session: Session):
+    entries = session.info.pop(SESSION_KEY, None)
+    if entries:
+        session.execute(insert(StockLedgerDB), entries)
+
+
+@listens_for(Session, "after_rollback")
+def discard_ledger(session: Session):
+    session.info.pop(SESSION_KEY, None)
+
+
+class StockLedgerRepository:
+    """
+    Repo for the stock ledger and snapshots.
+    """
+    @staticmethod
+    def take_snapshot(db: Session, changed_only: bool = True) -> int:
+        """
+        Snapshot the stock of the medications changed since the previous snapshot (all with changed_only=False).
+        Return the number of snapshot rows.
+        """
+        #The stock writers hold the sync counter lock until they commit (sync.row_version): waiting for it makes
+        #the stock values and the last ledger id consistent
+        db.query(SyncStateDB).filter(SyncStateDB.id == 1).with_for_update().one()
+
+        last_ledger_id = db.query(func.max(StockLedgerDB.id)).scalar() or 0
+        previous_ledger_id = db.query(func.max(StockSnapshotDB.ledger_id)).scalar() or 0
+
+        medications = select(MedicationDB.id, literal(datetime.utcnow()), MedicationDB.stock, literal(last_ledger_id))
+        if changed_only:
+            medications = medications.where(or_(
+                MedicationDB.id.in_(select(StockLedgerDB.medication_id).where(StockLedgerDB.id > previous_ledger_id)),
+                ~MedicationDB.id.in_(select(StockSnapshotDB.medication_id))
+            ))
+
+        result = db.execute(insert(StockSnapshotDB).from_select(
+            ["medication_id", "taken_at", "stock", "ledger_id"], medications))
+        db.commit()
+        return result.rowcount
+
+
+    @staticmethod
+    def has_history(db: Session, medication_id: int) -> bool:
+        """
+        Check that a medication exists or has ledger rows (the ledger of a deleted medication is kept).
+        """
+        return db.query(or_(
+            select(MedicationDB.id).where(MedicationDB.id == medication_id).exists(),
+            select(StockLedgerDB.id).where(StockLedgerDB.medication_id == medication_id).exists()
+        )).scalar()
+
+
+    @staticmethod
+    def stock_at(db: Session, medication_id: int, at: datetime) -> StockAtResponse:
+        """
+        Stock of a medication at a point in time: latest snapshot before it plus the ledger tail.
+        Without a snapshot the ledger is replayed from the start (from the "initial" row of the medication).
+        """
+        snapshot = (db.query(StockSnapshotDB)
+                    .filter(StockSnapshotDB.medication_id == medication_id, StockSnapshotDB.taken_at <= at)
+                    .order_by(StockSnapshotDB.taken_at.desc())
+                    .first())
+        stock, after_id = (snapshot.stock, snapshot.ledger_id) if snapshot else (0, 0)
+
+        tail, rows = db.query(func.coalesce(func.sum(StockLedgerDB.delta), 0), func.count(StockLedgerDB.id)).filter(
+            StockLedgerDB.medication_id == medication_id,
+            StockLedgerDB.id > after_id,
+            StockLedgerDB.created_at <= at
+        ).one()
+
+        return StockAtResponse(medication_id=medication_id, at=at, stock=stock + tail,
+                               snapshot_at=snapshot.taken_at if snapshot else None, ledger_rows=rows)
+
+
+if __name__ == "__main__":
+    import argparse
+    from database import SessionLocal, engine
+    import models
+
+    parser = argparse.ArgumentParser(description="Take a stock snapshot.")
+    parser.add_argument("--all", action="store_true", help="Snapshot all the medications, not only the changed ones")
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    try:
+        count = StockLedgerRepository().take_snapshot(session, changed_only=not args.all)
+        print(f"Stock snapshot taken for {count} medications.")
+    finally:
+        session.close()
@@ -0,0 +1,111 @@
+"""
+Delta sync of the medications and orders (GET /sync?since_version=N)
+
+Every transaction that writes medications or orders takes the next value of a global counter (sync_state) and stores
+it in the row_version column of the rows it changes; deleted rows leave a tombstone with the version.
+The counter row stays locked until the transaction commits, so the versions become visible in increasing order and a
+client that stored the last version it received never misses a change (the writes are serialized on the counter).
+ORM writes are versioned by a before_flush listener, the set-based UPDATEs set row_version=row_version(db) themselves.
+"""
+from itertools import chain
+from sqlalchemy import update
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from models import (MedicationDB, OrderDB, OrderItemDB, SyncStateDB, SyncTombstoneDB, MedicationResponse,
+                    OrderResponse, OrderItemResponse, SyncResponse, SyncTombstoneResponse)
+
+
+SESSION_KEY = "row_version"
+VERSIONED = (MedicationDB, OrderDB)
+
+
+def row_version(db: Session) -> int:
+    """
+    Version of the current transaction (the counter is increased once per transaction).
+    """
+    version = db.info.get(SESSION_KEY)
+    if version is None:
+        version = db.execute(
+            update(SyncStateDB).where(SyncStateDB.id == 1).values(version=SyncStateDB.version + 1)
+            .returning(SyncStateDB.version)
+        ).scalar_one()
+        db.info[SESSION_KEY] = version
+    return version
+
+
+@listens_for(Session, "before_flush")
+def version_rows(session: Session, flush_context, instances):
+    """
+    Set the row version of the new and changed medications / orders, add the tombstones of the deleted ones.
+    A change of the order items is a change of the order.
+    """
+    changed = {obj for obj in session.new if isinstance(obj, VERSIONED)}
+    changed.update(obj for obj in session.dirty
+                   if isinstance(obj, VERSIONED) and session.is_modified(obj, include_collections=False))
+    for item in chain(session.new, session.dirty, session.deleted):
+        if isinstance(item, OrderItemDB):
+            order = item.order if item.order is not None else session.get(OrderDB, item.order_id)
+            if order is not None and order not in session.deleted:
+                changed.add(order)
+    deleted = [obj for obj in session.deleted if isinstance(obj, VERSIONED)]
+
+    if not changed and not deleted:
+        return
+    version = row_version(session)
+    for obj in changed:
+        obj.row_version = version
+    for obj in deleted:
+        session.add(SyncTombstoneDB(table_name=obj.__tablename__, row_id=obj.id, version=version))
+
+
+@listens_for(Session, "after_commit")
+@listens_for(Session, "after_rollback")
+def reset_row_version(session: Session):
+    session.info.pop(SESSION_KEY, None)
+
+
+class SyncRepository:
+    """
+    Repo for the delta sync.
+    """
+    @staticmethod
+    def get_changes(db: Session, since_version: int = 0, medications: bool = True,
+                    orders: bool = True) -> SyncResponse:
+        """
+        Medications, orders and tombstones with a version greater than since_version.
+        since_version=0 returns all the rows (first sync, the rows older than the versioning have version 0).
+        """
+        #Read before the rows: any row with a greater version is committed after this point
+        version = db.query(SyncStateDB.version).filter(SyncStateDB.id == 1).scalar() or 0
+        min_version = since_version + 1 if since_version else 0
+
+        changed_medications = []
+        if medications:
+            changed_medications = [
+                MedicationResponse.model_validate(medication) for medication in
+                db.query(MedicationDB).filter(MedicationDB.row_version >= min_version).order_by(MedicationDB.id)
+            ]
+
+        changed_orders = []
+        if orders:
+            changed_orders = [
+                OrderResponse(
+                    id=order.id,
+                    pharmacy_id=order.pharmacy_id,
+                    order_date=order.order_date,
+                    status=order.status,
+                    total_amount=order.total_amount,
+                    order_items=[OrderItemResponse(medication_id=item.medication_id, quantity=item.quantity,
+                                                   price=item.price) for item in order.order_items]
+                ) for order in db.query(OrderDB).filter(OrderDB.row_version >= min_version).order_by(OrderDB.id)
+            ]
+
+        tables = [table for table, included in (("medications", medications), ("orders", orders)) if included]
+        deleted = [
+            SyncTombstoneResponse.model_validate(tombstone) for tombstone in
+            db.query(SyncTombstoneDB).filter(SyncTombstoneDB.version > since_version,
+                                             SyncTombstoneDB.table_name.in_(tables)).order_by(SyncTombstoneDB.version)
+        ]
+
+        return SyncResponse(version=max(version, since_version), medications=changed_medications,
+                            orders=changed_orders, deleted=deleted)
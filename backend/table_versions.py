@@ -0,0 +1,96 @@
+"""
+Per-table change counters for the client caches (GET /versions, ETag / If-None-Match on the list endpoints)
+
+Every transaction that writes medications, pharmacies or orders (order items count as orders) increases the counter
+of the table once, in the same transaction. The ORM writes are detected after the flush and the DML statements
+(set-based updates, bulk inserts) when they are executed; raw SQL writes call mark_changed.
+The ETag of a list response is built from the counters of the tables it reads, the query string and the format,
+so checking it costs one small query instead of loading and serializing the list.
+"""
+from typing import Dict, Iterable, List, Optional
+from fastapi import Request, Response
+from sqlalchemy import update
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+from models import TableVersionDB
+from tabular import requested_format
+import hashlib
+
+
+#Written table -> versioned table
+TRACKED_TABLES = {"medications": "medications", "pharmacies": "pharmacies", "orders": "orders",
+                  "order_items": "orders"}
+SESSION_KEY = "changed_tables"
+
+
+def mark_changed(session: Session, table_names: Iterable[str]):
+    """
+    Increase the counters of the written tables (once per table and transaction).
+    """
+    bumped = session.info.setdefault(SESSION_KEY, set())
+    tables = {TRACKED_TABLES[name] for name in table_names if name in TRACKED_TABLES} - bumped
+    if not tables:
+        return
+    session.connection().execute(
+        update(TableVersionDB).where(TableVersionDB.table_name.in_(tables))
+        .values(version=TableVersionDB.version + 1)
+    )
+    bumped.update(tables)
+
+
+@listens_for(Session, "after_flush")
+def mark_flushed_tables(session: Session, flush_context):
+    mark_changed(session, {obj.__tablename__ for obj in (*session.new, *session.dirty, *session.deleted)
+                           if hasattr(obj, "__tablename__")})
+
+
+@listens_for(Session, "do_orm_execute")
+def mark_dml_tables(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, "table", None)
+        if table is not None:
+            mark_changed(orm_execute_state.session, [table.name])
+
+
+@listens_for(Session, "after_commit")
+@listens_for(Session, "after_rollback")
+def reset_changed_tables(session: Session):
+    session.info.pop(SESSION_KEY, None)
+
+
+class TableVersionRepository:
+    """
+    Repo for the table change counters.
+    """
+    @staticmethod
+    def get_versions(db: Session) -> Dict[str, int]:
+        return {table_name: version for table_name, version in db.query(TableVersionDB.table_name,
+                                                                         TableVersionDB.version)}
+
+
+    def etag(self, db: Session, request: Request, tables: List[str]) -> str:
+        """
+        ETag of a list response reading the tables.
+        """
+        versions = self.get_versions(db)
+        key = "|".join([",".join(f"{table}:{versions.get(table, 0)}" for table in tables),
+                        str(request.url.path), str(request.url.query), requested_format(request) or "json"])
+        return f'"{hashlib.sha1(key.encode()).hexdigest()[:20]}"'
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """
+    304 response when the client already has this version (If-None-Match), otherwise None.
+    """
+    tags = [tag.strip().removeprefix("W/") for tag in request.headers.get("if-none-match", "").split(",")]
+    if etag in tags or "*" in tags:
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    """
+    Add the ETag to a response built by the endpoint.
+    """
+    response.headers["ETag"] = etag
+    return response
@@ -0,0 +1,57 @@
+"""
+Tabular responses (Apache Arrow IPC stream / Parquet) for the list and analytics endpoints
+
+The client asks for them with the Accept header, otherwise the endpoints return JSON.
+pip install pyarrow
+"""
+from io import BytesIO
+from typing import Iterable, Optional, Sequence
+from fastapi import Request, Response
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:   #Without pyarrow the endpoints only return JSON
+    pa = None
+    pq = None
+
+
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+PARQUET = "application/vnd.apache.parquet"
+
+
+def requested_format(request: Request) -> Optional[str]:
+    """
+    Tabular media type accepted by the client, None -> JSON.
+    """
+    if pa is None:
+        return None
+
+    accept = request.headers.get("accept", "")
+    for media_type in (ARROW_STREAM, PARQUET):
+        if media_type in accept:
+            return media_type
+    return None
+
+
+def table_from_rows(columns: Sequence[str], rows: Iterable[Sequence]):
+    """
+    Arrow table built column by column from the query result rows.
+    """
+    rows = list(rows)
+    return pa.table({name: [row[i] for row in rows] for i, name in enumerate(columns)})
+
+
+def tabular_response(table, media_type: str) -> Response:
+    """
+    Serialize an Arrow table as an IPC stream or as a Parquet file.
+    """
+    if media_type == PARQUET:
+        buffer = BytesIO()
+        pq.write_table(table, buffer)
+        return Response(content=buffer.getvalue(), media_type=PARQUET)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(content=sink.getvalue().to_pybytes(), media_type=ARROW_STREAM)
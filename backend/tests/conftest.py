@@ -0,0 +1,8 @@
+"""
+The backend modules are imported from the backend folder, with an in-memory SQLite DB unless one is configured.
+"""
+import os
+import sys
+
+os.environ.setdefault("SQLALCHEMY_DATABASE_URL", "sqlite://")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
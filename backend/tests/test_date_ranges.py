@@ -0,0 +1,51 @@
+"""
+The from / to dates of the order search and of the analytics are inclusive: the same range gives the same totals.
+"""
+from datetime import date, datetime
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from database import Base
+from models import OrderStatus, OrderDB, OrderItemDB, PharmacyDB, MedicationDB
+from orders import OrderRepository
+from analytics import AnalyticsRepository
+from sales_rollup import SalesRollupRepository
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    session.add(PharmacyDB(id=1, name="Pharma A", address="Str 1", contact_phone="+40712345678", email="a@a.ro"))
+    session.add(MedicationDB(id=1, name="Aspirin", type="OTC", quantity=0, price=2.0, pharma_id=1, stock=100))
+    #One order on the first, the last and the day after the range
+    for order_id, day in enumerate([date(2024, 1, 1), date(2024, 1, 31), date(2024, 2, 1)], start=1):
+        session.add(OrderDB(id=order_id, pharmacy_id=1, status=OrderStatus.pending, total_amount=2.0 * order_id,
+                            order_date=datetime.combine(day, datetime.min.time()).replace(hour=23, minute=59)))
+        session.add(OrderItemDB(order_id=order_id, medication_id=1, quantity=order_id, price=2.0))
+    session.commit()
+    SalesRollupRepository().rebuild(session)
+    yield session
+    session.close()
+
+
+RANGE = {"date_from": date(2024, 1, 1), "date_to": date(2024, 1, 31)}
+
+
+def test_order_search_includes_the_last_day(db):
+    orders = OrderRepository().get_all(db, **RANGE)
+    assert [order.id for order in orders] == [1, 2]
+
+
+def test_best_sellers_include_the_last_day(db):
+    best_sellers = AnalyticsRepository().best_sellers(db, top_n=1, **RANGE)
+    assert [seller.quantity for seller in best_sellers] == [1 + 2]
+
+
+@pytest.mark.parametrize("medication_id", [None, 1])
+def test_sales_include_the_last_day(db, medication_id):
+    sales = SalesRollupRepository().sales(db, "month", medication_id=medication_id, **RANGE)
+    assert [(bucket.quantity, bucket.order_count) for bucket in sales] == [(1 + 2, 2)]
+    orders = OrderRepository().get_all(db, **RANGE)
+    assert sum(bucket.revenue for bucket in sales) == sum(order.total_amount for order in orders)
@@ -0,0 +1,49 @@
+"""
+Query plans of the order search (GET /orders filters) on SQLite: the filters must use the composite indexes.
+"""
+from datetime import date
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import sessionmaker
+from database import Base
+from models import OrderStatus
+from orders import OrderRepository
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def query_plan(db, query) -> str:
+    """
+    EXPLAIN QUERY PLAN of an ORM query, as one string.
+    """
+    sql = query.statement.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    return "\n".join(row[-1] for row in db.execute(text(f"EXPLAIN QUERY PLAN {sql}")))
+
+
+@pytest.mark.parametrize("filters", [
+    {"pharmacy_id": 1, "status": OrderStatus.pending},
+    {"pharmacy_id": 1, "status": OrderStatus.pending, "date_from": date(2024, 1, 1), "date_to": date(2024, 1, 31)},
+])
+def test_pharmacy_status_date_filter_uses_composite_index(db, filters):
+    plan = query_plan(db, OrderRepository().order_query(db, **filters))
+    assert "ix_orders_pharmacy_status_date" in plan
+
+
+def test_medication_filter_uses_medication_order_index(db):
+    plan = query_plan(db, OrderRepository().order_query(db, medication_id=1))
+    assert "ix_order_items_medication_order" in plan
+
+
+def test_all_filters_use_both_indexes(db):
+    plan = query_plan(db, OrderRepository().order_query(db, pharmacy_id=1, status=OrderStatus.processed,
+                                                        date_from=date(2024, 1, 1), medication_id=1))
+    assert "ix_orders_pharmacy_status_date" in plan
+    assert "ix_order_items_medication_order" in plan
@@ -1,90 +1,74 @@
 """
 The relationship between the medication stock quantity and the stock level throw scatter plot and bar chart visualization
+The charts are rendered from the aggregated summary computed by the API.
 """
-from utils import get_medications_and_pharmacies
+from utils import get_dashboard_summary
 import pandas as pd      #data manipulation & visualization
 import streamlit as st
 import altair as alt     #data visualization
 
 
+STOCK_LEVEL_SCALE = alt.Scale(domain=["low", "medium", "high"], range=["red", "orange", "green"])
+
+
 def quantity_vs_stock_level_chart():
     """
     Quantity vs. stock level
     """
     st.subheader("Stock Quantity vs. Stock Level Overview")
 
-    #Fetch medications and pharmacies data
-    response = get_medications_and_pharmacies()
-
-    if response.status_code == 200:
-        data = response.json()
-        all_medications = []
-
-        #Extract informations from response
-        for item in data:
-            medication = item['medication']
-            pharmacy = item['pharmacy']
-
-            med_data = {
-                'id': medication['id'],
-                'name': medication['name'],
-                'type': medication['type'],
-                'quantity': medication['quantity'],
-                'price': medication['price'],
-                'stock': medication['stock'],
-                'stock_level': medication['stock_level'],
-                'pharmacy_name': pharmacy['name'],
-            }
-            all_medications.append(med_data)
-
-        #Convert medications list to DataFrame
-        df_all_medications = pd.DataFrame(all_medications)
-
-        #Check if the DataFrame is not empty
-        if not df_all_medications.empty:
-            source = df_all_medications.copy()
-
-            #Map stock levels to categories
-            source['stock_level'] = source['stock_level'].astype('category')
-            brush = alt.selection_interval()
-
-            #Create a scatter plot with brush interaction
-            points = alt.Chart(source).mark_circle(opacity=0.5).encode(
-                x=alt.X('name:N', title='Medication'),
-                y=alt.Y('stock:Q', title='Stock'),
-                color=alt.Color('stock_level:N', title="Stock Level",
-                                scale=alt.Scale(domain=["low", "medium", "high"],
-                                                range=["red", "orange", "green"])),
-                tooltip=['name:N', 'stock:Q', 'stock_level:N']
-            ).add_params(brush)
-
-            #Create a bar chart to display count of stock levels filtered by brush
-            bars = alt.Chart(source).mark_bar().encode(
-                x=alt.Y('stock_level:N', title='Stock Level'),
-                y=alt.X('count():Q', title='Number of Medications'),
-                color='stock_level:N'
-            ).transform_filter(brush)
-
-            #Combine both charts
-            chart = points & bars
-
-            #Create Streamlit tabs with different themes
-            tab1, tab2 = st.tabs(["Streamlit theme (default)", "Altair native theme"])
-
-            with tab1:
-                st.altair_chart(chart, theme="streamlit", use_container_width=True)
-            with tab2:
-                st.altair_chart(chart, theme=None, use_container_width=True)
-
-            #Stock level threshold
-            st.markdown("### Stock Level Threshold:")
-            st.markdown("- **Low**: 0-100 units")
-            st.markdown("- **Medium**: 101-350 units")
-            st.markdown("- **High**: 351 and above")
-        else:
-            st.error("No data available to generate the chart.")
-    else:
+    #Fetch the dashboard summary
+    summary = get_dashboard_summary(top_n=20)
+
+    if summary is None:
         st.error("Error fetching data.")
+        return
+
+    if not any(summary['stock_levels'].values()):
+        st.error("No data available to generate the chart.")
+        return
+
+    df_levels = pd.DataFrame(summary['stock_levels'].items(), columns=['stock_level', 'count'])
+    df_lowest = pd.DataFrame(summary['lowest_stock'])
+
+    #Bar chart with the lowest stock medications
+    points = alt.Chart(df_lowest).mark_bar(opacity=0.7).encode(
+        x=alt.X('name:N', title='Medication', sort='y'),
+        y=alt.Y('stock:Q', title='Stock'),
+        color=alt.Color('stock_level:N', title="Stock Level", scale=STOCK_LEVEL_SCALE),
+        tooltip=['name:N', 'stock:Q', 'stock_level:N']
+    ).properties(title='Medications with the Lowest Stock')
+
+    #Bar chart with the count of medications per stock level
+    bars = alt.Chart(df_levels).mark_bar().encode(
+        x=alt.X('stock_level:N', title='Stock Level', sort=["low", "medium", "high"]),
+        y=alt.Y('count:Q', title='Number of Medications'),
+        color=alt.Color('stock_level:N', scale=STOCK_LEVEL_SCALE),
+        tooltip=['stock_level:N', 'count:Q']
+    )
+
+    #Combine both charts
+    chart = points & bars
+
+    #Create Streamlit tabs with different themes
+    tab1, tab2 = st.tabs(["Streamlit theme (default)", "Altair native theme"])
+
+    with tab1:
+        st.altair_chart(chart, theme="streamlit", use_container_width=True)
+    with tab2:
+        st.altair_chart(chart, theme=None, use_container_width=True)
+
+    #Totals per pharmacy
+    if summary['pharmacies']:
+        st.markdown("### Pharmacies")
+        st.dataframe(pd.DataFrame(summary['pharmacies']))
+
+    #Stock level threshold (configured in the backend)
+    thresholds = summary['stock_level_thresholds']
+    st.markdown("### Stock Level Threshold:")
+    st.markdown(f"- **Low**: 0-{thresholds['low']} units")
+    st.markdown(f"- **Medium**: {thresholds['low'] + 1}-{thresholds['medium']} units")
+    st.markdown(f"- **High**: {thresholds['medium'] + 1} and above")
 
 
 if __name__ == "__main__":
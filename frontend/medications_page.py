@@ -9,8 +9,9 @@ Main components:
 """
 import streamlit as st
 import pandas as pd      #data manipulation & visualization
-from utils import (get_all_medications, get_medication, create_medication, update_medication, delete_medication,
-                   get_medications_and_pharmacies, convert_image_to_base64, decode_base64_to_image)
+from utils import (get_medication, get_stock_history, create_medication, update_medication, delete_medication, search_medications,
+                   bulk_import,
+                   get_medications_and_pharmacies_normalized, convert_image_to_base64, decode_base64_to_image)
 
 
 def show_medications_page():
@@ -19,7 +20,7 @@ def show_medications_page():
     """
     st.subheader("Medications")
     menu = ["Medications and Pharmacies", "View All Medications", "View Specific Medication", "Add New Medication",
-            "Update Medication", "Delete Medication"]
+            "Import Medications", "Update Medication", "Delete Medication"]
     choice = st.selectbox("Select an option", menu)
 
     if choice == "Medications and Pharmacies":
@@ -30,62 +31,42 @@ def show_medications_page():
         view_medication()
     elif choice == "Add New Medication":
         add_medication()
+    elif choice == "Import Medications":
+        import_medications()
     elif choice == "Update Medication":
         init_update_medication()
     elif choice == "Delete Medication":
         init_delete_medication()
 
 
-def filter_medications(df, search_query, stock_level_filter):
-    """
-    Filter medications based on search query and stock level
-    """
-    if search_query:
-        df = df[
-            df['name'].str.contains(search_query, case=False, na=False) |
-            df['type'].str.contains(search_query, case=False, na=False) |
-            df['stock_level'].str.contains(search_query, case=False, na=False)
-            ]
-
-    if stock_level_filter != "All":
-        df = df[df['stock_level'] == stock_level_filter]
-
-    return df
-
-
 def view_all_medications():
     """
-    Display all available medications in a table format with search, filter and sort functionality
+    Display all available medications in a table format with search, filter and sort functionality.
+    Search, filtering and sorting run on the server, only the matching medications are loaded.
     """
     st.subheader("All Medications")
-    with st.spinner("Loading medications..."):
-        medications = get_all_medications().json()
-
-    if not medications:
-        st.write("There are no medications.")
-        return
-
-    df_medication = pd.DataFrame(medications)
 
     #Filtering
-    search_query = st.text_input("Search", placeholder="Type to search..." , help="Search by medication name, type or stock level.")
+    search_query = st.text_input("Search", placeholder="Type to search..." , help="Search by medication name.")
     stock_level_filter = st.selectbox("Filter by Stock Level", ["All", "low", "medium", "high"], index=0)
-
-    df_medication = filter_medications(df_medication, search_query, stock_level_filter)
-
-    if df_medication.empty:
-        st.warning("Medication not found.")
-        return
+    type_filter = st.selectbox("Filter by Type", ["All", "RX", "OTC"], index=0)
 
     #Sorting
     sort_medications = st.selectbox("Sort by", options=["Name", "Type"], index=0)
     sort_ascending = st.checkbox("Sort Ascending", value=True)
+    sort_column = sort_medications.lower() if sort_ascending else f"-{sort_medications.lower()}"
 
-    if sort_medications:
-        sort_column = sort_medications.lower()
-        if sort_column in df_medication.columns:
-            df_medication[sort_column] = df_medication[sort_column].astype(str)
-            df_medication = df_medication.sort_values(by=sort_column, key=lambda x: x.str.lower(), ascending=sort_ascending)
+    with st.spinner("Loading medications..."):
+        df_medication = search_medications(
+            search_query=search_query,
+            stock_level=None if stock_level_filter == "All" else stock_level_filter,
+            type=None if type_filter == "All" else type_filter,
+            sort=sort_column
+        )
+
+    if df_medication.empty:
+        st.warning("Medication not found.")
+        return
 
     #Display the DF as a table
     st.dataframe(df_medication)
@@ -100,16 +81,18 @@ def view_pharma_and_med():
 
     st.subheader("Medications With Images")
     with st.spinner("Loading medications..."):
-        response = get_medications_and_pharmacies()
+        data = get_medications_and_pharmacies_normalized(
+            fields=['name', 'type', 'quantity', 'price', 'stock', 'stock_level', 'image'])
 
-    if response.status_code == 200:
-        data = response.json()
+    if data is not None:
+        #Each pharmacy is sent once
+        pharmacies = {pharmacy['id']: pharmacy for pharmacy in data['pharmacies']}
+        empty_pharmacy = {'name': None, 'address': None, 'contact_phone': None, 'email': None}
         all_medications = []
         valid_image_meds = []
 
-        for item in data:
-            medication = item['medication']
-            pharmacy = item['pharmacy']
+        for medication in data['medications']:
+            pharmacy = pharmacies.get(medication['pharma_id'], empty_pharmacy)
 
             med_data = {
                 'id': medication['id'],
@@ -192,6 +175,14 @@ def view_medication():
             st.write(f"**Pharma ID**: {medication_json['pharma_id']}")
             st.write(f"**Stock**: {medication_json['stock']} RON")
             st.write(f"**Stock Level**: {medication_json['stock_level']}")
+
+            #Stock over the last 90 days (downsampled by the API)
+            history = get_stock_history(medication_id)
+            if history and history["points"]:
+                st.write(f"**Stock history** ({history['changes']} changes)")
+                history_df = pd.DataFrame(history["points"])
+                history_df["t"] = pd.to_datetime(history_df["t"])
+                st.line_chart(history_df, x="t", y="stock")
         else:
             #Display an error message if the medication is not found
             st.warning(f"Medication with NPC {medication_id} not found. Please check the ID and try again.")
@@ -232,6 +223,30 @@ def add_medication():
 
 
 
+def import_medications():
+    """
+    Bulk import medications from a CSV or NDJSON file
+    """
+    st.subheader("Import Medications")
+    st.write("Upload a CSV (with header) or NDJSON file with the columns: name, type, quantity, price, pharma_id, "
+             "stock. Existing medications (same name and pharmacy) are updated.")
+
+    uploaded_file = st.file_uploader("Medications file", type=["csv", "ndjson", "jsonl"])
+
+    if uploaded_file is not None and st.button("Import"):
+        with st.spinner("Importing medications..."):
+            report = bulk_import("medications", uploaded_file)
+
+        if report is None:
+            st.error("The import failed. Please check the file and try again.")
+            return
+
+        st.success(f"{report['imported']} of {report['total']} medications imported.")
+        if report['errors']:
+            st.warning(f"{report['failed']} rows were rejected.")
+            st.dataframe(pd.DataFrame(report['errors']))
+
+
 def validate_medication_input(name, type, pharma_id, stock, quantity, price):
     """
     Validate medication input
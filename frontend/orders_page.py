@@ -10,79 +10,50 @@ import streamlit as st
 import pandas as pd
 import plotly.graph_objects as go           #Used for creating interactive plots
 from plotly.subplots import make_subplots   #Used for creating subplots
-from utils import (get_all_orders, get_order, create_order, update_order, update_order_status, delete_order, OrderStatus,
-                   get_all_medications)
+from utils import (get_order, create_order, update_order, update_order_status, delete_order, OrderStatus,
+                   get_best_sellers, get_dataframe)
 
 
 def show_best_selling_medication():
     """
     Best-selling medications per pharmacy
 
-    The function retrieves all orders & medications and processes the data to determine the best-selling medication for
-    each pharmacy.
+    The best-selling medication and the total ordered quantity of each pharmacy are aggregated on the server.
     Plot a pie chart using Plotly showing the percentage comparison between the best-selling medication and other
     medications per each pharmacy.
     """
     st.subheader("Best-Selling Medication per Pharmacy")
 
-    #Fetch all orders
-    with st.spinner("Loading order..."):
-        orders = get_all_orders().json()
+    #Fetch the best-selling medication of every pharmacy
+    with st.spinner("Loading best-selling medications..."):
+        best_sellers = get_best_sellers(top_n=1)
 
-    if not orders:
+    if not best_sellers:
         st.write("There are no orders.")
         return
 
-    #Convert orders to DataFrame
-    df_orders = pd.DataFrame(orders)
-
-    #Expand the order_items column
-    df_items = df_orders.explode('order_items')
-    df_items['medication_id'] = df_items['order_items'].apply(lambda x: x['medication_id'])
-    df_items['quantity'] = df_items['order_items'].apply(lambda x: x['quantity'])
-
-    #Group by pharmacy_id and medication_id, sum the quantities
-    df_grouped = df_items.groupby(['pharmacy_id', 'medication_id'])['quantity'].sum().reset_index()
-
-    #Fetch all medications
-    with st.spinner("Loading medication..."):
-        medications = get_all_medications().json()
-
-    #Create a dictionary by mapping medication's ID to medication's name
-    medication_names = {med['id']: med['name'] for med in medications}
-
-    #Add medication names to DataFrame
-    df_grouped['medication_name'] = df_grouped['medication_id'].map(medication_names)
-
     #Create subplots for each pharmacy
-    fig = make_subplots(rows=1, cols=3, specs=[[{'type': 'domain'}, {'type': 'domain'}, {'type': 'domain'}]],
-                        subplot_titles=("Pharma A", "Pharma B", "Pharma C"))
+    titles = [item['pharmacy_name'] or f"Pharma {item['pharmacy_id']}" for item in best_sellers]
+    fig = make_subplots(rows=1, cols=len(best_sellers), specs=[[{'type': 'domain'}] * len(best_sellers)],
+                        subplot_titles=titles)
 
     colors = ['#00CED1', '#FFA500', '#8B0000', '#00008B', '#FF99CC', '#00CED1']
 
-    for i, pharmacy_id in enumerate([1, 2, 3], start=1):
-        pharmacy_data = df_grouped[df_grouped['pharmacy_id'] == pharmacy_id]
-
-        #Best-selling medication
-        best_selling = pharmacy_data.loc[pharmacy_data['quantity'].idxmax()]
-
-        #Total quantity per pharmacy
-        total_quantity = pharmacy_data['quantity'].sum()
-
+    for i, best_selling in enumerate(best_sellers, start=1):
         #Quantity for "Other medications"
-        other_quantity = total_quantity - best_selling['quantity']
+        other_quantity = best_selling['pharmacy_total_quantity'] - best_selling['quantity']
 
         labels = [best_selling['medication_name'], 'Other medications']
         values = [best_selling['quantity'], other_quantity]
 
-        fig.add_trace(go.Pie(labels=labels, values=values, name=f"Pharma {pharmacy_id}",
+        fig.add_trace(go.Pie(labels=labels, values=values, name=titles[i - 1],
                              marker_colors=colors), 1, i)
 
     fig.update_traces(textposition='inside', textinfo='percent+label')
     fig.update_layout(
         title_text="Best-Selling Medication vs. Other Medications",
         height=500,
-        width=900,
+        width=max(900, 300 * len(best_sellers)),
     )
 
     st.plotly_chart(fig)
@@ -121,16 +92,30 @@ def view_all_orders():
     Display all available orders
     """
     st.subheader("All Orders")
+
+    #Filters applied by the API
+    pharmacy_filter = st.number_input("Filter by Pharmacy ID (0 = all)", min_value=0, step=1)
+    status_filter = st.selectbox("Filter by Status", ["All"] + [status.value for status in OrderStatus], index=0)
+    medication_filter = st.number_input("Filter by Medication ID (0 = all)", min_value=0, step=1)
+    date_range = st.date_input("Order Date Range", value=[], help="Leave empty for all dates.")
+
+    params = {}
+    if pharmacy_filter:
+        params["pharmacy_id"] = int(pharmacy_filter)
+    if status_filter != "All":
+        params["status"] = status_filter
+    if medication_filter:
+        params["medication_id"] = int(medication_filter)
+    if len(date_range) == 2:
+        params["from"], params["to"] = date_range[0].isoformat(), date_range[1].isoformat()
+
     with st.spinner("Loading orders..."):
-        orders = get_all_orders().json()
+        df_order = get_dataframe("/orders", params)
 
-    if not orders:
+    if df_order.empty:
         st.write("There are no orders.")
         return
 
-    #Convert orders to DF
-    df_order = pd.DataFrame(orders)
-
     #Convert order_items to string
     df_order['order_items'] = df_order['order_items'].apply(lambda items: ', '.join(
         [f"Medication ID: {item['medication_id']}, Quantity: {item['quantity']}, Price: {item['price']}" for item in items]
@@ -8,7 +8,8 @@ Main components:
 """
 import streamlit as st
 import pandas as pd    #data manipulation & visualization
-from utils import get_all_pharmacies, get_pharmacy, create_pharmacy, update_pharmacy, delete_pharmacy
+from utils import (get_all_pharmacies, get_pharmacy, create_pharmacy, update_pharmacy, delete_pharmacy,
+                   get_nearest_pharmacies)
 import re              #Python build-in regex module, used for input validation
 import pydeck as pdk   #interactive map
 
@@ -23,7 +24,7 @@ def show_pharmacies_page():
 
     #Menu for CRUD operations
     menu = ["View All Pharmacies", "View Specific Pharmacy", "Add New Pharmacy", "Update Pharmacy",
-            "Delete Pharmacy"]
+            "Delete Pharmacy", "Nearest Pharmacy with Stock"]
     choice = st.selectbox("Select an option", menu)
 
     if choice == "View All Pharmacies":
@@ -36,6 +37,8 @@ def show_pharmacies_page():
         init_update_pharmacy()
     elif choice == "Delete Pharmacy":
         init_delete_pharmacy()
+    elif choice == "Nearest Pharmacy with Stock":
+        find_nearest_pharmacy()
 
     display_locations()
 
@@ -107,6 +110,27 @@ def view_pharmacy():
             st.error(f"Pharmacy with ID {pharmacy_id} has not been found.")
 
 
+def location_inputs(key: str, latitude=None, longitude=None):
+    """
+    Optional latitude / longitude inputs of the pharmacy forms, prefilled with the current location
+    """
+    latitude = st.number_input("Latitude", min_value=-90.0, max_value=90.0, value=latitude, format="%.6f",
+                               placeholder="45.6428", help="Pharmacy location (optional).", key=f"{key}_latitude")
+    longitude = st.number_input("Longitude", min_value=-180.0, max_value=180.0, value=longitude, format="%.6f",
+                                placeholder="25.5893", help="Pharmacy location (optional).", key=f"{key}_longitude")
+    return latitude, longitude
+
+
+def valid_location(latitude, longitude) -> bool:
+    """
+    The API accepts both coordinates or none
+    """
+    if (latitude is None) != (longitude is None):
+        st.error("Enter both latitude and longitude, or leave both empty.")
+        return False
+    return True
+
+
 #Add a new pharma
 def add_pharmacy():
     """
@@ -136,6 +160,7 @@ def add_pharmacy():
                                       placeholder="+40 7XX XXX XXX",
                                       max_chars=15
                                       )
+        latitude, longitude = location_inputs("add")
         submit_button = st.form_submit_button(label="Add Pharmacy", use_container_width=True)
 
     if submit_button:
@@ -148,7 +173,10 @@ def add_pharmacy():
                 st.error("Invalid phone number.")
                 return
 
-            response = create_pharmacy(name, address, contact_phone, email)
+            if not valid_location(latitude, longitude):
+                return
+
+            response = create_pharmacy(name, address, contact_phone, email, latitude, longitude)
             if response.status_code == 200:
                 st.success(f"Pharmacy '{name}' added successfully.")
             else:
@@ -169,6 +197,10 @@ def init_update_pharmacy():
                                   min_value=1,
                                   help="Enter the ID of the pharmacy you want to update."
                                   )
+    #Current location, kept unless changed
+    current = get_pharmacy(pharmacy_id)
+    current = current.json() if current.status_code == 200 else {}
+
     with st.form(key='update_pharmacy_form'):
         name = st.text_input("New Pharmacy Name",
                              help="Enter the new name for the pharmacy.",
@@ -189,11 +221,15 @@ def init_update_pharmacy():
                               help="Enter the new email address.",
                               placeholder="new_pharma_name@yahoo.com"
                               )
+        latitude, longitude = location_inputs(f"update_{pharmacy_id}", current.get('latitude'),
+                                              current.get('longitude'))
         submit_button = st.form_submit_button(label="Update Pharmacy")
 
     if submit_button:
         if name and address and email and contact_phone:
-            response = update_pharmacy(pharmacy_id, name, address, contact_phone, email)
+            if not valid_location(latitude, longitude):
+                return
+            response = update_pharmacy(pharmacy_id, name, address, contact_phone, email, latitude, longitude)
             if response.status_code == 200:
                 st.success(f"Pharmacy with ID {pharmacy_id} updated successfully.")
             else:
@@ -222,13 +258,17 @@ def display_locations():
     """
     Display a map with the pharma's locations using Pydeck
     """
-    #Create DF with geographical coordinates, location labels and colors
-    pharma_locations = pd.DataFrame({
-        'lat': [45.6428, 45.6551, 45.6469],                                 #Latitude
-        'lon': [25.5893, 25.5963, 25.5884],                                 #Longitude
-        'location': ['Str. Republicii', 'Str. Lunga', 'Piata Teatrului'],   #Locations
-        'color': [[0,153,153], [0,153,0], [153, 0,76]]
-    })
+    #Create DF with the coordinates of the pharmacies that have a location
+    pharmacies = get_all_pharmacies().json()
+    pharma_locations = pd.DataFrame([pharmacy for pharmacy in pharmacies
+                                     if pharmacy.get('latitude') is not None and pharmacy.get('longitude') is not None])
+    if pharma_locations.empty:
+        st.info("No pharmacy has a location yet.")
+        return
+
+    pharma_locations = pharma_locations.rename(columns={'latitude': 'lat', 'longitude': 'lon', 'name': 'location'})
+    colors = [[0,153,153], [0,153,0], [153, 0,76]]
+    pharma_locations['color'] = [colors[i % len(colors)] for i in range(len(pharma_locations))]
 
     layer = pdk.Layer(
         'ScatterplotLayer',
@@ -252,8 +292,8 @@ def display_locations():
 
     #Map configuration
     view_state = pdk.ViewState(
-        latitude=45.648,   #Centered on Brasov
-        longitude=25.593,
+        latitude=pharma_locations['lat'].mean(),   #Centered on the pharmacies
+        longitude=pharma_locations['lon'].mean(),
         zoom=13.5,
         pitch=45
     )
@@ -268,3 +308,26 @@ def display_locations():
     #Display the map
     st.pydeck_chart(r)
 
+
+#Nearest pharmacies holding a medication
+def find_nearest_pharmacy():
+    """
+    Find the nearest pharmacies that have a medication in stock
+    """
+    st.subheader("Nearest Pharmacy with Stock")
+
+    medication_name = st.text_input("Medication Name", help="Enter the medication name.")
+    latitude = st.number_input("Latitude", min_value=-90.0, max_value=90.0, value=45.648, format="%.6f")
+    longitude = st.number_input("Longitude", min_value=-180.0, max_value=180.0, value=25.593, format="%.6f")
+    k = st.number_input("Number of pharmacies", min_value=1, max_value=100, step=1, value=5)
+
+    if st.button("Find"):
+        if not medication_name:
+            st.error("Enter the medication name.")
+            return
+
+        nearest = get_nearest_pharmacies(medication_name, latitude, longitude, k)
+        if not nearest:
+            st.warning(f"No pharmacy with a location has '{medication_name}' in stock.")
+            return
+        st.dataframe(pd.DataFrame(nearest))
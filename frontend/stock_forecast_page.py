@@ -4,7 +4,7 @@ Medication stock forecast page
 import streamlit as st
 import pandas as pd   #data manipulation & visualization
 import altair as alt  #statistical visualization lib -> interactive charts
-from utils import get_stock_forecast
+from utils import get_stock_forecast, suggest_medication_names
 import time
 
 
@@ -162,8 +162,16 @@ def show_stock_forecast_page():
     """
     st.title("Optimal Stock Forecast")
 
-    #User's input for medication name
-    medication_name = st.text_input("Enter the medication name:")
+    #User's input for medication name, completed with the names known by the server
+    typed_name = st.text_input("Enter the medication name:")
+    medication_name = typed_name
+
+    if typed_name:
+        suggestions = suggest_medication_names(typed_name)
+        if suggestions:
+            medication_name = st.selectbox("Matching medications:", suggestions)
+        else:
+            st.info("No medication starts with this name.")
 
     if st.button("Generate Forecast"):
         if medication_name:
@@ -5,17 +5,118 @@ Contains functions for CRUD operations on medications, pharmacies, and orders
 import requests
 import os
 import logging
+import threading
+import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 import base64
 from io import BytesIO
 from PIL import Image
 from enum import Enum
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:   #Without pyarrow the tables are fetched as JSON
+    pa = None
 
 
 #Load environment variables
 load_dotenv()
 API_URL = os.getenv("API_URL")
 
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+#Cached GET responses: (path, params, accept) -> (ETag, response, table versions), least recently used first.
+#Shared by the sessions of the Streamlit server (one thread each), bounded to RESPONSE_CACHE_SIZE responses.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 32))
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+#Table versions of the last GET /versions, reused for VERSIONS_TTL seconds (one call per page run instead of one
+#revalidation per cached response); the writes below expire them so their changes show up on the next run.
+VERSIONS_TTL = float(os.getenv("VERSIONS_TTL", 2))
+_versions = (0.0, None)   #(time.monotonic() of the call, versions)
+_versions_lock = threading.Lock()
+
+
+def get_versions():
+    """
+    Change counters of the medications, pharmacies and orders tables, None if the API does not answer.
+    """
+    global _versions
+    with _versions_lock:
+        fetched_at, versions = _versions
+        if versions is not None and time.monotonic() - fetched_at < VERSIONS_TTL:
+            return versions
+    try:
+        response = requests.get(f"{API_URL}/versions")
+    except requests.RequestException:
+        return None
+    versions = response.json() if response.ok else None
+    with _versions_lock:
+        _versions = (time.monotonic(), versions)
+    return versions
+
+
+def expire_versions():
+    """
+    Fetch the table versions again on the next cached GET (after a write).
+    """
+    global _versions
+    with _versions_lock:
+        _versions = (0.0, None)
+
+
+def cached_get(path, params=None, headers=None):
+    """
+    GET with a cached response: it is returned without a request while the table versions are the ones it was
+    fetched with (the ETags only depend on them), otherwise it is revalidated by ETag: the API answers 304 (no body)
+    until the data changes.
+    """
+    headers = dict(headers or {})
+    key = (path, tuple(sorted((params or {}).items())), headers.get("Accept"))
+    versions = get_versions()
+    with _response_cache_lock:
+        cached = _response_cache.get(key)
+        if cached and versions is not None and cached[2] == versions:
+            _response_cache.move_to_end(key)
+            return cached[1]
+    if cached:
+        headers["If-None-Match"] = cached[0]
+
+    response = requests.get(f"{API_URL}{path}", params=params, headers=headers)
+    if response.status_code == 304 and cached:
+        with _response_cache_lock:
+            if key in _response_cache:
+                _response_cache[key] = (cached[0], cached[1], versions)
+                _response_cache.move_to_end(key)
+        return cached[1]
+    if response.ok and response.headers.get("ETag"):
+        with _response_cache_lock:
+            _response_cache[key] = (response.headers["ETag"], response, versions)
+            _response_cache.move_to_end(key)
+            while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)   #Least recently used
+    return response
+
+
+def get_dataframe(path, params=None):
+    """
+    Fetch a list endpoint directly as a pandas DataFrame.
+    The Arrow IPC stream is requested when pyarrow is installed (no JSON decoding), otherwise JSON is used.
+    Return an empty DataFrame if the request fails.
+    """
+    headers = {"Accept": f"{ARROW_STREAM}, application/json"} if pa is not None else {}
+    response = cached_get(path, params=params, headers=headers)
+    if not response.ok:
+        return pd.DataFrame()
+
+    if response.headers.get("content-type", "").startswith(ARROW_STREAM):
+        #The response may be cached: the buffers are not released while converting
+        return pa.ipc.open_stream(response.content).read_all().to_pandas(split_blocks=True)
+    return pd.DataFrame(response.json())
+
 
 def convert_image_to_base64(uploaded_file):
     if uploaded_file is not None:
@@ -73,10 +174,46 @@ def get_all_medications():
     """
     Fetch all medications from API.
     """
-    response = requests.get(f"{API_URL}/medications")   #The requests library return an object
+    response = cached_get("/medications")   #The requests library return an object
     return response if response.ok else None
 
 
+def search_medications(search_query=None, stock_level=None, type=None, pharma_id=None, sort=None):
+    """
+    Search medications on the server, only the matching rows are returned.
+
+    search_query: medication name (or the beginning of the name)
+    stock_level: low, medium or high
+    type: RX or OTC
+    pharma_id: the id of the pharmacy
+    sort: column name, "-" prefix for descending order (e.g. "-price")
+
+    Return a DataFrame with the matching medications.
+    """
+    params = {
+        "q": search_query or None,
+        "stock_level": stock_level,
+        "type": type,
+        "pharma_id": pharma_id,
+        "sort": sort
+    }
+    return get_dataframe("/medications", params={key: value for key, value in params.items() if value is not None})
+
+
+def bulk_import(entity, uploaded_file):
+    """
+    Import a CSV/NDJSON file with medications or pharmacies.
+
+    entity: "medications" or "pharmacies"
+    uploaded_file: the file from the Streamlit uploader
+    Return the import report (imported rows and per-row errors) or None if the request failed.
+    """
+    files = {"file": (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)}
+    response = requests.post(f"{API_URL}/{entity}/bulk", files=files)
+    expire_versions()
+    return response.json() if response.ok else None
+
+
 def get_medication(medication_id):
     """
     Fetch a medication by medication ID.
@@ -111,6 +248,7 @@ def create_medication(name, type, quantity, price, pharma_id, stock, uploaded_fi
         files["image"] = (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)
 
     response = requests.post(f"{API_URL}/medications", data=medication_data, files=files)
+    expire_versions()
 
     if response.ok:
         return response.json()
@@ -146,6 +284,7 @@ def update_medication(medication_id, name, type, quantity, price, pharma_id, sto
         files["image"] = (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)
 
     response = requests.put(f"{API_URL}/medications/{medication_id}", data=medication_data, files=files)
+    expire_versions()
     return response.json() if response.ok else None
 
 
@@ -154,6 +293,7 @@ def delete_medication(medication_id):
     Delete a medication by medication ID.
     """
     response = requests.delete(f"{API_URL}/medications/{medication_id}")
+    expire_versions()
     return response
 
 
@@ -162,7 +302,7 @@ def get_all_pharmacies():
     """
     Fetch all pharmacies from API.
     """
-    response = requests.get(f"{API_URL}/pharmacies")
+    response = cached_get("/pharmacies")
     return response
 
 
@@ -174,7 +314,7 @@ def get_pharmacy(pharmacy_id):
     return response
 
 
-def create_pharmacy(name, address, contact_phone, email):
+def create_pharmacy(name, address, contact_phone, email, latitude=None, longitude=None):
     """
     Create a new pharmacy.
 
@@ -182,19 +322,23 @@ def create_pharmacy(name, address, contact_phone, email):
     address: the address of the pharmacy
     contact_phone: the pharmacy phone
     email: the pharmacy email
+    latitude, longitude: the pharmacy location (optional)
     """
     pharmacy_data = {
         "name": name,
         "address": address,
         "contact_phone": contact_phone,
-        "email": email
+        "email": email,
+        "latitude": latitude,
+        "longitude": longitude
     }
 
     response = requests.post(f"{API_URL}/pharmacies", json=pharmacy_data)
+    expire_versions()
     return response
 
 
-def update_pharmacy(pharmacy_id, name, address, contact_phone, email):
+def update_pharmacy(pharmacy_id, name, address, contact_phone, email, latitude=None, longitude=None):
     """
     Update a pharmacy by ID.
 
@@ -202,14 +346,18 @@ def update_pharmacy(pharmacy_id, name, address, contact_phone, email):
     address: the address of the pharmacy
     contact_phone: the pharmacy phone
     email: the pharmacy email
+    latitude, longitude: the pharmacy location (optional)
     """
     pharmacy_data = {
         "name": name,
         "address": address,
         "contact_phone": contact_phone,
-        "email": email
+        "email": email,
+        "latitude": latitude,
+        "longitude": longitude
     }
     response = requests.put(f"{API_URL}/pharmacies/{pharmacy_id}", json=pharmacy_data)
+    expire_versions()
     return response
 
 
@@ -218,6 +366,7 @@ def delete_pharmacy(pharmacy_id):
     Delete a pharmacy by ID.
     """
     response = requests.delete(f"{API_URL}/pharmacies/{pharmacy_id}")
+    expire_versions()
     return response
 
 
@@ -226,7 +375,7 @@ def get_all_orders():
     """
     Fetch all orders from API.
     """
-    response = requests.get(f"{API_URL}/orders")
+    response = cached_get("/orders")
     return response
 
 
@@ -253,6 +402,7 @@ def create_order(pharmacy_id, order_items, status):
     }
 
     response = requests.post(f"{API_URL}/orders", json=order_data)
+    expire_versions()
     return response if response.ok else None
 
 
@@ -272,6 +422,7 @@ def update_order(order_id, pharmacy_id, order_items, status):
     }
 
     response = requests.put(f"{API_URL}/orders/{order_id}/update", json=order_data)
+    expire_versions()
     return response
 
 
@@ -281,6 +432,7 @@ def update_order_status(order_id, new_status):
     """
     status = new_status.value if isinstance(new_status, OrderStatus) else new_status
     response = requests.put(f"{API_URL}/orders/{order_id}/status", params={"new_status": new_status})
+    expire_versions()
     return response
 
 
@@ -289,6 +441,7 @@ def delete_order(order_id):
     Delete an order by ID.
     """
     response = requests.delete(f"{API_URL}/orders/{order_id}")
+    expire_versions()
     return response
 
 
@@ -297,7 +450,7 @@ def get_medications_and_pharmacies():
     """
     Full join between the medications and pharmacies tables/ all available data from medications and pharmacies
     """
-    response = requests.get(f"{API_URL}/medications_with_pharmacies")
+    response = cached_get("/medications_with_pharmacies")
     if response.status_code == 200:
         data = response.json()
         for item in data:
@@ -311,6 +464,57 @@ def get_medications_and_pharmacies():
     return response
 
 
+def get_medications_and_pharmacies_normalized(fields=None):
+    """
+    Medications and pharmacies in the normalized shape: each pharmacy is listed once and the medications reference it
+    by pharma_id.
+
+    fields: list of the medication columns to fetch (the image is only sent when requested)
+    """
+    params = {"shape": "normalized"}
+    if fields:
+        params["fields"] = ",".join(fields)
+
+    response = cached_get("/medications_with_pharmacies", params=params)
+    return response.json() if response.ok else None
+
+
+#API request for the main page KPIs
+def get_dashboard_summary(top_n=10):
+    """
+    Counts per stock level, totals per pharmacy and the top N medications with the lowest stock
+    """
+    response = requests.get(f"{API_URL}/dashboard/summary", params={"top_n": top_n})
+    return response.json() if response.ok else None
+
+
+#API requests for ANALYTICS
+def get_best_sellers(top_n=1, date_from=None, date_to=None):
+    """
+    Top N best-selling medications per pharmacy, aggregated on the server.
+
+    top_n: number of medications per pharmacy
+    date_from / date_to: optional order date range (ISO format)
+    """
+    params = {"top_n": top_n}
+    if date_from:
+        params["from"] = date_from
+    if date_to:
+        params["to"] = date_to
+
+    response = requests.get(f"{API_URL}/analytics/best-sellers", params=params)
+    return response.json() if response.ok else []
+
+
+#API request for medication name suggestions (autocomplete)
+def suggest_medication_names(prefix, limit=10):
+    """
+    Medication names starting with the given prefix
+    """
+    response = requests.get(f"{API_URL}/medications/suggest", params={"prefix": prefix, "limit": limit})
+    return response.json() if response.ok else []
+
+
 #API request for fetching the stock forecast for a specific medication
 def get_stock_forecast(medication_name: str):
     """
@@ -322,3 +526,31 @@ def get_stock_forecast(medication_name: str):
         return response.json()
     elif response.status_code is not 200:
         return None
+
+
+def get_stock_history(medication_id: int, date_from=None, date_to=None, points: int = 500):
+    """
+    Get the downsampled stock history of a medication (default: last 90 days)
+    """
+    params = {"points": points}
+    if date_from:
+        params["from"] = date_from.isoformat()
+    if date_to:
+        params["to"] = date_to.isoformat()
+    response = requests.get(f"{API_URL}/medications/{medication_id}/stock-history", params=params)
+
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+
+def get_nearest_pharmacies(medication_name: str, lat: float, lon: float, k: int = 5):
+    """
+    Get the k nearest pharmacies holding a medication
+    """
+    response = requests.get(f"{API_URL}/medications/{medication_name}/nearest",
+                            params={"lat": lat, "lon": lon, "k": k})
+
+    if response.status_code == 200:
+        return response.json()
+    return None